@@ -1,5 +1,3 @@
-from ctypes import c_int
-
 # Setup aliases for the registers
 register_map = {}
 for x in xrange(32):
@@ -17,7 +15,14 @@ def map_lookup(dct, item):
 # Instruction Argument Types                                                   #
 # ---------------------------------------------------------------------------- #
 class Argument(object):
-    """ Represents an argument to an instruction. """
+    """ Represents an argument to an instruction.  Arguments are shared between all the instructions
+    that use them, so they can't be changed once they're made.
+    """
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise RuntimeError("Arguments are shared and can't be changed.")
+    
     def is_register(self):
         return False
     
@@ -27,6 +32,9 @@ class Argument(object):
     def is_offset(self):
         return False
     
+    def is_string(self):
+        return False
+    
     def value(self, sim):
         raise RuntimeError("Base arguments don't have a value.")
     
@@ -34,12 +42,21 @@ class Argument(object):
         raise RuntimeError("Cannot write to type %s" % type(self))
 
 class Register(Argument):
-    """ Represents a register argument. """
-    def __init__(self, name):
-        self.name = name
-        self.register_number = map_lookup(register_map, name)
-        if not (0 <= self.register_number < 32) or not isinstance(self.register_number, (int, long)):
-            raise RuntimeError("$%s does not appear to be a valid register." % self.name)
+    """ Represents a register argument.  There is one Register for each register name. """
+    __slots__ = ('name', 'register_number')
+    interned = {}
+
+    def __new__(cls, name):
+        register = cls.interned.get(name)
+        if register is None:
+            register_number = map_lookup(register_map, name)
+            if not (0 <= register_number < 32) or not isinstance(register_number, (int, long)):
+                raise RuntimeError("$%s does not appear to be a valid register." % name)
+            register = Argument.__new__(cls)
+            object.__setattr__(register, 'name', name)
+            object.__setattr__(register, 'register_number', register_number)
+            cls.interned[name] = register
+        return register
     
     def __str__(self):
         return 'Register(%s->%d)' % (self.name, self.register_number)
@@ -50,8 +67,14 @@ class Register(Argument):
     def __eq__(self, other):
         return isinstance(other, Register) and self.register_number == other.register_number
     
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        return self.register_number
+    
     def value(self, sim):
-        return sim.read_register(self.register_number)
+        return sim.registers[self.register_number]
     
     def write(self, sim, value):
         sim.write_register(self.register_number, value)
@@ -60,9 +83,24 @@ class Register(Argument):
         return True
 
 class Immediate(Argument):
-    """ Represents an immediate argument. """
-    def __init__(self, number, base=10):
-        self.number = c_int(int(number, base)).value
+    """ Represents an immediate argument, a signed 32 bit number.  Numbers up to 2^32 - 1 are taken
+    as unsigned words, so 0xffffffff is -1, and bigger ones raise a RuntimeError.  Immediates are
+    shared between arguments written the same way.
+    """
+    __slots__ = ('number',)
+    interned = {}
+
+    def __new__(cls, number, base=10):
+        immediate = cls.interned.get((number, base))
+        if immediate is None:
+            value = int(number, base)
+            if not -0x80000000 <= value <= 0xffffffff:
+                raise RuntimeError("The immediate %d doesn't fit in 32 bits." % value)
+            value &= 0xffffffff
+            immediate = Argument.__new__(cls)
+            object.__setattr__(immediate, 'number', int(value - (1 << 32) if value & 0x80000000 else value))
+            cls.interned[number, base] = immediate
+        return immediate
     
     def __str__(self):
         return 'Integer(%s)' % self.number
@@ -77,10 +115,19 @@ class Immediate(Argument):
         return True
 
 class Offset(Argument):
-    """ Represents an offset argument. """
-    def __init__(self, offset, offset_from):
-        self.offset = Immediate(offset)
-        self.offset_from = parse_arg(offset_from)
+    """ Represents an offset argument.  Offsets are shared like Immediates. """
+    __slots__ = ('offset', 'offset_from')
+    interned = {}
+
+    def __new__(cls, offset, offset_from):
+        key = offset, tuple(offset_from)
+        argument = cls.interned.get(key)
+        if argument is None:
+            argument = Argument.__new__(cls)
+            object.__setattr__(argument, 'offset', Immediate(offset))
+            object.__setattr__(argument, 'offset_from', parse_arg(offset_from))
+            cls.interned[key] = argument
+        return argument
     
     def __str__(self):
         return 'Offset(%s, %s)' % (self.offset, self.offset_from)
@@ -94,9 +141,29 @@ class Offset(Argument):
     def is_offset(self):
         return True
 
+class String(Argument):
+    """ Represents a quoted string argument, which only directives take. """
+    __slots__ = ('text',)
+
+    def __new__(cls, text):
+        argument = Argument.__new__(cls)
+        object.__setattr__(argument, 'text', text)
+        return argument
+    
+    def __str__(self):
+        return 'String(%s)' % self.text
+    
+    def __repr__(self):
+        return '"%s"' % self.text
+    
+    def is_string(self):
+        return True
+
 def parse_arg(arg):
     if len(arg) == 2 and arg[0] == '$':
         return Register(arg[1])
+    elif len(arg) == 2 and arg[0] == '"':
+        return String(arg[1])
     elif len(arg) == 2 and arg[0] == '0x':
         return Immediate(arg[1], base=16)
     elif (len(arg) == 1 and arg[0].isdigit()) or \
@@ -0,0 +1,23 @@
+#!/usr/bin/env python 
+
+""" Assembles a .s file into a program image that main.py can run without parsing it again:
+
+    assembler.py program.s [program.img]
+"""
+
+import os
+import sys
+from array import array
+from instructions import encode_instruction
+import image
+import main
+
+def assemble(filename, output, processes=1, cache=True):
+    """ Assembles the assembly file at filename and writes its image to output. """
+    program = main.load_asm_file(filename, processes, cache)
+    image.write_image(output, array('I', [encode_instruction(inst) for inst in program.text]), program.data)
+
+if __name__ == '__main__':
+    filename = sys.argv[1]
+    output = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(filename)[0] + '.img'
+    assemble(filename, output)
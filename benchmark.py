@@ -0,0 +1,256 @@
+#!/usr/bin/env python 
+
+import os
+import sys
+import time
+import random
+import tempfile
+import StringIO
+import grammar
+import lexer
+import main
+import simulator
+import sampling
+
+REGISTERS = ['$r%d' % x for x in xrange(32)]
+
+def random_instruction(rand):
+	""" Returns one random line of assembly using the syntax the grammar accepts. """
+	reg = lambda: rand.choice(REGISTERS)
+	kind = rand.randint(0, 5)
+	if kind == 0:
+		line = '%s %s, %s, %s' % (rand.choice(['add', 'sub', 'and', 'or', 'nor', 'slt']), reg(), reg(), reg())
+	elif kind == 1:
+		line = '%s %s, %s, %d' % (rand.choice(['addi', 'subi', 'ori', 'slti']), reg(), reg(), rand.randint(-100, 1000))
+	elif kind == 2:
+		line = '%s %s, %s, 0x%x' % (rand.choice(['andi', 'ori']), reg(), reg(), rand.randint(0, 0xffff))
+	elif kind == 3:
+		line = '%s %s, %d(%s)' % (rand.choice(['lw', 'sw']), reg(), rand.randint(0, 64) * 4, reg())
+	elif kind == 4:
+		line = '%s %s, %s, %d' % (rand.choice(['beq', 'bne']), reg(), reg(), rand.randint(-8, 8))
+	else:
+		line = 'j 0x%x' % (0x1000 + rand.randint(0, 256) * 4)
+	
+	if rand.random() < 0.3:
+		line += '\t# comment %d' % rand.randint(0, 1000)
+	return line
+
+def generate_program(lines, seed=0):
+	""" Generates a program with the given number of lines and returns its source. """
+	rand = random.Random(seed)
+	return '\n'.join([random_instruction(rand) for _ in xrange(lines)]) + '\n'
+
+def timed(func, *args, **kwargs):
+	start = time.time()
+	result = func(*args, **kwargs)
+	return time.time() - start, result
+
+def bench_grammar(filename):
+	""" Compares the compiled and the interpreted grammar on the given file. """
+	with open(filename, 'rb') as f:
+		data = f.read()
+	
+	interpreted_time, interpreted = timed(grammar.parse, data, compiled=False)
+	compiled_time, compiled = timed(grammar.parse, data, compiled=True)
+	assert compiled == interpreted
+
+	print 'grammar: interpreted %.03fs, compiled %.03fs (%.01fx)' % (interpreted_time, compiled_time, interpreted_time / compiled_time)
+
+def bench_results(length):
+	""" Times the interpreted grammar on one long line and on a long file, where building the
+	result lists dominates.
+	"""
+	long_comment = 'add $r1, $r2, $r3 # ' + 'x' * length + '\n'
+	long_operands = 'add ' + ', '.join([REGISTERS[i % 32] for i in xrange(length / 4)]) + '\n'
+	long_file = generate_program(length / 4)
+	for name, data in [('long comment', long_comment), ('long operand list', long_operands), ('long file', long_file)]:
+		parse_time, result = timed(grammar.parse, data, compiled=False)
+		assert result is not None
+		print 'results: %s of %d characters %.03fs' % (name, len(data), parse_time)
+
+def bench_tokens(filename):
+	""" Compares the character grammar and the lexer with the token grammar on the given file. """
+	with open(filename, 'rb') as f:
+		data = f.read()
+	
+	lex_time, tokens = timed(lexer.tokenize, data)
+	characters_time, characters = timed(grammar.parse, data, compiled=False)
+	tokens_time, result = timed(grammar.parse_tokens, data)
+	assert result == characters
+	vm_time, result = timed(grammar.parse_tokens, data, backend='vm')
+	assert result == characters
+
+	print 'tokens: %d characters, %d tokens (lexing %.03fs); characters %.03fs, tokens %.03fs (%.01fx), tokens on the vm %.03fs (%.01fx)' % \
+		(len(data), len(tokens), lex_time, characters_time, tokens_time, characters_time / tokens_time, vm_time, characters_time / vm_time)
+
+def bench_backends(filename):
+	""" Compares the combinator and the parsing machine backends on the given file. """
+	with open(filename, 'rb') as f:
+		data = f.read()
+	
+	for compiled in (False, True):
+		combinator_time, combinator = timed(grammar.parse, data, compiled=compiled, backend='combinator')
+		vm_time, vm = timed(grammar.parse, data, compiled=compiled, backend='vm')
+		assert vm == combinator
+
+		print 'backends (%s): combinator %.03fs, vm %.03fs (%.01fx)' % ('compiled' if compiled else 'interpreted', combinator_time, vm_time, combinator_time / vm_time)
+
+def bench_assembly(lines):
+	""" Times turning parsed lines into Instructions, which shares the arguments between them. """
+	rand = random.Random(0)
+	parsed = grammar.parse(''.join([random_instruction(rand) + '\n' for _ in xrange(100)]))
+	parsed = [line for line in parsed if line != []] * (lines / 100)
+	assembly_time, insts = timed(lambda: [main.parse_instruction(name, [main.parse_arg(arg) for arg in args]) for name, args in parsed])
+	print 'assembly: %d instructions %.03fs' % (len(insts), assembly_time)
+
+def bench_streaming(filename, processes=4):
+	""" Times how long the streaming pipeline takes to give the first instruction and all of them,
+	in this process and on a process pool.
+	"""
+	for procs in (1, processes):
+		errors = []
+		start = time.time()
+		insts = main.iter_asm_file(filename, errors, procs)
+		next(insts)
+		first_time = time.time() - start
+		count = 1 + sum(1 for _ in insts)
+		assert not errors
+		print 'streaming (%d processes): first instruction after %.03fs, %d instructions in %.03fs' % (procs, first_time, count, time.time() - start)
+
+LOOP_PROGRAM = '''ori $r1, $r0, %d
+ori $r2, $r0, 1
+ori $r3, $r0, 1
+add $r4, $r2, $r3
+add $r2, $r3, $r0
+add $r3, $r4, $r0
+sw $r4, 0($r0)
+lw $r5, 0($r0)
+subi $r1, $r1, 1
+add $r6, $r5, $r5
+bne $r1, $r0, -8
+'''
+
+COUNTED_LOOP_PROGRAM = '''ori $r1, $r0, %d
+ori $r2, $r0, 0
+ori $r3, $r0, 5
+addi $r2, $r2, 1
+lw $r5, 0($r0)
+add $r4, $r3, $r2
+add $r6, $r4, $r5
+slt $r7, $r2, $r1
+bne $r7, $r0, -6
+'''
+
+def bench_modes(iterations):
+	""" Compares the simulation modes on a loop run the given number of times. """
+	fd, filename = tempfile.mkstemp(suffix='.s')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(LOOP_PROGRAM % iterations)
+		for packed in (False, True):
+			for mode in simulator.MODES:
+				# Running prints the final state, which isn't interesting here.
+				stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+				try:
+					mode_time, sim = timed(main.sim_file, filename, verbose=False, cache=False, packed=packed, mode=mode)
+				finally:
+					sys.stdout = stdout
+				print 'modes (%s memory): %s %d instructions %.03fs (%d instructions/s)' % \
+					('packed' if packed else 'list', mode, sim.instruction_count, mode_time, sim.instruction_count / mode_time)
+	finally:
+		os.remove(filename)
+
+def bench_checkpoints(iterations, runs=10):
+	""" Fast-forwards through half of the loop once and times saving a checkpoint there, and an
+	incremental one an iteration later, and loading the first to carry on with the pipelined
+	simulator from the same point a number of times.
+	"""
+	fd, filename = tempfile.mkstemp(suffix='.s')
+	os.close(fd)
+	fd, path = tempfile.mkstemp(suffix='.ckpt')
+	os.close(fd)
+	try:
+		with open(filename, 'wb') as f:
+			f.write(LOOP_PROGRAM % iterations)
+		program = main.load_asm_file(filename, cache=False)
+		stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+		try:
+			sim = simulator.Simulator(packed=True, mode='functional')
+			sim.load_program(program)
+			forward_time, _ = timed(sim.run, limit=iterations * 8 / 2)
+			save_time, _ = timed(sim.save_checkpoint, path)
+			sim.run(sim.pc, limit=8)
+			incremental_time, _ = timed(sim.save_checkpoint, path + '.1', incremental=True)
+			load_time = 0
+			for _ in xrange(runs):
+				detailed = simulator.Simulator(packed=True)
+				elapsed, _ = timed(detailed.load_checkpoint, path)
+				load_time += elapsed
+				detailed.run(detailed.pc)
+		finally:
+			sys.stdout = stdout
+		print 'checkpoints: fast-forward %.03fs, save %.03fs (%d bytes), incremental save %.03fs (%d bytes), load %.03fs' % \
+			(forward_time, save_time, os.path.getsize(path), incremental_time, os.path.getsize(path + '.1'), load_time / runs)
+	finally:
+		for name in (filename, path, path + '.1'):
+			if os.path.exists(name):
+				os.remove(name)
+
+def bench_sampling(iterations):
+	""" Compares a full pipelined run of the loop with a sampled one. """
+	fd, filename = tempfile.mkstemp(suffix='.s')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(LOOP_PROGRAM % iterations)
+		program = main.load_asm_file(filename, cache=False)
+		full = simulator.Simulator(packed=True)
+		full.load_program(program)
+		full_time, _ = timed(full.run_pipelined, simulator.BASE_MEMORY)
+		sim = simulator.Simulator(packed=True)
+		sim.load_program(program)
+		sampled_time, sample = timed(sampling.run_sampled, sim, window=100, warmup=10, skip=2000)
+		interval = sample.interval()
+		print 'sampling: full %.03fs, sampled %.03fs (%.01fx) with %d windows, CPI %.03f estimated as %.03f +/- %.03f' % \
+			(full_time, sampled_time, full_time / sampled_time, len(sample.windows), full.cpi(), sample.cpi(), interval or 0)
+	finally:
+		os.remove(filename)
+
+def bench_loops(iterations):
+	""" Compares pipelined runs of a counted loop with and without skipping through its steady state. """
+	fd, filename = tempfile.mkstemp(suffix='.s')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(COUNTED_LOOP_PROGRAM % iterations)
+		program = main.load_asm_file(filename, cache=False)
+		sims = []
+		for extrapolate in (False, True):
+			sim = simulator.Simulator(packed=True, extrapolate=extrapolate)
+			sim.load_program(program)
+			run_time, _ = timed(sim.run_pipelined, simulator.BASE_MEMORY)
+			sims.append((run_time, sim))
+		(full_time, full), (skipping_time, skipping) = sims
+		assert (full.registers, full.cycle_count) == (skipping.registers, skipping.cycle_count)
+		print 'loops: %d cycles, full %.03fs, skipping %d iterations %.03fs (%.01fx)' % \
+			(full.cycle_count, full_time, skipping.loops.skipped, skipping_time, full_time / skipping_time)
+	finally:
+		os.remove(filename)
+
+if __name__ == '__main__':
+	lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+	fd, filename = tempfile.mkstemp(suffix='.s')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(generate_program(lines))
+		print 'Benchmarking on a generated %d line program' % lines
+		bench_grammar(filename)
+		bench_backends(filename)
+		bench_tokens(filename)
+		bench_results(lines * 10)
+		bench_streaming(filename)
+		bench_assembly(lines * 100)
+		bench_modes(lines)
+		bench_checkpoints(lines)
+		bench_sampling(lines)
+		bench_loops(lines)
+	finally:
+		os.remove(filename)
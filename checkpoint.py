@@ -0,0 +1,70 @@
+""" The checkpoint format, a simulator saved part way through a run.
+
+A checkpoint is a header, then the simulator's state other than memory (the registers, the PC, the
+counters and the pipeline) marshalled, then pages of memory.  A page is its number followed by its
+little endian 32 bit words.  A full checkpoint has every page of memory that isn't all zero, and an
+incremental one only the pages written since the checkpoint it's relative to, its parent, which it
+names by id.
+"""
+
+import marshal
+import struct
+import sys
+from array import array
+
+MAGIC = 'MCKP'
+VERSION = 2
+
+# magic, version, words in a page, id, parent id (zeros for a full checkpoint), state bytes, pages
+HEADER = struct.Struct('<4sII8s8sII')
+PAGE_NUMBER = struct.Struct('<I')
+
+NO_PARENT = '\0' * 8
+
+def write_checkpoint(path, identity, parent, state, pages, page_words):
+    """ Writes a checkpoint with the given id and parent id, or NO_PARENT.  The state has to be
+    marshallable, and pages is a list of (page number, array of page_words words).
+    """
+    state = marshal.dumps(state)
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, page_words, identity, parent, len(state), len(pages)))
+        f.write(state)
+        for number, words in pages:
+            if sys.byteorder == 'big':
+                words = array('I', words)
+                words.byteswap()
+            f.write(PAGE_NUMBER.pack(number))
+            words.tofile(f)
+
+def read_checkpoint(path, page_words):
+    """ Returns (id, parent id, state, pages) from the checkpoint at path, pages being a list of
+    (page number, array of words), after checking that it's whole and has pages of page_words words.
+    """
+    with open(path, 'rb') as f:
+        buf = f.read()
+    if len(buf) < HEADER.size:
+        raise RuntimeError("Not a checkpoint: it's too short.")
+    magic, version, words, identity, parent, state_size, page_count = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise RuntimeError("Not a checkpoint.")
+    if version != VERSION:
+        raise RuntimeError("Can't read version %d checkpoints." % version)
+    if words != page_words:
+        raise RuntimeError("The checkpoint has pages of %d words, not %d." % (words, page_words))
+    page_size = PAGE_NUMBER.size + page_words * 4
+    if len(buf) != HEADER.size + state_size + page_count * page_size:
+        raise RuntimeError("The checkpoint is truncated.")
+
+    offset = HEADER.size
+    state = marshal.loads(buf[offset:offset + state_size])
+    offset += state_size
+    pages = []
+    for _ in xrange(page_count):
+        number, = PAGE_NUMBER.unpack_from(buf, offset)
+        words = array('I')
+        words.fromstring(buf[offset + PAGE_NUMBER.size:offset + page_size])
+        if sys.byteorder == 'big':
+            words.byteswap()
+        pages.append((number, words))
+        offset += page_size
+    return identity, parent, state, pages
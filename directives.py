@@ -0,0 +1,135 @@
+import os
+import sys
+from array import array
+from arguments import *
+
+# ---------------------------------------------------------------------------- #
+# The Assembled Program                                                        #
+# ---------------------------------------------------------------------------- #
+class Program(object):
+    """ An assembled program: the Instructions of the text segment, and the data segment as a list
+    of (address, array of words) pieces in the order they were given.
+    """
+    def __init__(self, directory=''):
+        """ directory=str
+
+        Paths in .incbin directives are relative to directory.
+        """
+        self.directory = directory
+        self.text = []
+        self.data = []
+        self.in_data = False
+        self.data_addr = 0
+    
+    def add_instruction(self, instruction):
+        if self.in_data:
+            raise RuntimeError("%s is in the data segment.  Use .text before instructions." % instruction)
+        self.text.append(instruction)
+    
+    def add_data(self, words):
+        """ Adds the array of words to the data segment at the current data address. """
+        if not self.in_data:
+            raise RuntimeError("Data has to be in the data segment.  Use .data before it.")
+        self.data.append((self.data_addr, words))
+        self.data_addr += len(words) << 2
+
+# ---------------------------------------------------------------------------- #
+# The Directives                                                               #
+# ---------------------------------------------------------------------------- #
+# .data [address], .text
+# .word, .space, .incbin
+
+class Directive(object):
+    def apply(self, program):
+        raise RuntimeError
+    
+    def name(self):
+        return self.__class__.__name__.lower()
+    
+    def __repr__(self):
+        return str(self)
+
+class Data(Directive):
+    """ Switches to the data segment, which starts at address 0 unless an address is given. """
+    def __init__(self, address=None):
+        assert address is None or address.is_immediate()
+        if address is not None and address.number & 0x3 != 0:
+            raise RuntimeError("The data segment can't start at the non-word boundary %s." % address)
+        self.address = address
+    
+    def apply(self, program):
+        program.in_data = True
+        if self.address is not None:
+            program.data_addr = self.address.number
+    
+    def __str__(self):
+        return '.data' if self.address is None else '.data %s' % self.address
+
+class Text(Directive):
+    """ Switches back to the text segment. """
+    def apply(self, program):
+        program.in_data = False
+    
+    def __str__(self):
+        return '.text'
+
+class Word(Directive):
+    """ Puts each of its immediates in a word. """
+    def __init__(self, *values):
+        assert values and all(value.is_immediate() for value in values)
+        self.values = values
+    
+    def apply(self, program):
+        program.add_data(array('I', [value.number & 0xffffffff for value in self.values]))
+    
+    def __str__(self):
+        return '.word %s' % ', '.join([repr(value) for value in self.values])
+
+class Space(Directive):
+    """ Leaves the given number of bytes zero'd, rounded up to whole words. """
+    def __init__(self, size):
+        assert size.is_immediate()
+        if size.number < 0:
+            raise RuntimeError("Can't leave %s bytes of space." % size)
+        self.size = size
+    
+    def apply(self, program):
+        program.add_data(array('I', [0]) * ((self.size.number + 3) >> 2))
+    
+    def __str__(self):
+        return '.space %s' % self.size
+
+class IncBin(Directive):
+    """ Puts the contents of a file in the data segment as little endian words, padded with zeros
+    to a whole word.
+    """
+    def __init__(self, path):
+        assert path.is_string()
+        self.path = path
+    
+    def apply(self, program):
+        with open(os.path.join(program.directory, self.path.text), 'rb') as f:
+            contents = f.read()
+        words = array('I')
+        words.fromstring(contents + '\0' * (-len(contents) % 4))
+        if sys.byteorder == 'big':
+            words.byteswap()
+        program.add_data(words)
+    
+    def __str__(self):
+        return '.incbin %r' % self.path
+
+supported_directives = {
+    '.data':   Data,
+    '.text':   Text,
+    '.word':   Word,
+    '.space':  Space,
+    '.incbin': IncBin,
+}
+
+def parse_directive(directive_name, args):
+    directive_name = directive_name.lower()
+    if directive_name not in supported_directives:
+        raise RuntimeError("The %s directive is unsupported at this time." % directive_name)
+    
+    return supported_directives[directive_name](*args)
@@ -1,5 +1,8 @@
+import re
 import parser
 from parser import *
+import pegvm
+import lexer
 
 def enable_debug():
 	myparser.DEBUG_DEFAULT = True
@@ -7,6 +10,16 @@ def enable_debug():
 def joiner(l):
 	return ''.join(l)
 
+def token_text(token):
+	return token.text
+
+def token_number(token):
+	return ['-', token.text[1:]] if token.text[0] == '-' else [token.text]
+
+def with_arguments(l):
+	""" Gives a directive without arguments an empty argument list, like an instruction's. """
+	return l if len(l) == 2 else l + [[]]
+
 chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
 digits = '0123456789'
 hex_digits = digits + 'abcdefABCDEF'
@@ -21,26 +34,120 @@ address = hex_number.name('address').nameonly()
 offset = (number + whitespace.optional() + atom('(').hide() + (register | address) + atom(')').hide()).combine()
 
 instruction_delimiter = whitespace.optional() + atom(',').hide() + whitespace.optional()
-instruction_start = (whitespace.optional() + Word(chars + digits).name('instruction-name').nameonly() + whitespace).combine()
-instruction = LinearMatch(instruction_start, DelimitedMatch((register | offset | hex_number | address | number).combine(), whitespace.optional() + atom(',') + whitespace.optional())).combine()
+instruction_start = (whitespace.optional() + Word(chars + digits).name('instruction-name').nameonly() + whitespace).combine().name('instruction').nameonly()
+operand = (register | offset | hex_number | address | number).combine().name('operand').nameonly()
+operand_delimiter = (whitespace.optional() + atom(',') + whitespace.optional()).name("','").nameonly()
+instruction = LinearMatch(instruction_start, DelimitedMatch(operand, operand_delimiter)).combine()
 
 r_instruction = register + instruction_delimiter + register + instruction_delimiter + register
 i_instruction = register + instruction_delimiter + register + instruction_delimiter + (number | hex_number)
 j_instruction = address
 
+string = LinearMatch(atom('"'), StarMatch(NotMatch(orstring('"' + newlines))).postprocess(joiner), atom('"').hide()).combine().name('string').nameonly()
+directive_name = LinearMatch(atom('.'), Word(chars)).postprocess(joiner).name('directive-name').nameonly()
+directive_arguments = LinearMatch(whitespace, DelimitedMatch((string | hex_number | number).combine(), operand_delimiter)).combine()
+directive = LinearMatch(whitespace.optional(), directive_name, directive_arguments.optional()).postprocess(with_arguments).combine()
+
 comment = LinearMatch(OrMatch(atom(';'), atom('#')), StarMatch(NotMatch(orstring(newlines))))
 end_of_instruction = LinearMatch(whitespace.optional(), comment.optional(), StarMatch(orstring(newlines), min=1)).combine()
 #end_of_instruction = LinearMatch(comment.optional(), StarMatch(orstring(newlines), min=1)).combine()
 
 #instructions = (DelimitedMatch(instruction, end_of_instruction).combine() + StarMatch(orstring('\n\t\r ')).hide()).combine()
-line = LinearMatch(instruction.optional(), Word(spaces).hide().optional(), comment.optional().hide()).combine()
-instructions = DelimitedMatch(line, orstring(newlines)).combine()
+line = LinearMatch((instruction | directive).combine().optional(), Word(spaces).hide().optional(), comment.optional().hide()).combine()
+line_delimiter = orstring(newlines).name('newline').nameonly()
+instructions = DelimitedMatch(line, line_delimiter).combine()
+
+# The same grammar with its character-level rules lowered to regular expressions.
+compiled_instructions = compile_grammar(instructions)
+
+# The same grammar over the tokens from lexer.tokenize.  Every rule gives the same result as its
+# character counterpart above.
+token_whitespace = StarMatch(TypeMatch(lexer.Space, lexer.Newline), min=1).hide()
+token_hex_number = TypeMatch(lexer.HexNumber).postprocess(lambda token: ['0x', token.text[2:]]).combine()
+token_number = TypeMatch(lexer.Number, lexer.NegativeNumber).postprocess(token_number).combine().name('number').nameonly()
+token_register = TypeMatch(lexer.Register).postprocess(lambda token: ['$', token.text[1:]]).combine().name('register').nameonly()
+token_address = token_hex_number.name('address').nameonly()
+token_offset = (token_number + token_whitespace.optional() + TypeMatch(lexer.OpenParen).hide() + (token_register | token_address) + TypeMatch(lexer.CloseParen).hide()).combine()
+
+token_instruction_name = TypeMatch(lexer.Mnemonic, lexer.Number, lexer.HexNumber).postprocess(token_text).name('instruction-name').nameonly()
+token_instruction_start = (token_whitespace.optional() + token_instruction_name + token_whitespace).combine()
+token_instruction = LinearMatch(token_instruction_start, DelimitedMatch((token_register | token_offset | token_hex_number | token_address | token_number).combine(), token_whitespace.optional() + TypeMatch(lexer.Comma) + token_whitespace.optional())).combine()
+
+token_string = TypeMatch(lexer.String).postprocess(lambda token: ['"', token.text[1:-1]]).combine()
+token_directive_arguments = LinearMatch(token_whitespace, DelimitedMatch((token_string | token_hex_number | token_number).combine(), token_whitespace.optional() + TypeMatch(lexer.Comma) + token_whitespace.optional())).combine()
+token_directive = LinearMatch(token_whitespace.optional(), TypeMatch(lexer.Directive).postprocess(token_text), token_directive_arguments.optional()).postprocess(with_arguments).combine()
+
+token_line = LinearMatch((token_instruction | token_directive).combine().optional(), TypeMatch(lexer.Space).hide().optional(), TypeMatch(lexer.Comment).optional().hide()).combine()
+token_instructions = DelimitedMatch(token_line, TypeMatch(lexer.Newline)).combine()
+
+# Frozen copies, which parse() shares between calls and threads without copying them.
+frozen_instructions = freeze(instructions)
+frozen_compiled_instructions = freeze(compiled_instructions)
+frozen_token_instructions = freeze(token_instructions)
+
+# The same grammar, but a bad line is recorded and skipped up to the next newline, so one pass
+# finds every syntax error.
+recovering_instructions = freeze(DelimitedMatch(line, line_delimiter, recover=newlines).combine(), compiled=True)
+
+instructions_program = pegvm.compile(frozen_instructions.root)
+compiled_program = pegvm.compile(frozen_compiled_instructions.root)
+token_program = pegvm.compile(frozen_token_instructions.root)
+
+# Bump when the result of a parse changes, so cached parses aren't used.
+GRAMMAR_VERSION = 2
+
+# 'combinator' runs the MatchObject tree itself, 'vm' runs it compiled for the parsing machine.
+BACKEND = 'combinator'
+
+def parse(insts, packrat=True, compiled=True, backend=None):
+	if (backend or BACKEND) == 'vm':
+		return (compiled_program if compiled else instructions_program).parse(insts)
+	rule = frozen_compiled_instructions if compiled else frozen_instructions
+	return rule.parse(insts, packrat=packrat)
+
+def parse_tokens(insts, packrat=True, backend=None):
+	""" Like parse, but runs the lexer first and matches the token grammar. """
+	tokens = lexer.tokenize(insts)
+	if (backend or BACKEND) == 'vm':
+		return token_program.parse(tokens)
+	return frozen_token_instructions.parse(tokens, packrat=packrat)
 
-def parse(insts):
-	return totalMatch(insts, instructions)
+def parse_with_errors(insts, packrat=True):
+	""" Returns (parsed instructions, list of parser.ParseError).  The instructions are None if there
+	are any errors.
+	"""
+	return recovering_instructions.parse_with_errors(insts, packrat=packrat)
 
-def raw_parse(insts):
-	return instructions.match(insts)
+def iter_parse(insts, packrat=True, errors=None):
+	""" Yields the parsed lines one at a time, the same ones parse returns as a list.  Syntax errors
+	are recorded and skipped like in parse_with_errors, and added to errors at the end.
+	"""
+	return recovering_instructions.iter_parse(insts, packrat=packrat, errors=errors)
+
+# Whitespace inside an instruction can run over newlines, but a line that starts with a letter can
+# only start an instruction, so the source can be cut before one and the parts parsed separately.
+LINE_START = re.compile(r'[\n\r](?=[ \t]*[A-Za-z])')
+
+def split_lines(insts, size):
+	""" Returns (start, end) offsets cutting insts into parts of roughly size characters that
+	iter_parse gives the same instructions for as for the whole.
+	"""
+	parts = []
+	start = 0
+	while len(insts) - start > size:
+		m = LINE_START.search(insts, start + size)
+		if m is None:
+			break
+		parts.append((start, m.end()))
+		start = m.end()
+	parts.append((start, len(insts)))
+	return parts
+
+def raw_parse(insts, packrat=True, compiled=True, backend=None):
+	if (backend or BACKEND) == 'vm':
+		return (compiled_program if compiled else instructions_program).match(insts)
+	rule = frozen_compiled_instructions if compiled else frozen_instructions
+	return rule.match(insts, packrat=packrat)
 
 if __name__ == '__main__':
 	import unittest
@@ -50,5 +157,102 @@ if __name__ == '__main__':
 			self.assertEquals(totalMatch("""ori $r1, $r0, 1 #test
 addi $r2, $r0, 2""", instructions), [['ori', [['$', 'r1'], ['$', 'r0'], ['1']]],
  									 ['addi', [['$', 'r2'], ['$', 'r0'], ['2']]]])
+
+		def test_directives(self):
+			source = """.data 0x100
+.word 1, -2, 0x10 # words
+ .space 8
+.incbin "data.bin"
+.text
+ori $r1, $r0, 1"""
+			self.assertEquals(parse(source), [['.data', [['0x', '100']]], ['.word', [['1'], ['-', '2'], ['0x', '10']]], ['.space', [['8']]],
+				['.incbin', [['"', 'data.bin']]], ['.text', []], ['ori', [['$', 'r1'], ['$', 'r0'], ['1']]]])
+			self.assertEquals(parse(source, compiled=False), parse(source))
+			self.assertEquals(parse(source, backend='vm'), parse(source))
+			self.assertEquals(parse_tokens(source), parse(source))
+			self.assertEquals(parse('.word 1 2'), None)
+
+		def test_compiled(self):
+			source = """  ori $r1, $r0, 0x1f
+lw $r2, -4($r7) ; load
+sw $r2, 8 ($r7)
+
+j 0x1000 # jump
+"""
+			self.assertEquals(parse(source, compiled=True), parse(source, compiled=False))
+			self.assertEquals(raw_parse('ori $r1 $r0, 1', compiled=True)[1], raw_parse('ori $r1 $r0, 1', compiled=False)[1])
+
+		def test_tokens(self):
+			source = """  ori $r1, $r0, 0x1f
+lw $r2, -4($r7) ; load
+sw $r2, 8 ($r7)
+
+j 0x1000 # jump
+"""
+			self.assertEquals(parse_tokens(source), parse(source))
+			self.assertEquals(parse_tokens(source, backend='vm'), parse(source))
+			self.assertEquals(parse_tokens('add$r1, $r2, $r3'), None)
+			self.assertEquals(lexer.tokenize('lw $r1, -4(0x10)'), [lexer.Mnemonic('lw', 0), lexer.Space(' ', 0), lexer.Register('$r1', 0),
+				lexer.Comma(', ', 0), lexer.NegativeNumber('-4', 0), lexer.OpenParen('(', 0), lexer.HexNumber('0x10', 0),
+				lexer.CloseParen(')', 0)])
+
+		def test_frozen(self):
+			import threading
+			self.assertRaises(RuntimeError, frozen_instructions.root.set_option, 'hide', True)
+			self.assertRaises(RuntimeError, frozen_instructions.root.item.items[0].add_item, atom('x'))
+			self.assertEquals(frozen_instructions.root.optional().options['optional'], True)
+
+			source = '\n'.join(['ori $r%d, $r0, %d # line %d' % (i % 32, i, i) for i in range(200)])
+			expected = parse(source)
+			results = []
+			def worker(compiled):
+				for i in range(5):
+					results.append(parse(source, compiled=compiled) == expected)
+			threads = [threading.Thread(target=worker, args=(i % 2 == 0,)) for i in range(8)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			self.assertEquals(results, [True] * 40)
+
+		def test_errors(self):
+			source = 'ori $r1, $r0, 1\nadd $r1 $r2, $r3\nsw $r1, 4($r2)\nadd $r1, $r2, @\n'
+			result, errors = parse_with_errors(source)
+			self.assertEquals(result, None)
+			self.assertEquals([(e.pos, e.expected) for e in errors], [(24, ['newline']), (62, ['operand'])])
+			self.assertEquals(parse_with_errors(source[:16]), (parse(source[:16]), []))
+
+		def test_iter_parse(self):
+			source = 'ori $r1, $r0, 1\nadd\n$r1, $r2, $r3\n  \n  sw $r1, 4\n($r2)\nj 0x1000\n'
+			self.assertEquals([l for l in iter_parse(source) if l != []], [l for l in parse(source) if l != []])
+			for size in range(1, len(source)):
+				lines = []
+				for start, end in split_lines(source, size):
+					lines.extend(iter_parse(source[start:end]))
+				self.assertEquals([l for l in lines if l != []], [l for l in parse(source) if l != []])
+			
+			errors = []
+			source = 'ori $r1, $r0, 1\nadd $r1 $r2, $r3\nsw $r1, 4($r2)\nadd $r1, $r2, @\n'
+			self.assertEquals(len(list(iter_parse(source, errors=errors))), 3)
+			self.assertEquals([(e.pos, e.expected) for e in errors], [(e.pos, e.expected) for e in parse_with_errors(source)[1]])
+			self.assertRaises(RuntimeError, list, iter_parse(source))
+
+		def test_vm(self):
+			source = """ori $r1, $r0, 0x1f
+lw $r2, -4($r7) ; load
+
+j 0x1000 # jump"""
+			for compiled in (True, False):
+				self.assertEquals(parse(source, compiled=compiled, backend='vm'), parse(source, compiled=False))
+				self.assertEquals(raw_parse('ori $r1 $r0, 1', compiled=compiled, backend='vm')[1], raw_parse('ori $r1 $r0, 1')[1])
+ 	
+		def test_vm_postprocess(self):
+			def fail(item):
+				raise RuntimeError('The postprocess ran.')
+			# The first alternative matches its 'a' before it's abandoned.
+			match = OrMatch(LinearMatch(atom('a').postprocess(fail), atom('x')), LinearMatch(atom('a'), atom('b')))
+			self.assertRaises(RuntimeError, totalMatch, 'ab', match)
+			self.assertRaises(RuntimeError, pegvm.compile(match).parse, 'ab')
+			self.assertEquals(pegvm.compile(match, lazy=True).parse('ab'), [[['a', 'b']]])
  	
  	unittest.main()
\ No newline at end of file
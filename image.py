@@ -0,0 +1,52 @@
+""" The program image format, an assembled program saved as the memory it's loaded into.
+
+An image is a header followed by little endian 32 bit words, one for every word of memory from
+address 0 up to the end of the text segment or of the data, whichever is later.  The text segment
+starts at text_base, and memory no data was given for is zero.  Since the words are laid out the
+same way as in memory, an image can be mapped and used as memory without reading it in.
+"""
+
+import struct
+import sys
+from array import array
+
+MAGIC = 'MIPS'
+VERSION = 2
+
+# magic, version, text_base, text words, memory words
+HEADER = struct.Struct('<4sIIII')
+
+def write_image(path, text, data=(), text_base=0x1000):
+    """ Writes an image with the array of encoded instructions text at text_base, and data, a list
+    of (address, array of words) pieces like directives.Program.data.
+    """
+    text_start, text_end = text_base >> 2, (text_base >> 2) + len(text)
+    memory_words = max([text_end] + [(addr >> 2) + len(piece) for addr, piece in data])
+    words = array('I', [0]) * memory_words
+    words[text_start:text_end] = text
+    for addr, piece in data:
+        start = addr >> 2
+        if start < text_end and start + len(piece) > text_start:
+            raise RuntimeError("The data at 0x%x overlaps the text segment." % addr)
+        words[start:start + len(piece)] = piece
+    if sys.byteorder == 'big':
+        words.byteswap()
+    
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, text_base, len(text), memory_words))
+        words.tofile(f)
+
+def read_header(buf):
+    """ Returns (text_base, text words, memory words) from the header at the start of buf, after
+    checking that buf holds a whole image.
+    """
+    if len(buf) < HEADER.size:
+        raise RuntimeError("Not a program image: it's too short.")
+    magic, version, text_base, text_words, memory_words = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise RuntimeError("Not a program image.")
+    if version != VERSION:
+        raise RuntimeError("Can't read version %d program images." % version)
+    if len(buf) != HEADER.size + memory_words * 4 or memory_words < (text_base >> 2) + text_words:
+        raise RuntimeError("The program image is truncated.")
+    return text_base, text_words, memory_words
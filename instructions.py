@@ -8,110 +8,26 @@ from arguments import *
 # beq, bne, j, jr
 # lw, sw
 
-def init_forwarding(func):
-    def wrapper(self, *args, **kwargs):
-        self.forwarded = {}
-        return func(self, *args, **kwargs)
-    return wrapper
-
-def x_to_x(func):
-    def wrapper(self, sim, *args, **kwargs):
-        if sim.verbose: 'X->X %s' % self
-        if sim.results['memory'] is not None:
-            n_min1_stage = sim.stages[sim.stages.index('execute') - 1]
-
-            dest_register, dest_value = sim.results['memory']
-            if sim.verbose:  'X->X Checking forwarding'
-
-            if dest_register.is_register() and \
-               dest_register.register_number != 0 and \
-               dest_register in self.source() and \
-               dest_register not in self.forwarded:
-                if sim.verbose:  'X->X Forwarding enabled for %s' % self
-                self.forwarded[dest_register] = dest_value
-                #self.forwarded = sim.results['execute']
-        return func(self, sim, *args, **kwargs)
-    wrapper.__name__ = 'x-to-x-wrapper'
-    return wrapper
-
-def m_to_x(func):
-    def wrapper(self, sim, *args, **kwargs):
-        if sim.results['write'] is not None:
-            if sim.verbose:  'Checking M->X'
-            #n_min2_stage = sim.stages[sim.stages.index('execute') + 2]
-
-            dest_register, dest_value = sim.results['write']
-
-            if dest_register.is_register() and \
-               dest_register.register_number != 0 and \
-               dest_register in self.source() and \
-               dest_register not in self.forwarded:
-                if sim.verbose:  'M->X Forwarding enabled for %s' % self
-                #self.forwarded = sim.results['memory']
-                self.forwarded[dest_register] = dest_value
-            if sim.verbose:  self.forwarded
-            
-        return func(self, sim, *args, **kwargs)
-    return wrapper
-
-def m_to_m(func):
-    def wrapper(self, sim, *args, **kwargs):
-        if sim.results['write'] is not None:
-            if sim.verbose:  'Checking M->M'
-            n_min1_stage = sim.stages[sim.stages.index('memory') + 1]
-
-            dest_register, dest_value = sim.results['write']
-
-            if dest_register.is_register() and \
-               dest_register.register_number != 0 and \
-               dest_register in self.source() and \
-               isinstance(sim.pipeline[n_min1_stage], LW):
-                if sim.verbose:  'M->M Forwarding enabled for %s' % self
-                #self.forwarded = sim.results['memory']
-                self.forwarded[dest_register] = dest_value
-            if sim.verbose:  self.forwarded
-            
-        return func(self, sim, *args, **kwargs)
-    return wrapper
-
-def accept_forwarding(func):
-    def wrapper(self, sim, *args, **kwargs):
-        for stage in sim.stages[sim.stages.index(sim.current_stage) + 1:-1]:
-            instruction = sim.pipeline[stage]
-            if instruction is None: continue
-            if instruction.destination() in self.source() and instruction.destination() not in self.forwarded:
-                if sim.verbose:  'STALLING!'
-                sim.stall(sim.current_stage)
-                return None
-
-
-        if sim.verbose:  '%s accepting forwarding' % self
-        if hasattr(self, 'forwarded') and self.forwarded is not None:
-            old_values = {}
-            if sim.verbose:  self.forwarded
-            for forwarded_register in self.forwarded:
-                for source in self.source():
-                    if sim.verbose:  source, forwarded_register
-                    if source == forwarded_register:
-                        old_values[source] = source.value
-                        source.value = lambda sim, forwarded_register=forwarded_register: self.forwarded[forwarded_register]
-                        if sim.verbose:  'Rewriting register %s to return %d' % (source, self.forwarded[forwarded_register])
-                        #break
-            
-            return_value = func(self, sim, *args, **kwargs)
-            
-            for source in old_values:
-                source.value = old_values[source]
-            
-            return return_value
-        
-        return func(self, sim, *args, **kwargs)
-    return wrapper
-
-def forwarding(func):
-    return init_forwarding(x_to_x(m_to_x(accept_forwarding(func))))
+# The simulator decides where an instruction's source registers come from before it executes, by
+# looking at the results waiting in the pipeline (see Simulator.forward), and puts the values
+# forwarded to it in forwarded, by register.  To keep that cheap, every instruction works out the
+# numbers of the registers it reads and writes once, when it's created.
+
+# The pipeline stages, as indexes into Simulator.latches.
+FETCH, DECODE, EXECUTE, MEMORY, WRITE = range(5)
+
+# Register numbers read by an instruction, shared between instructions that read the same ones.
+interned_reads = {}
 
 class Instruction(object):
+    __slots__ = ('forwarded', '_result', 'reads', 'writes')
+    # Whether the instruction takes forwarded values in the execute stage, whether it stalls there
+    # while a value it needs is still being loaded, and whether it takes a just loaded value in the
+    # memory stage.
+    forwarding = True
+    stalls = True
+    forwards_loads = False
+
     def fetch(self, sim):
         pass
     
@@ -125,10 +41,8 @@ class Instruction(object):
         pass
     
     def write(self, sim):
-        if self.destination() is not None:
-            if sim.verbose:  'result:', self.result()
-            dest_register, value = self.result()
-            dest_register.write(sim, value)
+        if self.writes is not None:
+            sim.write_register(self.writes, self._result[1])
     
     def source(self):
         raise RuntimeError
@@ -136,14 +50,43 @@ class Instruction(object):
     def destination(self):
         raise RuntimeError
     
-    def put_result(self, sim, result, stage='execute'):
+    def init_registers(self):
+        """ Sets reads and writes to the numbers of the registers in source() and destination(). """
+        reads = tuple(source.register_number for source in self.source() if source.is_register())
+        self.reads = interned_reads.setdefault(reads, reads)
+        destination = self.destination()
+        self.writes = destination.register_number if destination is not None else None
+    
+    def read(self, sim, source):
+        """ Returns the value of one of the source() arguments, or the value forwarded to it. """
+        forwarded = self.forwarded
+        if forwarded and source in forwarded:
+            return forwarded[source]
+        return source.value(sim)
+    
+    def put_result(self, sim, result, stage=EXECUTE):
         if sim.verbose:  'Putting result,', result
         self._result = self.destination(), result
-        sim.results[stage] = self.result()
+        sim.latches[stage].result = self._result
     
     def name(self):
         return self.__class__.__name__
     
+    def fields(self):
+        """ Returns the values of the fields in format that this instruction sets. """
+        raise RuntimeError("%s can't be encoded." % self.name())
+    
+    def encode(self):
+        """ Returns this instruction as a 32 bit word.  Fields missing from fields() are 0. """
+        fields = self.fields()
+        word = 0
+        for field, size in self.format:
+            value = fields.get(field, 0)
+            if not 0 <= value < 1 << size:
+                raise RuntimeError("%s doesn't fit in the %d bit %s field of %s." % (value, size, field, self))
+            word = word << size | value
+        return word
+    
     def result(self):
         if hasattr(self, '_result'):
             return self._result
@@ -152,7 +95,24 @@ class Instruction(object):
     def __repr__(self):
         return str(self)
 
+def encode_immediate(value, size, signed):
+    """ Returns value as a size bit field, two's complement if signed. """
+    low, high = (-(1 << size - 1), 1 << size - 1) if signed else (0, 1 << size)
+    if not low <= value < high:
+        raise RuntimeError("The immediate %d doesn't fit in %d bits." % (value, size))
+    return value & ((1 << size) - 1)
+
+def decode_immediate(value, size, signed):
+    if signed and value & (1 << size - 1):
+        return value - (1 << size)
+    return value
+
+def decode_register(number):
+    return Register('r%d' % number)
+
 class RType(Instruction):
+    __slots__ = ('rd', 'rs', 'rt')
+    opcode = 0
     format = [
         ('opcode', 6),
         ('rs', 5),
@@ -166,11 +126,11 @@ class RType(Instruction):
         assert rd.is_register()
         assert rs.is_register()
         assert rt.is_register()
-        self.opcode = 0
         self.rd = rd
         self.rs = rs
         self.rt = rt
         self._result = None
+        self.init_registers()
     
     def source(self):
         return self.rs, self.rt
@@ -181,48 +141,67 @@ class RType(Instruction):
     def result(self):
         return self._result
     
+    def fields(self):
+        return {'opcode': self.opcode, 'rs': self.rs.register_number, 'rt': self.rt.register_number,
+                'rd': self.rd.register_number, 'function': self.function}
+    
+    @classmethod
+    def from_fields(cls, fields):
+        return cls(decode_register(fields['rd']), decode_register(fields['rs']), decode_register(fields['rt']))
+    
     def __str__(self):
         return '%s %s, %s, %s' % (self.name(), self.rd, self.rs, self.rt)
 
 class Add(RType):
-    def encode(self):
-        out = 0
-        for piece, size in format:
-            pass
+    __slots__ = ()
+    function = 0x20
 
-    @forwarding
     def execute(self, sim):
-        self.put_result(sim, self.rs.value(sim) + self.rt.value(sim))
+        self.put_result(sim, self.read(sim, self.rs) + self.read(sim, self.rt))
 
 class Sub(RType):
-    @forwarding
+    __slots__ = ()
+    function = 0x22
+
     def execute(self, sim):
-        self.put_result(sim, self.rs.value(sim) - self.rt.value(sim))
+        self.put_result(sim, self.read(sim, self.rs) - self.read(sim, self.rt))
 
 class And(RType):
-    @forwarding
+    __slots__ = ()
+    function = 0x24
+
     def execute(self, sim):
-        self.put_result(sim, self.rs.value(sim) & self.rt.value(sim))
+        self.put_result(sim, self.read(sim, self.rs) & self.read(sim, self.rt))
 
 class Or(RType):
-    @forwarding
+    __slots__ = ()
+    function = 0x25
+
     def execute(self, sim):
-        self.put_result(sim, self.rs.value(sim) | self.rt.value(sim))
+        self.put_result(sim, self.read(sim, self.rs) | self.read(sim, self.rt))
 
 class Nor(RType):
-    @forwarding
+    __slots__ = ()
+    function = 0x27
+
     def execute(self, sim):
-        self.put_result(sim, ~(self.rs.value(sim) | self.rt.value(sim)))
+        self.put_result(sim, ~(self.read(sim, self.rs) | self.read(sim, self.rt)))
 
 class Slt(RType):
-    @forwarding
+    __slots__ = ()
+    function = 0x2a
+
     def execute(self, sim):
-        self.put_result(sim, int(self.rs.value(sim) < self.rt.value(sim)))
+        self.put_result(sim, int(self.read(sim, self.rs) < self.read(sim, self.rt)))
 
 class JR(RType):
+    __slots__ = ()
+    function = 0x08
+
     def __init__(self, rt):
         assert rt.is_register()
         self.rt = rt
+        self.init_registers()
     
     def source(self):
         return (self.rt,)
@@ -230,16 +209,33 @@ class JR(RType):
     def destination(self):
         return None
     
-    @forwarding
+    def fields(self):
+        # The register goes in the rs field, like the real jr.
+        return {'opcode': self.opcode, 'rs': self.rt.register_number, 'function': self.function}
+    
+    @classmethod
+    def from_fields(cls, fields):
+        return cls(decode_register(fields['rs']))
+    
     def execute(self, sim):
-        sim.jump_to(self.rt.value(sim))
-        sim.flush_before('execute')
+        sim.jump_to(self.read(sim, self.rt))
+        sim.flush_before(EXECUTE)
     
     def __str__(self):
         return '%s %s' % (self.name(), self.rt)
 
 
 class IType(Instruction):
+    __slots__ = ('rt', 'rs', 'immediate')
+    format = [
+        ('opcode', 6),
+        ('rs', 5),
+        ('rt', 5),
+        ('immediate', 16)
+    ]
+    # The immediate is sign extended, except for the logical instructions.
+    signed = True
+
     def __init__(self, rt, rs, immediate):
         assert rt.is_register()
         assert rs.is_register()
@@ -249,6 +245,7 @@ class IType(Instruction):
         self.rs = rs
         self.immediate = immediate
         self._result = None
+        self.init_registers()
     
     def source(self):
         return self.rs, self.immediate
@@ -256,40 +253,64 @@ class IType(Instruction):
     def destination(self):
         return self.rt
     
+    def fields(self):
+        return {'opcode': self.opcode, 'rs': self.rs.register_number, 'rt': self.rt.register_number,
+                'immediate': encode_immediate(self.immediate.number, 16, self.signed)}
+    
+    @classmethod
+    def from_fields(cls, fields):
+        immediate = decode_immediate(fields['immediate'], 16, cls.signed)
+        return cls(decode_register(fields['rt']), decode_register(fields['rs']), Immediate(str(immediate)))
+    
     def __str__(self):
         return '%s %s, %s, %s' % (self.name(), self.rt, self.rs, self.immediate)
 
 class AddI(IType):
-    @forwarding
+    __slots__ = ()
+    opcode = 0x08
+
     def execute(self, sim):
-        self.put_result(sim, self.rs.value(sim) + self.immediate.value(sim))
+        self.put_result(sim, self.read(sim, self.rs) + self.immediate.value(sim))
 
 class SubI(IType):
-    @forwarding
+    __slots__ = ()
+    # subi isn't a real MIPS instruction, so it gets an opcode MIPS32 leaves unused.
+    opcode = 0x18
+
     def execute(self, sim):
-        self.put_result(sim, self.rs.value(sim) - self.immediate.value(sim))
+        self.put_result(sim, self.read(sim, self.rs) - self.immediate.value(sim))
 
 class AndI(IType):
-    @forwarding
+    __slots__ = ()
+    opcode = 0x0c
+    signed = False
+
     def execute(self, sim):
-        self.put_result(sim, self.rs.value(sim) + self.immediate.value(sim))
+        self.put_result(sim, self.read(sim, self.rs) + self.immediate.value(sim))
 
 class OrI(IType):
-    @forwarding
+    __slots__ = ()
+    opcode = 0x0d
+    signed = False
+
     def execute(self, sim):
-        self.put_result(sim, self.rs.value(sim) + self.immediate.value(sim))
+        self.put_result(sim, self.read(sim, self.rs) + self.immediate.value(sim))
 
 class SltI(IType):
-    @forwarding
+    __slots__ = ()
+    opcode = 0x0a
+
     def execute(self, sim):
-        self.put_result(sim, self.rs.value(sim) + self.immediate.value(sim))
+        self.put_result(sim, self.read(sim, self.rs) + self.immediate.value(sim))
 
 class Beq(IType):
-    @forwarding
+    __slots__ = ()
+    opcode = 0x04
+
     def execute(self, sim):
-        if self.rs.value(sim) == self.rt.value(sim):
+        if self.read(sim, self.rs) == self.read(sim, self.rt):
             sim.jump_relative_to(self.immediate.value(sim) << 2)
-            sim.flush_before('execute')
+            sim.flush_before(EXECUTE)
 
     def destination(self):
         return None
@@ -298,11 +319,13 @@ class Beq(IType):
         return self.rs, self.rt
 
 class Bne(IType):
-    @forwarding
+    __slots__ = ()
+    opcode = 0x05
+
     def execute(self, sim):
-        if self.rs.value(sim) != self.rt.value(sim):
+        if self.read(sim, self.rs) != self.read(sim, self.rt):
             sim.jump_relative_to(self.immediate.value(sim) << 2)
-            sim.flush_before('execute')
+            sim.flush_before(EXECUTE)
 
     def destination(self):
         return None
@@ -311,59 +334,89 @@ class Bne(IType):
         return self.rs, self.rt
 
 class MemIType(IType):
+    __slots__ = ('offset',)
+    # Loads and stores only use their registers in the memory stage, and never stall for them.
+    stalls = False
+
     def __init__(self, rt, offset):
         assert rt.is_register()
         assert offset.is_offset()
         self.rt = rt
         self.offset = offset
+        self.init_registers()
+
+    def fields(self):
+        if not self.offset.offset_from.is_register():
+            raise RuntimeError("Only offsets from a register can be encoded, not %s." % self)
+        return {'opcode': self.opcode, 'rs': self.offset.offset_from.register_number, 'rt': self.rt.register_number,
+                'immediate': encode_immediate(self.offset.offset.number, 16, True)}
+    
+    @classmethod
+    def from_fields(cls, fields):
+        offset = decode_immediate(fields['immediate'], 16, True)
+        return cls(decode_register(fields['rt']), Offset(str(offset), ['$', 'r%d' % fields['rs']]))
 
     def __str__(self):
         return '%s %s, %s' % (self.name(), self.rt, self.offset)
 
 class LW(MemIType):
+    __slots__ = ()
+    opcode = 0x23
+
     def destination(self):
         return self.rt
     
     def source(self):
         return [self.offset.offset_from]
     
-    @init_forwarding
-    @x_to_x
-    @m_to_x
-    def execute(self, sim):
-        pass
-
-    @accept_forwarding
     def memory(self, sim):
-        self.put_result(sim, sim.read_word(self.offset.value(sim)), stage='memory')
+        address = self.offset.offset.value(sim) + self.read(sim, self.offset.offset_from)
+        self.put_result(sim, sim.read_word(address), stage=MEMORY)
 
 class SW(MemIType):
+    __slots__ = ()
+    opcode = 0x2b
+    forwards_loads = True
+
     def destination(self):
         return None
     
     def source(self):
         return [self.rt]
     
-    @init_forwarding
-    @x_to_x
-    @m_to_x
-    def execute(self, sim):
-        pass
-
-    @m_to_m
-    @accept_forwarding
     def memory(self, sim):
-        sim.write_word(self.offset.value(sim), self.rt.value(sim))
+        sim.write_word(self.offset.value(sim), self.read(sim, self.rt))
 
 class JType(Instruction):
+    __slots__ = ('target',)
+    forwarding = False
+    format = [
+        ('opcode', 6),
+        ('target', 26)
+    ]
+
     def __init__(self, target):
         assert target.is_immediate()
         self.target = target
+        self.init_registers()
+    
+    def fields(self):
+        # The target is a word address, and the top 4 bits of the PC are assumed to be 0.
+        if self.target.number & 0x3 != 0:
+            raise RuntimeError("Can't jump to %s at a non-word boundary." % self.target)
+        return {'opcode': self.opcode, 'target': self.target.number >> 2}
+    
+    @classmethod
+    def from_fields(cls, fields):
+        return cls(Immediate(str(fields['target'] << 2)))
     
     def __str__(self):
         return '%s %s' % (self.__class__.__name__, self.target)
 
 class J(JType):
+    __slots__ = ()
+    opcode = 0x02
+
     def destination(self):
         return None
     
@@ -372,10 +425,13 @@ class J(JType):
     
     def execute(self, sim):
         sim.jump_to(self.target.value(sim))
-        sim.flush_before('execute')
+        sim.flush_before(EXECUTE)
 
 
 
+# Bump when the instruction set or its encoding changes, so cached programs are assembled again.
+ISA_VERSION = 1
+
 supported_instructions = {
     'add':  Add,
     'sub':  Sub,
@@ -407,9 +463,25 @@ def parse_instruction(instruction_name, args):
         if sim.verbose:  'Instruction parsing failed for %s' % instruction_name
         raise
 
-def encode_instruction(instruction):
-    pass
+# R-type instructions all have opcode 0 and are told apart by their function field.
+opcodes = dict((cls.opcode, cls) for cls in supported_instructions.values() if not issubclass(cls, RType))
+functions = dict((cls.function, cls) for cls in supported_instructions.values() if issubclass(cls, RType))
 
+def encode_instruction(instruction):
+    """ Returns the instruction as a 32 bit word. """
+    return instruction.encode()
 
 def decode_instruction(n):
-    pass
+    """ Returns a new Instruction for the 32 bit word n. """
+    n &= 0xffffffff
+    opcode = n >> 26
+    cls = functions.get(n & 0x3f) if opcode == 0 else opcodes.get(opcode)
+    if cls is None:
+        raise RuntimeError("0x%08x isn't a supported instruction." % n)
+
+    fields = {}
+    shift = 32
+    for field, size in cls.format:
+        shift -= size
+        fields[field] = (n >> shift) & ((1 << size) - 1)
+    return cls.from_fields(fields)
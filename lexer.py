@@ -0,0 +1,104 @@
+""" A hand-written lexer that turns assembly source into a list of tokens, so a grammar built from
+TypeMatch can work on a few tokens per instruction instead of on every character.
+
+Runs of letters and digits are one token and are classified afterwards, the same way the character
+grammar sees them: a run that is a decimal number is a Number, one that is 0x followed by hex digits
+is a HexNumber and anything else is a Mnemonic.  Spaces and newlines are kept as tokens where the
+grammar cares about them (a mnemonic has to be followed by whitespace, for example).
+"""
+
+import re
+
+class Token(object):
+    __slots__ = ('text', 'pos')
+
+    def __init__(self, text, pos):
+        self.text = text
+        self.pos = pos
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.text)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.text == other.text
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self), self.text))
+
+class Mnemonic(Token): __slots__ = ()
+class Register(Token): __slots__ = ()
+class Number(Token): __slots__ = ()
+class NegativeNumber(Token): __slots__ = ()
+class HexNumber(Token): __slots__ = ()
+class Comma(Token): __slots__ = ()
+class OpenParen(Token): __slots__ = ()
+class CloseParen(Token): __slots__ = ()
+class Comment(Token): __slots__ = ()
+class Directive(Token): __slots__ = ()
+class String(Token): __slots__ = ()
+class Space(Token): __slots__ = ()
+class Newline(Token): __slots__ = ()
+class Unknown(Token): __slots__ = ()
+
+# Spaces around a comma belong to the comma, and spaces that end a line are dropped: the grammar
+# accepts exactly the same input with them gone, and the token stream gets a third shorter.
+TOKEN_PATTERN = re.compile(r'''
+      (?P<Comma>[ \t]*,[ \t]*)
+    | [ \t]+(?=[\n\r;\#]|\Z)
+    | (?P<Space>[ \t]+)
+    | (?P<Newline>[\n\r])
+    | (?P<Register>\$[A-Za-z0-9]+)
+    | (?P<Word>-?[A-Za-z0-9]+)
+    | (?P<OpenParen>\()
+    | (?P<CloseParen>\))
+    | (?P<Comment>[;\#][^\n\r]*)
+    | (?P<Directive>\.[A-Za-z]+)
+    | (?P<String>"[^"\n\r]*")
+    | (?P<Unknown>[\s\S])
+''', re.VERBOSE)
+
+TOKEN_TYPES = {
+    'Space': Space,
+    'Newline': Newline,
+    'Register': Register,
+    'Comma': Comma,
+    'OpenParen': OpenParen,
+    'CloseParen': CloseParen,
+    'Comment': Comment,
+    'Directive': Directive,
+    'String': String,
+    'Unknown': Unknown,
+}
+
+NUMBER_PATTERN = re.compile(r'[0-9]+\Z')
+HEX_PATTERN = re.compile(r'0x[0-9a-fA-F]+\Z')
+
+def classify(text):
+    """ Returns the token type of a run of letters and digits, optionally preceded by a minus. """
+    if text[0] == '-':
+        return NegativeNumber if NUMBER_PATTERN.match(text, 1) else Unknown
+    if NUMBER_PATTERN.match(text):
+        return Number
+    if HEX_PATTERN.match(text):
+        return HexNumber
+    return Mnemonic
+
+def tokenize(data):
+    """ Returns the list of tokens in data, which can be a str or an mmap.  Characters no token
+    starts with become Unknown tokens, which no grammar rule accepts.
+    """
+    tokens = []
+    append = tokens.append
+    for m in TOKEN_PATTERN.finditer(data):
+        kind = m.lastgroup
+        if kind is None:
+            continue
+        text = m.group(kind)
+        if kind == 'Word':
+            append(classify(text)(text, m.start()))
+        else:
+            append(TOKEN_TYPES[kind](text, m.start()))
+    return tokens
@@ -0,0 +1,279 @@
+""" Finds loops the pipelined simulator has reached a steady state in, and skips through the
+iterations that would all run the same way.
+
+Each time a backward branch or jump retires, the detector takes a snapshot at it, the loop's head:
+the registers, the counters, the state of the pipeline and the instructions retired since the last
+one.  The loop is in a steady state when three snapshots in a row have the pipeline in the same
+state, the same instructions retired in the same number of cycles between them, and every register
+and every value in the pipeline changing by the same amount each iteration.
+
+The retired instructions are then run over the registers of the first two snapshots, to check that
+they give the registers of the next ones, and to find the values that decide how an iteration runs:
+what the branches compare, what slt compares, the sources of the other instructions that aren't
+linear, the addresses of loads and stores and what's stored.  While none of those decisions
+changes, every iteration adds the same to the registers and the counters, so the iterations up to
+the one before the first that would change are skipped at once.  Nothing is skipped for a loop that
+loads from or stores to addresses that change, stores values that change, jumps through a register
+that changes, uses a changing value in an instruction that isn't linear or would never end.
+"""
+
+from instructions import *
+from translator import ALU_OPERATIONS
+
+# A loop with more instructions than this in an iteration isn't looked for.
+MAX_LOOP_LENGTH = 1024
+
+# The most iterations the pipeline can take to come back to the same state, and the most the
+# detector waits for between looking for a steady state.
+MAX_PERIOD = 4
+MAX_BACKOFF = 64
+
+# The instructions that can close a loop.
+BACKWARD = frozenset([Beq, Bne, J])
+
+INFINITY = float('inf')
+
+class Snapshot(object):
+    """ The simulator when a loop's head retired. """
+    __slots__ = ('registers', 'instructions', 'cycles', 'pattern', 'values', 'trace')
+
+    def __init__(self, sim, trace):
+        self.registers = sim.registers[:]
+        self.instructions = sim.instruction_count
+        self.cycles = sim.cycle_count
+        self.pattern, self.values = pipeline_state(sim)
+        self.trace = trace
+
+def pipeline_state(sim):
+    """ Returns the state of the pipeline as the things that have to be the same from one iteration
+    to the next, and the list of the values in it: the results in the latches and the values
+    forwarded to the instruction in the execute stage, which it takes to the memory stage.
+    """
+    latches = sim.latches
+    values = [latch.result[1] for latch in latches if latch.valid and latch.result is not None]
+    forwarded = ()
+    latch = latches[EXECUTE]
+    if latch.valid and latch.instruction.forwarded:
+        forwarded = sorted(latch.instruction.forwarded, key=lambda register: register.register_number)
+        values.extend(latch.instruction.forwarded[register] for register in forwarded)
+    pattern = (sim.pc, sim.stalling(), tuple((latch.valid, latch.pc, latch.result is not None) for latch in latches),
+               tuple(register.register_number for register in forwarded))
+    return pattern, values
+
+def set_pipeline_values(sim, values):
+    """ Puts values, a list like the one pipeline_state returns, in the pipeline. """
+    values = iter(values)
+    latches = sim.latches
+    results = [(latch, next(values)) for latch in latches if latch.valid and latch.result is not None]
+    # An instruction can be in more than one stage, and its own result is the one it put in the
+    # newest of them, so that one is set last.
+    for latch, value in reversed(results):
+        latch.result = latch.instruction._result = latch.instruction.destination(), value
+    latch = latches[EXECUTE]
+    if latch.valid and latch.instruction.forwarded:
+        forwarded = latch.instruction.forwarded
+        for register in sorted(forwarded, key=lambda register: register.register_number):
+            forwarded[register] = next(values)
+
+def is_backward(instruction, pc):
+    """ Returns whether the instruction at pc is a branch or jump to pc or before it. """
+    if isinstance(instruction, (Beq, Bne)):
+        return instruction.immediate.is_immediate() and instruction.immediate.number < 0
+    if isinstance(instruction, J):
+        return instruction.target.is_immediate() and instruction.target.number <= pc
+    return False
+
+def operand(argument, registers):
+    if argument.is_register():
+        return registers[argument.register_number]
+    if argument.is_immediate():
+        return argument.number
+    raise RuntimeError("Can't follow the argument %s." % argument)
+
+def interpret(trace, registers, read_word):
+    """ Runs the instructions in trace, a list of (pc, instruction), one after the other over a copy
+    of registers.  Returns the registers after them, and a list of (kind, values) for the values
+    that decide how they ran: 'equal' and 'less' for the pairs of values a branch or slt compares,
+    and 'fixed' for values the instructions are only linear for as long as they don't change.
+    Stores aren't made, since they have to be the same every iteration.
+    """
+    registers = list(registers)
+    decisions = []
+    for pc, instruction in trace:
+        cls = type(instruction)
+        if cls in ALU_OPERATIONS:
+            if issubclass(cls, RType):
+                dest, a, b = instruction.rd, operand(instruction.rs, registers), operand(instruction.rt, registers)
+            else:
+                dest, a, b = instruction.rt, operand(instruction.rs, registers), operand(instruction.immediate, registers)
+            if cls is Slt:
+                decisions.append(('less', (a, b)))
+            elif cls in (And, Or, Nor):
+                decisions.append(('fixed', (a, b)))
+            value = ALU_OPERATIONS[cls][0](a, b)
+        elif cls in (Beq, Bne):
+            decisions.append(('equal', (operand(instruction.rs, registers), operand(instruction.rt, registers))))
+            continue
+        elif cls is LW or cls is SW:
+            if not instruction.offset.offset_from.is_register():
+                raise RuntimeError("Can't follow %s." % instruction)
+            address = instruction.offset.offset.number + operand(instruction.offset.offset_from, registers)
+            if cls is SW:
+                decisions.append(('fixed', (address, operand(instruction.rt, registers))))
+                continue
+            decisions.append(('fixed', (address,)))
+            dest, value = instruction.rt, read_word(address)
+        elif cls is JR:
+            decisions.append(('fixed', (operand(instruction.rt, registers),)))
+            continue
+        elif cls is J:
+            continue
+        else:
+            raise RuntimeError("Can't follow %s." % instruction)
+        if dest.register_number != 0:
+            registers[dest.register_number] = value
+    return registers, decisions
+
+def horizon(kind, values, slopes):
+    """ Returns for how many more iterations a decision with the given values, changing by slopes
+    each iteration, stays the same, or INFINITY if it always does.
+    """
+    if kind == 'fixed':
+        return 0 if any(slopes) else INFINITY
+    distance, closing = values[0] - values[1], slopes[0] - slopes[1]
+    if closing == 0:
+        return INFINITY
+    if kind == 'equal':
+        if distance == 0:
+            return 0
+        if distance % closing != 0 or -distance // closing <= 0:
+            return INFINITY
+        return -distance // closing - 1
+    # For 'less', the first values are less than the second ones until the distance changes sign.
+    if distance < 0:
+        return INFINITY if closing < 0 else (-distance + closing - 1) // closing - 1
+    return INFINITY if closing > 0 else distance // -closing
+
+def differences(first, second, third):
+    """ Returns how much each value changes from the first list to the second, or None if they
+    don't change by the same from the second to the third.
+    """
+    try:
+        deltas = [b - a for a, b in zip(first, second)]
+        if deltas != [c - b for b, c in zip(second, third)]:
+            return None
+    except TypeError:
+        # Not everything in list memory is a number.
+        return None
+    return deltas
+
+class LoopDetector(object):
+    """ Watches the instructions a pipelined simulator retires, and skips through loops once they
+    reach a steady state.
+
+    The pipeline can take more than one iteration to come back to the same state, when the
+    iterations stall differently, so a steady state is looked for over periods of up to MAX_PERIOD
+    iterations.  Each time the snapshots of a loop show no steady state, the detector waits for
+    longer before taking them again, so loops that never reach one cost little.
+    """
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.skipped = 0
+        self.forget()
+
+    def forget(self):
+        """ Forgets the loop being watched, since the simulator was changed under it. """
+        self.head = None
+        self.trace = []
+        self.snapshots = []
+        self.backoff = 0
+        self.waiting = 0
+
+    def retired(self, latch):
+        """ Called with the latch of each instruction the simulator retires. """
+        instruction = latch.instruction
+        self.trace.append((latch.pc, instruction))
+        if latch.pc == self.head:
+            if self.waiting:
+                self.waiting -= 1
+                self.trace = []
+            else:
+                self.snapshot()
+        elif type(instruction) in BACKWARD and is_backward(instruction, latch.pc):
+            self.forget()
+            self.head = latch.pc
+            self.snapshot()
+        elif len(self.trace) > MAX_LOOP_LENGTH:
+            self.forget()
+
+    def snapshot(self):
+        snapshots = self.snapshots
+        snapshots.append(Snapshot(self.sim, self.trace))
+        self.trace = []
+        for period in xrange(1, MAX_PERIOD + 1):
+            if len(snapshots) < 2 * period + 1:
+                return
+            iterations, deltas, value_deltas = self.steady(period)
+            if iterations > 0:
+                self.skip(period, iterations, deltas, value_deltas)
+                return
+        
+        # There's no steady state in any period yet, so wait before looking again.
+        self.backoff = min(2 * self.backoff + 1, MAX_BACKOFF)
+        self.waiting = self.backoff
+        self.snapshots = []
+
+    def steady(self, period):
+        """ Returns the number of periods of the given number of iterations that can be skipped from
+        the last snapshot, and how much each register and each value in the pipeline changes in a
+        period.
+        """
+        snapshots = self.snapshots
+        first, second, third = snapshots[-2 * period - 1], snapshots[-period - 1], snapshots[-1]
+        nothing = 0, None, None
+        if not first.pattern == second.pattern == third.pattern:
+            return nothing
+        if third.cycles - second.cycles != second.cycles - first.cycles or \
+           third.instructions - second.instructions != second.instructions - first.instructions:
+            return nothing
+        before = [step for snapshot in snapshots[-2 * period:-period] for step in snapshot.trace]
+        after = [step for snapshot in snapshots[-period:] for step in snapshot.trace]
+        if [pc for pc, instruction in before] != [pc for pc, instruction in after]:
+            return nothing
+        deltas = differences(first.registers, second.registers, third.registers)
+        value_deltas = differences(first.values, second.values, third.values)
+        if deltas is None or value_deltas is None:
+            return nothing
+
+        try:
+            registers, earlier = interpret(before, first.registers, self.sim.read_word)
+            if registers != second.registers:
+                return nothing
+            registers, later = interpret(after, second.registers, self.sim.read_word)
+            if registers != third.registers:
+                return nothing
+            left = min([horizon(kind, values, [b - a for a, b in zip(previous, values)])
+                        for (kind, previous), (_, values) in zip(earlier, later)] or [INFINITY])
+        except (RuntimeError, TypeError):
+            return nothing
+        # A loop that never ends isn't skipped through, and the pipeline already has some of the
+        # next period in it, so that one has to run the same way too.
+        if left == INFINITY:
+            return nothing
+        return left - 1, deltas, value_deltas
+
+    def skip(self, period, periods, deltas, value_deltas):
+        """ Skips the given number of periods of the given number of iterations of the loop. """
+        sim = self.sim
+        second, third = self.snapshots[-period - 1], self.snapshots[-1]
+        if sim.verbose: print 'Skipping %d iterations of the loop at 0x%x' % (period * periods, self.head)
+        registers = sim.registers
+        for number, delta in enumerate(deltas):
+            registers[number] += delta * periods
+        set_pipeline_values(sim, [value + delta * periods for value, delta in zip(third.values, value_deltas)])
+        sim.instruction_count += (third.instructions - second.instructions) * periods
+        sim.cycle_count += (third.cycles - second.cycles) * periods
+        self.skipped += period * periods
+        self.snapshots = []
+        self.backoff = 0
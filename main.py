@@ -1,68 +1,254 @@
 #!/usr/bin/env python 
 
 from pprint import pprint
-from instructions import parse_instruction
+from instructions import parse_instruction, ISA_VERSION
+from directives import parse_directive, Directive, Program
 from arguments import *
 import traceback
-import sys, time
+import sys, os, time
+import mmap
+import marshal
+import hashlib
+import tempfile
+import multiprocessing
 import grammar
 import simulator
+import sampling
+
+def print_syntax_errors(data, errors):
+    """ Prints each of the parser.ParseErrors in data with its line and column, the line itself and
+    a caret under the error.
+    """
+    line_num = 1
+    counted = 0
+    for error in errors:
+        # The errors are in order, so the newlines are counted in one pass over data.
+        line_num += data[counted:error.pos].count('\n')
+        counted = error.pos
+        line_start = data.rfind('\n', 0, error.pos) + 1
+        line_end = data.find('\n', error.pos)
+        if line_end < 0:
+            line_end = len(data)
+        column = error.pos - line_start + 1
+        
+        print "Syntax error at line %d, character %d" % (line_num, column)
+        if error.expected:
+            print "Expected %s" % ' or '.join(error.expected)
+        line = data[line_start:line_end]
+        print line
+        # Keep the tabs so the caret lines up with the line above it.
+        print ''.join([c if c == '\t' else ' ' for c in line[:column - 1]]) + '^'
 
 def read_asm_file(filename):
-    """ Reads the assembly file at the given filename.  If there is invalid syntax in the file, it
-    will throw an error.  This will return a list of parsed instructions in the following format:
+    """ Reads the assembly file at the given filename.  If there is invalid syntax in the file, every
+    syntax error is printed and None is returned.  Otherwise this will return a list of parsed
+    instructions in the following format:
 
     [List of Instruction]
     Where Instruction is:
-    [InstructionName [ListOf Argument]]
-    Where Argument is either Register, Offset, or Immediate
+    [InstructionName [ListOf Argument]] or [DirectiveName [ListOf Argument]]
+    Where DirectiveName is the name of a directive starting with a '.'
+    Where Argument is either Register, Offset, Immediate or String
     Where Register is: ['$', RegisterNumber]
     Where Offset is: [Number, Register or Immediate]
     Where Immediate is: [Number] or ['-', Number] or ['0x', HexNumber]
+    Where String is: ['"', Text]
     """
     with open(filename, 'rb') as f:
-        data = f.read()
-        print len(data.split('\n'))
-
-        parsed_instructions = grammar.parse(data)
-
-        if parsed_instructions is None:
-            action, rest = grammar.raw_parse(data)
-            error_char = len(data) - len(rest)
-            data_up_to_error = data[:error_char]
-            line_num = data_up_to_error.count('\n')
-            prev_newline = data_up_to_error.rfind('\n')
-            next_newline = rest.find('\n')
-            if prev_newline < 0:
-                prev_newline = 0
-            if next_newline < 0:
-                next_newline = len(rest)
-            
-            relative_error_char = error_char - prev_newline
-            print "Syntax error at line %d, character %d" % (line_num + 1, relative_error_char)
-
-            print data[prev_newline:error_char] + rest[:next_newline]
-            print ' ' * relative_error_char + '^'
+        data = open_asm_file(f)
+        parsed_instructions, errors = grammar.parse_with_errors(data)
+        if errors:
+            print_syntax_errors(data, errors)
             return None
     
     return parsed_instructions
 
-def sim_file(filename, verbose=True):
-    """ Simulates a given filename. """
-    insts = []
-    for line in read_asm_file(filename):
-        if line == []: continue
-        inst_name, args = line
-        insts.append(parse_instruction(inst_name, [parse_arg(arg) for arg in args]))
+def open_asm_file(f):
+    """ Maps the open file f, or reads it if it's empty, since empty files can't be mapped. """
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        return f.read()
+
+# Files bigger than this are split into parts of about this size when parsing on a process pool.
+CHUNK_SIZE = 1 << 22
+
+def parse_chunk(filename, start, end):
+    """ Parses the given part of the assembly file in a pool process.  Returns the parsed lines that
+    aren't empty, and the syntax errors with their positions in the whole file.
+    """
+    errors = []
+    with open(filename, 'rb') as f:
+        data = open_asm_file(f)
+        lines = [line for line in grammar.iter_parse(data[start:end], errors=errors) if line != []]
+    for error in errors:
+        error.pos += start
+    return lines, errors
+
+def iter_parsed_lines(filename, data, errors, processes):
+    """ Yields the parsed lines of data, the contents of filename, in order. """
+    if processes <= 1 or len(data) <= CHUNK_SIZE:
+        for line in grammar.iter_parse(data, errors=errors):
+            yield line
+        return
+
+    # Only a few parts are queued ahead of the one being yielded, so memory use doesn't grow with
+    # the size of the file.
+    pool = multiprocessing.Pool(processes)
+    try:
+        parts = iter(grammar.split_lines(data, CHUNK_SIZE))
+        pending = []
+        while True:
+            for start, end in parts:
+                pending.append(pool.apply_async(parse_chunk, (filename, start, end)))
+                if len(pending) >= processes * 2:
+                    break
+            if not pending:
+                break
+            lines, chunk_errors = pending.pop(0).get()
+            errors.extend(chunk_errors)
+            for line in lines:
+                yield line
+    finally:
+        pool.terminate()
+
+# Parsed programs are cached in this directory.  Entries are named by content, so one directory
+# serves every source file.
+CACHE_DIR = '.asmcache'
+
+def cache_path(data):
+    """ Returns where the parse of the source data is cached.  The name is a hash of
+    the source and of everything that decides what it parses to.
+    """
+    key = hashlib.sha1('%d %d %d\n' % (grammar.GRAMMAR_VERSION, ISA_VERSION, marshal.version))
+    key.update(data)
+    return os.path.join(CACHE_DIR, key.hexdigest())
+
+def load_cached_lines(path):
+    """ Returns the cached parsed lines at path, or None if there aren't any. """
+    try:
+        with open(path, 'rb') as f:
+            lines = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    return lines if isinstance(lines, list) else None
+
+def store_cached_lines(path, lines):
+    """ Caches the parsed lines at path.  The file is written under another name and renamed, so
+    a run reading the cache at the same time never sees half of it.  Failing to write is ignored.
+    """
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(lines, f)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        pass
+
+def iter_asm_file(filename, errors, processes=1, cache=True):
+    """ Yields an Instruction or a Directive for each line of the assembly file at filename as soon
+    as it's parsed.  Lines with invalid syntax are skipped, and their parser.ParseErrors added to errors.
+    With more than one process, big files are split up and the parts parsed in parallel.  If cache
+    is True, the parse is looked up in and saved to CACHE_DIR.
+    """
+    with open(filename, 'rb') as f:
+        data = open_asm_file(f)
+        path = cache_path(data) if cache else None
+        lines = load_cached_lines(path) if cache else None
+        # The lines are only kept for the cache if they weren't found in it.
+        parsed = [] if cache and lines is None else None
+        if lines is None:
+            lines = iter_parsed_lines(filename, data, errors, processes)
+        
+        errors_before = len(errors)
+        for line in lines:
+            if line == []: continue
+            if parsed is not None:
+                parsed.append(line)
+            name, args = line
+            args = [parse_arg(arg) for arg in args]
+            yield parse_directive(name, args) if name.startswith('.') else parse_instruction(name, args)
+        
+        if parsed is not None and len(errors) == errors_before:
+            store_cached_lines(path, parsed)
+
+def load_asm_file(filename, processes=1, cache=True):
+    """ Returns the assembly file at filename assembled into a Program.  If there is invalid syntax
+    in the file, every syntax error is printed and a RuntimeError raised.
+    """
+    errors = []
+    program = Program(os.path.dirname(filename))
+    for item in iter_asm_file(filename, errors, processes, cache):
+        if isinstance(item, Directive):
+            item.apply(program)
+        else:
+            program.add_instruction(item)
+    if errors:
+        with open(filename, 'rb') as f:
+            print_syntax_errors(open_asm_file(f), errors)
+        raise RuntimeError("%s has %d syntax errors" % (filename, len(errors)))
+
+    assert all(inst is not None for inst in program.text)
+    return program
+
+def sim_file(filename, verbose=True, processes=1, cache=True, packed=False, mode='pipelined', extrapolate=False):
+    """ Simulates a given filename, in one of simulator.MODES. """
+    program = load_asm_file(filename, processes, cache)
 
-    assert all(inst is not None for inst in insts)
+    sim = simulator.Simulator(verbose=verbose, packed=packed, mode=mode, extrapolate=extrapolate)
+    sim.load_program(program)
+    sim.run()
+
+    return sim
 
-    sim = simulator.Simulator(verbose=verbose)
-    sim.load(insts)
+def sim_image(filename, verbose=True, mode='pipelined', extrapolate=False):
+    """ Simulates the program image at filename, as written by assembler.py. """
+    sim = simulator.Simulator(verbose=verbose, packed=True, mode=mode, extrapolate=extrapolate)
+    sim.load_image(filename)
     sim.run()
 
     return sim
 
+def sample_file(filename, processes=1, cache=True, **options):
+    """ Estimates the CPI of the assembly file or program image at filename with sampled
+    simulation, taking the options of sampling.run_sampled, and prints it.
+    """
+    # Only program images need packed memory, and not every program can be packed.
+    image = filename.endswith('.img')
+    sim = simulator.Simulator(packed=image)
+    if image:
+        sim.load_image(filename)
+    else:
+        sim.load_program(load_asm_file(filename, processes, cache))
+    sample = sampling.run_sampled(sim, **options)
+
+    print 'Execution finished'
+    interval = sample.interval()
+    print '%d instructions were run, %d of them in %d measured windows' % (sample.instructions, sample.detailed_instructions(), len(sample.windows))
+    print 'The estimated CPI is %.03f%s, for %d cycles' % (sample.cpi(), ' +/- %.03f' % interval if interval is not None else '', sample.cycles())
+    print sim.registers
+
+    return sample
+
 if __name__ == '__main__':
-    filename = sys.argv[1]
-    sim_file(filename)
+    args = sys.argv[1:]
+    mode = 'pipelined'
+    extrapolate = False
+    while args[0] in ('--functional', '--translated', '--sampled', '--extrapolate'):
+        if args[0] == '--extrapolate':
+            extrapolate = True
+        else:
+            mode = args[0][2:]
+        args = args[1:]
+    filename = args[0]
+    if mode == 'sampled':
+        if extrapolate:
+            raise RuntimeError("Loops can only be skipped through in pipelined mode, not sampled mode.")
+        sample_file(filename)
+    elif filename.endswith('.img'):
+        sim_image(filename, mode=mode, extrapolate=extrapolate)
+    else:
+        sim_file(filename, mode=mode, extrapolate=extrapolate)
@@ -1,3 +1,6 @@
+import copy
+import itertools
+import re
 import types
 
 OPTIONAL_DEFAULT = False
@@ -20,6 +23,11 @@ def rec_join(s):
 
 def general_sum(lst):
     if not lst: raise RuntimeError("Cannot do a sum on an empty list")
+    try:
+        # Strings are joined in one go rather than copied on every +=.
+        return ''.join(lst)
+    except TypeError:
+        pass
     s = lst[0]
     for i in lst[1:]:
         s += i
@@ -34,38 +42,73 @@ def copydict(d):
 def __isfunction__(f):
     return type(f) in (types.FunctionType, types.MethodType)
 
-def __pdebug__(s, depth, verbose, atom=False):
+def __pdebug__(s, depth, verbose, atom=False, args=()):
+    # Formatting is deferred until we know the message is printed; str() of a grammar is expensive.
     if verbose and (not atom or atom and ATOM_DEBUG):
-        print '  ' * depth + s
+        print '  ' * depth + (s % args if args else s)
+
+def __preview__(buf, pos, length=40):
+    return buf[pos:pos + length]
+
+# Actions add a matcher's item to the list its parent is building.  Every caller hands an action
+# a list of its own, so actions add to it in place and return it instead of copying it.
+
+def __keep__(lst):
+    return lst
+
+class Append(object):
+    """ Action that appends item to the list. """
+    __slots__ = ('item',)
+    
+    def __init__(self, item):
+        self.item = item
+    
+    def __call__(self, lst):
+        lst.append(self.item)
+        return lst
 
-def __return_item__(item, rest, arguments):
+class Extend(object):
+    """ Action for a combined item: its elements are spliced into the list.  An item that can't be
+    iterated replaces the contents of the list.
+    """
+    __slots__ = ('item',)
+    
+    def __init__(self, item):
+        self.item = item
+    
+    def __call__(self, lst):
+        if hasattr(self.item, '__iter__'):
+            lst.extend(self.item)
+        else:
+            lst[:] = [self.item]
+        return lst
+
+def __return_item__(item, pos, arguments):
     global CouldNotFind
     
     #print '------------ Returning ', arguments.get('name', None)
-    action = lambda lst: lst + [item]
     if type(item) is CouldNotFindType:
         if arguments.get('optional', False):
-            action = lambda lst: (lst)
-        else:
-            return CouldNotFind, rest
-    else:
-        if 'postprocess' in arguments:
-            item = arguments['postprocess'](item)
-        
-        if 'name' in arguments and not arguments.get('ignorename', IGNORE_NAME_DEFAULT):
-            item = {arguments['name']: item}
-        #elif 'name' in arguments:
-        
-        if arguments.get('hide', False):
-            action = lambda lst: list(lst)
-        else:
-            if arguments.get('combine', False):
-                def combine_func(lst):
-                    lst = lst + list(item) if hasattr(item, '__iter__') else [item]
-                    return lst
-                action = combine_func#lambda lst: lst + list(item)
+            return __keep__, pos
+        return CouldNotFind, pos
+    
+    if 'postprocess' in arguments:
+        item = arguments['postprocess'](item)
+    
+    if 'name' in arguments and not arguments.get('ignorename', IGNORE_NAME_DEFAULT):
+        item = {arguments['name']: item}
+    #elif 'name' in arguments:
     
-    return action, rest
+    if arguments.get('hide', False):
+        return __keep__, pos
+    if arguments.get('combine', False):
+        return Extend(item), pos
+    return Append(item), pos
+
+def __first_union__(a, b):
+    if a is None or b is None:
+        return None
+    return a | b
 
 def __combine_options__(options1, options2):
     ret = {}
@@ -77,14 +120,114 @@ def __combine_options__(options1, options2):
             ret[key] = options2[key]
     return ret
 
+class ParseError(object):
+    """ A syntax error: the position matching stopped at, and descriptions of what was expected there. """
+    def __init__(self, pos, expected):
+        self.pos = pos
+        self.expected = expected
+    
+    def __str__(self):
+        if not self.expected:
+            return 'Syntax error at %d' % self.pos
+        return 'Syntax error at %d, expected %s' % (self.pos, ' or '.join(self.expected))
+    
+    def __repr__(self):
+        return 'ParseError(%d, %r)' % (self.pos, self.expected)
+
+def __describe__(match):
+    if 'name' in match.options:
+        return match.options['name']
+    return match.strval()
+
+class ParseState(object):
+    """ Bookkeeping shared by every match() call of a single parse.  When packrat is enabled, memo
+    holds the result of each (matcher, position) pair so every rule runs at most once per position.
+    
+    furthest is the furthest position a terminal or named matcher failed at and expected lists
+    those matchers, so the cause of a failed parse is known without parsing again.  errors holds
+    the ParseErrors a DelimitedMatch with the recover option skipped over.
+    """
+    def __init__(self, packrat=False):
+        self.memo = {} if packrat else None
+        self.furthest = -1
+        self.expected = []
+        self.errors = []
+    
+    def failed(self, match, pos, mark):
+        """ Records that match failed at pos.  A named matcher replaces whatever its children
+        expected, at the furthest position they got to; mark is (furthest, len(expected)) from
+        before it ran.
+        """
+        if mark is not None:
+            furthest, count = mark
+            if self.furthest > furthest:
+                self.expected = [match]
+                return
+            if self.furthest == furthest and len(self.expected) > count:
+                del self.expected[count:]
+                self.expected.append(match)
+                return
+        
+        if pos < self.furthest:
+            return
+        if pos > self.furthest:
+            self.furthest = pos
+            self.expected = []
+        if match not in self.expected:
+            self.expected.append(match)
+    
+    def error(self, pos):
+        """ Returns a ParseError at the furthest failure, or at pos if nothing failed after it. """
+        if self.furthest < pos:
+            return ParseError(pos, [])
+        expected = []
+        for match in self.expected:
+            description = __describe__(match)
+            if description not in expected:
+                expected.append(description)
+        return ParseError(self.furthest, expected)
+
+def packrat(func):
+    """ Decorator for a match method.  Without a memo table it keeps the old behavior of failing a
+    matcher that is re-entered at the same input through the seen set.  With a memo table the
+    result is looked up by (matcher, position), and a failure is stored before the matcher runs so
+    left recursion fails the same way without hashing the remaining input.  Failures of terminal
+    and named matchers are recorded in the state.
+    """
+    def wrapper(self, buf, pos=0, depth=0, seen=set(), state=None):
+        if state is None:
+            if (self, pos) in seen:
+                return __return_item__(CouldNotFind, pos, self.options)
+            return func(self, buf, pos, depth=depth, seen=seen | set([(self, pos)]), state=state)
+        
+        mark = (state.furthest, len(state.expected)) if 'name' in self.options else None
+        if state.memo is None:
+            if (self, pos) in seen:
+                return __return_item__(CouldNotFind, pos, self.options)
+            ret = func(self, buf, pos, depth=depth, seen=seen | set([(self, pos)]), state=state)
+        else:
+            key = (id(self), pos)
+            memo = state.memo
+            if key in memo:
+                return memo[key]
+            memo[key] = __return_item__(CouldNotFind, pos, self.options)
+            ret = memo[key] = func(self, buf, pos, depth=depth, seen=seen, state=state)
+        
+        if ret is not None and type(ret[0]) is CouldNotFindType and (self.terminal or mark is not None):
+            state.failed(self, pos, mark)
+        return ret
+    return wrapper
+
 def copied_self(func):
     def wrapper(self, *args, **kwargs):
-        cp = self.copy()
+        cp = self.clone()
         func(cp, *args, **kwargs)
         return cp
     return wrapper
 
 class MatchObject(object):
+    # Terminal matchers look at the input themselves; their failures are what a syntax error expected.
+    terminal = False
 
     def set_option(self, property_name, value):
         self.options[property_name] = value
@@ -98,6 +241,20 @@ class MatchObject(object):
     def copy(self):
         raise RuntimeError("The base match object does not support copying")
     
+    def clone(self):
+        """ Returns a shallow copy with options of its own.  The children are shared, so fluent calls
+        don't copy the subtree.
+        """
+        cp = copy.copy(self)
+        cp.options = copydict(self.options)
+        return cp
+    
+    def first(self, seen=set()):
+        """ Returns (chars, nullable): the set of items a match can start with (None if it can start
+        with anything) and whether it can succeed without consuming input.  Both are conservative.
+        """
+        return None, True
+    
     @copied_self
     def optional(self, optional=True):
         #cp = self.copy()
@@ -161,6 +318,8 @@ class LinearMatch(MatchObject):
         self.options = arguments
     
     def add_item(self, item):
+        if isinstance(self.options, FrozenOptions):
+            raise RuntimeError("A frozen grammar can't be changed")
         self.items += [item]
         return self
     
@@ -177,21 +336,30 @@ class LinearMatch(MatchObject):
     def __str__(self):
         return self.strval()
     
-    def match(self, lst, depth=0, seen=set()):
-        if (self, lst) in seen:
-            return __return_item__(CouldNotFind, lst, self.options)
-        __pdebug__('Matching %s to %r' % (str(self), lst), depth, self.options.get('verbose', DEBUG_DEFAULT))
+    def first(self, seen=set()):
+        if self in seen:
+            return None, True
+        chars = frozenset()
+        for item in self.items:
+            item_chars, nullable = item.first(seen=seen | set([self]))
+            chars = __first_union__(chars, item_chars)
+            if not nullable:
+                return chars, self.options.get('optional', False)
+        return chars, True
+    
+    @packrat
+    def match(self, buf, pos=0, depth=0, seen=set(), state=None):
+        __pdebug__('Matching %s to %r', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self, __preview__(buf, pos)))
         
-        seen = seen | set([(self, lst)])
-        original_lst = lst
+        original_pos = pos
         match_index = 0
         match_list = []
         done = False
         while True:
             match_item = self.items[match_index]
             #__pdebug__('Matching item %s to %s' % (match_item, lst), depth, self.options.get('verbose', DEBUG_DEFAULT))
-            action, lst = match_item.match(lst, depth=depth+1, seen=seen)
-            if type(action) is CouldNotFindType: return __return_item__(CouldNotFindType(action.message), original_lst, self.options)
+            action, pos = match_item.match(buf, pos, depth=depth+1, seen=seen, state=state)
+            if type(action) is CouldNotFindType: return __return_item__(CouldNotFindType(action.message), original_pos, self.options)
             
             match_list = action(match_list)
             
@@ -199,7 +367,7 @@ class LinearMatch(MatchObject):
             if match_index >= len(self.items):
                 break
         
-        return __return_item__(match_list, lst, self.options)
+        return __return_item__(match_list, pos, self.options)
     
     def __add__(self, other):
         items = self.items + tuple([other])
@@ -222,6 +390,8 @@ class StarMatch(MatchObject):
         self.options = arguments
     
     def set_item(self, item):
+        if isinstance(self.options, FrozenOptions):
+            raise RuntimeError("A frozen grammar can't be changed")
         self.starMatch = item
         return self
     
@@ -242,38 +412,46 @@ class StarMatch(MatchObject):
     def __str__(self):
         return self.strval()
     
-    def match(self, lst, depth=0, seen=set()):
-        if (self, lst) in seen:
-            return __return_item__(CouldNotFind, lst, self.options)
-        __pdebug__('Matching %s to %r' % (str(self), lst), depth, self.options.get('verbose', DEBUG_DEFAULT))
+    def first(self, seen=set()):
+        if self in seen or self.starMatch is None:
+            return None, True
+        chars, nullable = self.starMatch.first(seen=seen | set([self]))
+        return chars, nullable or self.options.get('min', 0) == 0 or self.options.get('optional', False)
+    
+    @packrat
+    def match(self, buf, pos=0, depth=0, seen=set(), state=None):
+        __pdebug__('Matching %s to %r', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self, __preview__(buf, pos)))
         
-        seen = seen | set([(self, lst)])
-        original_lst = lst
-        last_lst = lst
+        original_pos = pos
+        last_pos = pos
         matches = []
         while True:
-            action, lst = self.starMatch.match(lst, depth=depth+1, seen=seen)
+            action, pos = self.starMatch.match(buf, pos, depth=depth+1, seen=seen, state=state)
             
-            if type(action) is CouldNotFindType or lst == last_lst: break
-            last_lst = lst
+            if type(action) is CouldNotFindType or pos == last_pos: break
+            last_pos = pos
             matches = action(matches)
         
         if self.options.get('min', 0) <= len(matches) <= self.options.get('max', float('inf')):
-            __pdebug__('%s match succeeded' % self, depth, self.options.get('verbose', DEBUG_DEFAULT))
-            return __return_item__(matches, lst, self.options)
+            __pdebug__('%s match succeeded', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self,))
+            return __return_item__(matches, pos, self.options)
         else:
-            __pdebug__('%s match failed' % self, depth, self.options.get('verbose', DEBUG_DEFAULT))
-            return __return_item__(CouldNotFind, original_lst, self.options)
+            __pdebug__('%s match failed', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self,))
+            return __return_item__(CouldNotFind, original_pos, self.options)
 
 class OrMatch(MatchObject):
     def __init__(self, *items, **arguments):
         self.items = items
         self.options = arguments
+        self.dispatch = None
         #if 'combine' not in self.options:
         #    self.options['combine'] = True
     
     def add_item(self, item):
-        self.items += [item]
+        if isinstance(self.options, FrozenOptions):
+            raise RuntimeError("A frozen grammar can't be changed")
+        self.items += (item,)
+        self.dispatch = None
         return self
     
     def copy(self, copied_items={}):
@@ -290,47 +468,88 @@ class OrMatch(MatchObject):
     def __str__(self):
         return self.strval()
     
-    def match(self, lst, depth=0, seen=set()):
-        if (self, lst) in seen:
-            return __return_item__(CouldNotFind, lst, self.options)
-        __pdebug__('Matching %s to %r' % (str(self), lst), depth, self.options.get('verbose', DEBUG_DEFAULT))
+    def first(self, seen=set()):
+        if self in seen:
+            return None, True
+        chars, nullable = frozenset(), self.options.get('optional', False)
+        for item in self.items:
+            item_chars, item_nullable = item.first(seen=seen | set([self]))
+            chars = __first_union__(chars, item_chars)
+            nullable = nullable or item_nullable
+        return chars, nullable
+    
+    def viable(self, buf, pos):
+        """ Returns the indices of the alternatives that can match at pos, in order.  The table is
+        built from the alternatives' first sets on the first match, so a grammar must not be changed
+        after it has been used.
+        """
+        if self.dispatch is None:
+            firsts = [item.first() for item in self.items]
+            always = tuple([i for i, (chars, nullable) in enumerate(firsts) if chars is None or nullable])
+            table = {}
+            for i, (chars, nullable) in enumerate(firsts):
+                for char in chars or ():
+                    table[char] = None
+            for char in table:
+                table[char] = tuple([i for i, (chars, nullable) in enumerate(firsts) if chars is None or nullable or \
+                                     char in chars or type(char) in chars])
+            at_end = tuple([i for i, (chars, nullable) in enumerate(firsts) if nullable])
+            self.dispatch = table, always, at_end
+        
+        table, always, at_end = self.dispatch
+        if pos >= len(buf):
+            return at_end
+        try:
+            item = buf[pos]
+            viable = table.get(item)
+            if viable is None:
+                viable = table.get(type(item), always)
+            return viable
+        except TypeError:
+            # An unhashable item can only be matched by alternatives with unknown first sets.
+            return always
+    
+    @packrat
+    def match(self, buf, pos=0, depth=0, seen=set(), state=None):
+        __pdebug__('Matching %s to %r', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self, __preview__(buf, pos)))
         
-        seen = seen | set([(self, lst)])
         possible_matches = []
         operating_mode = self.options.get('mode', 'first')
-        for match in self.items:
-            __pdebug__('Matching item %s to %s' % (match, lst), depth, self.options.get('verbose', DEBUG_DEFAULT))
-            action, new_lst = match.match(lst, depth=depth+1, seen=seen)
+        for index in self.viable(buf, pos):
+            match = self.items[index]
+            __pdebug__('Matching item %s to %s', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(match, __preview__(buf, pos)))
+            action, new_pos = match.match(buf, pos, depth=depth+1, seen=seen, state=state)
             if type(action) is CouldNotFindType:
                 #print '-' * 20, self.options.get('name', '')
                 continue
             
             l = action([])
             if len(l) > 0:
-                possible_matches.append((l, new_lst))
+                possible_matches.append((l, new_pos))
             
                 if operating_mode == 'first':
                     break
         
         if not possible_matches:
-            __pdebug__('%s failed!' % (self), depth, self.options.get('verbose', DEBUG_DEFAULT))
-            return __return_item__(CouldNotFind, lst, self.options)
-        __pdebug__('%s succeeded!' % self, depth, self.options.get('verbose', DEBUG_DEFAULT))
+            __pdebug__('%s failed!', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self,))
+            return __return_item__(CouldNotFind, pos, self.options)
+        __pdebug__('%s succeeded!', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self,))
         
         if operating_mode == 'shortest':
-            # The longest list yields the shortest result
-            result, rest = max(possible_matches, key=lambda m: len(m[1]))
+            # The smallest end position yields the shortest result
+            result, end = min(possible_matches, key=lambda m: m[1])
         elif operating_mode == 'longest':
-            # The longest list yields the shortest result
-            result, rest = min(possible_matches, key=lambda m: len(m[1]))
+            # The largest end position yields the longest result
+            result, end = max(possible_matches, key=lambda m: m[1])
         elif operating_mode == 'last':
-            result, rest = possible_matches[-1]
+            result, end = possible_matches[-1]
         elif type(operating_mode) in (types.FunctionType, types.MethodType):
-            result, rest = self.options['mode'](possible_matches)
+            # A mode function picks from (result, end position) pairs.
+            result, end = self.options['mode'](possible_matches)
         else:
-            result, rest = possible_matches[0]
+            result, end = possible_matches[0]
         
-        return __return_item__(result, rest, self.options)
+        return __return_item__(result, end, self.options)
     
     def __or__(self, other):
         if type(other) == OrMatch:
@@ -363,26 +582,32 @@ class DelimitedMatch(MatchObject):
     def __str__(self):
         return self.strval()
     
-    def match(self, lst, depth=0, seen=set()):
-        if (self, lst) in seen:
-            return __return_item__(CouldNotFind, lst, self.options)
-        __pdebug__('Matching %s to %r' % (str(self), lst), depth, self.options.get('verbose', DEBUG_DEFAULT))
+    def first(self, seen=set()):
+        if self in seen:
+            return None, True
+        chars, nullable = self.item.first(seen=seen | set([self]))
+        return chars, nullable or self.options.get('optional', False)
+    
+    @packrat
+    def match(self, buf, pos=0, depth=0, seen=set(), state=None):
+        __pdebug__('Matching %s to %r', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self, __preview__(buf, pos)))
+        
+        if 'recover' in self.options and state is not None:
+            return self.recovering_match(buf, pos, depth, seen, state)
         
-        seen = seen | set([(self, lst)])
         matches = []
         match = False
-        new_lst = lst
-        del_lst = None
+        new_pos = pos
         while not isinstance(match, CouldNotFindType):
-            last_lst = new_lst
+            last_pos = new_pos
             if match: # is not None:
                 __pdebug__('Searching for delimiter', depth, self.options.get('verbose', DEBUG_DEFAULT))
-                delimitor_match, new_lst = self.delimitor.match(new_lst, depth=depth+1, seen=seen)
+                delimitor_match, new_pos = self.delimitor.match(buf, new_pos, depth=depth+1, seen=seen, state=state)
                 if isinstance(delimitor_match, CouldNotFindType):
                     break
             
             __pdebug__('Searching for content...', depth, self.options.get('verbose', DEBUG_DEFAULT))
-            action, new_lst = self.item.match(new_lst, depth=depth+1, seen=seen)
+            action, new_pos = self.item.match(buf, new_pos, depth=depth+1, seen=seen, state=state)
             if isinstance(action, CouldNotFindType):
                 break
             match = True
@@ -391,10 +616,47 @@ class DelimitedMatch(MatchObject):
             matches.append(l)
         
         if not matches:
-            __pdebug__('%s failed!' % (self), depth, self.options.get('verbose', DEBUG_DEFAULT))
-            return __return_item__(CouldNotFind, lst, self.options)
+            __pdebug__('%s failed!', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self,))
+            return __return_item__(CouldNotFind, pos, self.options)
         
-        return __return_item__(matches, last_lst, self.options)
+        return __return_item__(matches, last_pos, self.options)
+    
+    def recovering_match(self, buf, pos, depth, seen, state):
+        """ match() for the recover option, which always matches up to the end of buf. """
+        matches = [action([]) for action, end in self.iter_items(buf, pos, depth=depth, seen=seen, state=state)]
+        return __return_item__(matches, len(buf), self.options)
+    
+    def iter_items(self, buf, pos=0, depth=0, seen=set(), state=None):
+        """ Yields (action, end position) for each item matched from pos, in order.  With the recover
+        option, which holds the characters to resynchronize at, an item that fails or that isn't
+        followed by a delimiter is added to state.errors as a ParseError, and matching goes on at the
+        next delimiter starting with one of those characters, up to the end of buf.
+        """
+        recover = self.options.get('recover') if state is not None else None
+        while True:
+            if recover is not None:
+                state.furthest, state.expected = -1, []
+            action, new_pos = self.item.match(buf, pos, depth=depth+1, seen=seen, state=state)
+            if not isinstance(action, CouldNotFindType):
+                pos = new_pos
+                delimitor_match, new_pos = self.delimitor.match(buf, pos, depth=depth+1, seen=seen, state=state)
+                if not isinstance(delimitor_match, CouldNotFindType):
+                    yield action, pos
+                    pos = new_pos
+                    continue
+                if recover is None or pos >= len(buf):
+                    yield action, pos
+                    return
+            elif recover is None:
+                return
+            
+            error = state.error(pos)
+            state.errors.append(error)
+            pos = __find_any__(buf, recover, error.pos)
+            if pos >= len(buf):
+                return
+            delimitor_match, new_pos = self.delimitor.match(buf, pos, depth=depth+1, seen=seen, state=state)
+            pos = pos + 1 if isinstance(delimitor_match, CouldNotFindType) else new_pos
     
     def __or__(self, other):
         if type(other) == OrMatch:
@@ -406,7 +668,19 @@ class DelimitedMatch(MatchObject):
             
         return OrMatch(*items, **options)
 
+def __find_any__(buf, chars, pos):
+    """ Returns the index of the first item of buf at or after pos that is in chars, or len(buf). """
+    try:
+        m = re.compile(__charclass__(chars)).search(buf, pos)
+        return m.start() if m else len(buf)
+    except TypeError:
+        while pos < len(buf) and buf[pos] not in chars:
+            pos += 1
+        return pos
+
 class ValueMatch(MatchObject):
+    terminal = True
+    
     def __init__(self, matchingValue, **arguments):
         self.matchingValue = matchingValue
         self.options = arguments
@@ -424,24 +698,32 @@ class ValueMatch(MatchObject):
             return self.options['name']
         return ('%s' % ('value(' + self.options['name'] + ', %s)') if 'name' in self.options else '%s') % '%r' % self.matchingValue
     
-    def match(self, lst, depth=0, seen=set()):
-        if (self, lst) in seen:
-            return __return_item__(CouldNotFind, lst, self.options)
-        __pdebug__('Matching %s to %r' % (str(self), lst), depth, self.options.get('verbose', DEBUG_DEFAULT), atom=True)
+    def first(self, seen=set()):
+        try:
+            chars = frozenset([self.matchingValue])
+        except TypeError:
+            return None, True
+        return chars, self.options.get('optional', False)
+    
+    @packrat
+    def match(self, buf, pos=0, depth=0, seen=set(), state=None):
+        __pdebug__('Matching %s to %r', depth, self.options.get('verbose', DEBUG_DEFAULT), atom=True, args=(self, __preview__(buf, pos)))
         
         return_value = CouldNotFind
-        rest = lst
-        if len(lst) > 0 and lst[0] == self.matchingValue:
-            return_value = lst[0]
-            rest = lst[1:]
+        end = pos
+        if pos < len(buf) and buf[pos] == self.matchingValue:
+            return_value = buf[pos]
+            end = pos + 1
         
         if return_value is CouldNotFind:
-            __pdebug__('Match %s failed' % str(self), depth, self.options.get('verbose', DEBUG_DEFAULT), atom=True)
+            __pdebug__('Match %s failed', depth, self.options.get('verbose', DEBUG_DEFAULT), atom=True, args=(self,))
         else:
-            __pdebug__('Match %s succeeded' % str(self), depth, self.options.get('verbose', DEBUG_DEFAULT), atom=True)
-        return __return_item__(return_value, rest, self.options)
+            __pdebug__('Match %s succeeded', depth, self.options.get('verbose', DEBUG_DEFAULT), atom=True, args=(self,))
+        return __return_item__(return_value, end, self.options)
 
 class TypeMatch(MatchObject):
+    terminal = True
+    
     def __init__(self, *matching_types, **arguments):
         self.matching_types = matching_types
         self.options = arguments
@@ -457,20 +739,25 @@ class TypeMatch(MatchObject):
             return self.options['name']
         return 'type(%s%s)' % ((self.options['name'] + ', ') if 'name' in self.options else '', self.matching_types)
     
-    def match(self, lst, depth=0, seen=set()):
-        if (self, lst) in seen:
-            return __return_item__(CouldNotFind, lst, self.options)
-        __pdebug__('Matching %s to %r' % (str(self), lst), depth, self.options.get('verbose', DEBUG_DEFAULT), atom=True)
+    def first(self, seen=set()):
+        # The first set holds the types themselves; OrMatch looks an item's type up when the item isn't found.
+        return frozenset(self.matching_types), self.options.get('optional', False)
+    
+    @packrat
+    def match(self, buf, pos=0, depth=0, seen=set(), state=None):
+        __pdebug__('Matching %s to %r', depth, self.options.get('verbose', DEBUG_DEFAULT), atom=True, args=(self, __preview__(buf, pos)))
         
         return_value = CouldNotFind
-        rest = lst
-        if len(lst) > 0 and type(lst[0]) in self.matching_types:
-            return_value = lst[0]
-            rest = lst[1:]
+        end = pos
+        if pos < len(buf) and type(buf[pos]) in self.matching_types:
+            return_value = buf[pos]
+            end = pos + 1
         
-        return __return_item__(return_value, rest, self.options)
+        return __return_item__(return_value, end, self.options)
 
 class FunctionMatch(MatchObject):
+    terminal = True
+    
     def __init__(self, function, **arguments):
         self.matching_function = function
         self.options = arguments
@@ -481,13 +768,14 @@ class FunctionMatch(MatchObject):
     def strval(self, seen=set()):
         return self.matching_function
     
-    def match(self, lst, depth=0, seen=set()):
-        if (self, lst) in seen:
-            return __return_item__(CouldNotFind, lst, self.options)
-        __pdebug__('Matching %s to %r' % (str(self), lst), depth, self.options.get('verbose', DEBUG_DEFAULT))
-        return self.matching_function(lst)
+    @packrat
+    def match(self, buf, pos=0, depth=0, seen=set(), state=None):
+        __pdebug__('Matching %s to %r', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self, __preview__(buf, pos)))
+        return self.matching_function(buf, pos)
 
 class RegexMatch(MatchObject):
+    terminal = True
+    
     def __init__(self, regex, **arguments):
         self.matching_regex = regex
         self.options = arguments
@@ -498,18 +786,24 @@ class RegexMatch(MatchObject):
     def strval(self, seen=set()):
         return self.matching_regex
     
-    def match(self, lst, depth=0, seen=set()):
-        if (self, lst) in seen:
-            return __return_item__(CouldNotFind, lst, self.options)
-        __pdebug__('Matching %s to %r' % (str(self), lst), depth, self.options.get('verbose', DEBUG_DEFAULT))
-        m = self.matching_regex.search(lst[0])
+    @packrat
+    def match(self, buf, pos=0, depth=0, seen=set(), state=None):
+        __pdebug__('Matching %s to %r', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self, __preview__(buf, pos)))
+        m = self.matching_regex.search(buf[pos])
         if m:
-            return __return_item__(m.groups(), lst[1:], self.options)
+            return __return_item__(m.groups(), pos + 1, self.options)
 
 class NotMatch(MatchObject):
+    terminal = True
+    
     def __init__(self, *matches, **arguments):
         self.matches = matches
         self.options = arguments
+        # NotMatch(orstring(...)) only has to look the next character up in a set.
+        self.charset = None
+        if matches and all([type(m) is CharsetMatch and not m.options.get('optional', False) and \
+                            not m.options.get('run', False) and not m.options.get('negate', False) for m in matches]):
+            self.charset = frozenset(''.join([m.chars for m in matches]))
     
     def copy(self, copied_items={}):
         return NotMatch(*[m.copy() for m in self.matches], **self.options)
@@ -524,22 +818,35 @@ class NotMatch(MatchObject):
             return self.options['name']
         return 'not %s' % ', '.join([m.strval(seen=seen|set([self])) for m in self.matches])
     
-    def match(self, lst, depth=0, seen=set()):
-        if (self, lst) in seen:
-            return __return_item__(CouldNotFind, lst, self.options)
-        __pdebug__('Matching %s to %r' % (str(self), lst), depth, self.options.get('verbose', DEBUG_DEFAULT))
+    def first(self, seen=set()):
+        return None, self.options.get('advance', 1) == 0 or self.options.get('optional', False)
+    
+    @packrat
+    def match(self, buf, pos=0, depth=0, seen=set(), state=None):
+        __pdebug__('Matching %s to %r', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self, __preview__(buf, pos)))
+        
+        if self.charset is not None:
+            advance_amount = self.options.get('advance', 1)
+            if len(buf) - pos >= advance_amount and (pos == len(buf) or buf[pos] not in self.charset):
+                return __return_item__(buf[pos:pos + advance_amount], pos + advance_amount, self.options)
+            return __return_item__(CouldNotFind, pos, self.options)
         
-        ret = [m.match(lst, depth=depth+1, seen=seen|set([(self, lst)])) for m in self.matches]
+        if state is not None:
+            # The children failing is what a NotMatch wants, so it's not what the parse expected.
+            mark = state.furthest, list(state.expected)
+        ret = [m.match(buf, pos, depth=depth+1, seen=seen, state=state) for m in self.matches]
+        if state is not None:
+            state.furthest, state.expected = mark
         #action, new_lst = self.matching_match.match(lst, depth=depth+1, seen=seen+[(self,lst)])
-        if all([type(action) is CouldNotFindType for action, new_lst in ret]):
+        if all([type(action) is CouldNotFindType for action, new_pos in ret]):
             advance_amount = self.options.get('advance', 1)
-            #print advance_amount, len(lst)
-            if len(lst) >= advance_amount:
-                return __return_item__(lst[0:advance_amount], lst[advance_amount:], self.options)
+            #print advance_amount, len(buf) - pos
+            if len(buf) - pos >= advance_amount:
+                return __return_item__(buf[pos:pos + advance_amount], pos + advance_amount, self.options)
         
         #print ret
-        __pdebug__('%s to %r failed' % (str(self), lst), depth, self.options.get('verbose', DEBUG_DEFAULT))
-        return __return_item__(CouldNotFind, lst, self.options)
+        __pdebug__('%s to %r failed', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self, __preview__(buf, pos)))
+        return __return_item__(CouldNotFind, pos, self.options)
 
 def atom(item, **arguments):
     return ValueMatch(item, **arguments)
@@ -550,8 +857,65 @@ def StringMatch(s, **arguments):
 
 def orstring(s, **arguments):
     arguments['combine'] = arguments.get('combine', True)
-    l = [atom(c) for c in s]
-    return OrMatch(*l, **arguments)
+    return CharsetMatch(s, **arguments)
+
+def __charclass__(chars, negate=False):
+    """ Returns a regular expression character class matching any of chars. """
+    if not chars:
+        return '[\\s\\S]' if negate else '(?!)'
+    return '[%s%s]' % ('^' if negate else '', ''.join(['\\' + c if c in '\\]^-' else c for c in chars]))
+
+class CharsetMatch(MatchObject):
+    """ Matches one character out of chars with a set lookup, giving the same [char] result as an
+    OrMatch of atoms.  With the run option it instead consumes the longest run of such characters
+    (at least min and at most max of them) and gives the run as one string, like Word used to.  The
+    negate option matches characters that are not in chars.
+    """
+    terminal = True
+    
+    def __init__(self, chars, **arguments):
+        self.chars = chars
+        self.charset = frozenset(chars)
+        self.options = arguments
+        self.negate = arguments.get('negate', False)
+        self.run_regex = re.compile(__charclass__(chars, self.negate) + '*')
+    
+    def copy(self, copied_items={}):
+        return CharsetMatch(self.chars, **self.options)
+    
+    def __str__(self):
+        return self.strval()
+    
+    def strval(self, seen=set()):
+        if self.options.get('nameonly', NAME_ONLY_DEFAULT) and 'name' in self.options:
+            return self.options['name']
+        return '[%s%s]%s' % ('^' if self.negate else '', self.chars, '+' if self.options.get('run', False) else '')
+    
+    def first(self, seen=set()):
+        nullable = self.options.get('optional', False) or \
+                   (self.options.get('run', False) and self.options.get('min', 0) == 0)
+        return (None if self.negate else self.charset), nullable
+    
+    @packrat
+    def match(self, buf, pos=0, depth=0, seen=set(), state=None):
+        __pdebug__('Matching %s to %r', depth, self.options.get('verbose', DEBUG_DEFAULT), atom=True, args=(self, __preview__(buf, pos)))
+        
+        if self.options.get('run', False):
+            try:
+                end = self.run_regex.match(buf, pos).end()
+            except TypeError:
+                # Not a character buffer, so scan it item by item.
+                end = pos
+                while end < len(buf) and (buf[end] in self.charset) != self.negate:
+                    end += 1
+            
+            if self.options.get('min', 0) <= end - pos <= self.options.get('max', float('inf')):
+                return __return_item__(buf[pos:end], end, self.options)
+        elif pos < len(buf) and (buf[pos] in self.charset) != self.negate:
+            return __return_item__([buf[pos]], pos + 1, self.options)
+        
+        __pdebug__('Match %s failed', depth, self.options.get('verbose', DEBUG_DEFAULT), atom=True, args=(self,))
+        return __return_item__(CouldNotFind, pos, self.options)
 
 class Combine(MatchObject):
     def __init__(self, match, **arguments):
@@ -571,15 +935,20 @@ class Combine(MatchObject):
             return self.options['name']
         return 'Combine(%s)' % self.thismatch.strval(seen=seen | set([self]))
     
-    def match(self, lst, depth=0, seen=set()):
-        if (self, lst) in seen:
-            return __return_item__(CouldNotFind, lst, self.options)
-        __pdebug__('Matching %s to %r' % (str(self), lst), depth, self.options.get('verbose', DEBUG_DEFAULT))
+    def first(self, seen=set()):
+        if self in seen:
+            return None, True
+        chars, nullable = self.thismatch.first(seen=seen | set([self]))
+        return chars, nullable or self.options.get('optional', False)
+    
+    @packrat
+    def match(self, buf, pos=0, depth=0, seen=set(), state=None):
+        __pdebug__('Matching %s to %r', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self, __preview__(buf, pos)))
 
-        ret = self.thismatch.match(lst, depth=depth+1, seen=seen|set([(self, lst)]))
+        ret = self.thismatch.match(buf, pos, depth=depth+1, seen=seen, state=state)
         if isinstance(ret, CouldNotFindType):
-            __pdebug__('%s to %r failed' % (str(self), lst), depth, self.options.get('verbose', DEBUG_DEFAULT))
-            return __return_item__(CouldNotFind, lst, self.options)
+            __pdebug__('%s to %r failed', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self, __preview__(buf, pos)))
+            return __return_item__(CouldNotFind, pos, self.options)
         
         ret_object, remainder = ret
         options = {
@@ -589,22 +958,426 @@ class Combine(MatchObject):
         return __return_item__(ret_object, remainder, options)
 
 def Word(s, **arguments):
-    arguments['combine'] = arguments.get('combine', True)
+    arguments.pop('combine', None)
     arguments['min'] = 1
-    l = [atom(c) for c in s]
-    return Combine(StarMatch(OrMatch(*l, combine=True), **arguments))
+    return CharsetMatch(s, run=True, **arguments)
+
+# ---------------------------------------------------------------------------- #
+# Grammar Compiler                                                             #
+# ---------------------------------------------------------------------------- #
+# Subtrees that only match characters (no FunctionMatch, TypeMatch, mode functions, ...) are
+# lowered to one regular expression so they run inside the re engine.  PEG semantics are kept by
+# making every star, choice and optional atomic with the (?=(?P<g>...))(?P=g) idiom, so the regex
+# can never backtrack into something the interpreted matcher would have committed to.
+
+class Lowering(object):
+    """ The regular expression form of a matcher.  item(lowering, m) rebuilds the raw item the
+    interpreted matcher would have produced from the regex match m, and defaults holds options the
+    matcher applies on top of its own (Combine's joining postprocess).
+    """
+    def __init__(self, node, pattern, minlen, maxlen, item, defaults=None, atomic=False, text=False):
+        self.node = node
+        self.pattern = pattern
+        self.minlen = minlen
+        self.maxlen = maxlen
+        self.item = item
+        self.options = copydict(defaults or {})
+        self.options.update(node.options)
+        self.atomic = atomic
+        self.needs_text = text
+        self.group = None
+        self.optional = False
+    
+    def wrap(self, names, evaluated=True, group=False, optional=True):
+        """ Returns the pattern to embed in a parent, or None if it can't be embedded.  A named group
+        is added when the item needs the matched text, when the parent needs to know whether this
+        branch matched, or to make the pattern atomic.
+        """
+        self.optional = optional and self.options.get('optional', False)
+        if self.optional and self.minlen == 0:
+            # An empty match could not be told apart from a skipped optional.
+            return None
+        
+        if not (self.optional or self.atomic or group or (evaluated and self.needs_text)):
+            return '(?:%s)' % self.pattern
+        
+        self.group = 'g%d' % names.next()
+        if self.optional:
+            return '(?=(?P<%s>(?:%s)?))(?P=%s)' % (self.group, self.pattern, self.group)
+        if self.atomic:
+            return '(?=(?P<%s>%s))(?P=%s)' % (self.group, self.pattern, self.group)
+        return '(?P<%s>%s)' % (self.group, self.pattern)
+    
+    def text(self, m):
+        return m.group(self.group)
+    
+    def matched(self, m):
+        return m.group(self.group) is not None
+    
+    def contribute(self, m, lst):
+        """ Applies the action the interpreted matcher would have returned to lst. """
+        if self.optional and not m.group(self.group):
+            return lst
+        action, pos = __return_item__(self.item(self, m), 0, self.options)
+        return action(lst)
+
+def __literal_atom__(node):
+    return type(node) is ValueMatch and not node.options and \
+           isinstance(node.matchingValue, str) and len(node.matchingValue) == 1
+
+def __named__(options):
+    return 'name' in options and not options.get('ignorename', IGNORE_NAME_DEFAULT)
+
+def __contribution_kind__(node):
+    """ 'chars' if node always contributes list(matched text), 'hidden' if it contributes nothing,
+    otherwise None.  Used to rebuild a star's result from the text it matched.
+    """
+    options = node.options
+    if options.get('optional', False) or 'postprocess' in options or __named__(options):
+        return None
+    if options.get('hide', False):
+        return 'hidden'
+    
+    combine = options.get('combine', False)
+    if type(node) is ValueMatch:
+        return None if combine else 'chars'
+    if type(node) is NotMatch:
+        return None if combine or options.get('advance', 1) != 1 else 'chars'
+    if combine and type(node) in (OrMatch, LinearMatch):
+        if all([__contribution_kind__(i) == 'chars' for i in node.items]):
+            return 'chars'
+    if type(node) is CharsetMatch and combine and not options.get('run', False):
+        return 'chars'
+    if combine and type(node) is StarMatch and node.starMatch is not None:
+        if __contribution_kind__(node.starMatch) == 'chars':
+            return 'chars'
+    return None
+
+def __may_be_empty__(node):
+    """ True if node can succeed while contributing nothing, which OrMatch treats as a failure. """
+    options = node.options
+    if options.get('optional', False) or options.get('hide', False):
+        return True
+    if not options.get('combine', False):
+        return False
+    if 'postprocess' in options or __named__(options):
+        return True
+    if type(node) is LinearMatch:
+        return all([__may_be_empty__(i) for i in node.items])
+    if type(node) is StarMatch:
+        return options.get('min', 0) == 0
+    return type(node) not in (OrMatch, ValueMatch, CharsetMatch, NotMatch, Combine, CompiledMatch)
+
+def __lower__(node, names, seen=frozenset()):
+    """ Returns a Lowering for node, or None if node can't be expressed as a regular expression
+    with the same results.
+    """
+    if node is None or node in seen or node.options.get('verbose', False):
+        return None
+    seen = seen | set([node])
+    options = node.options
+    
+    if type(node) is CompiledMatch:
+        return __lower__(node.source, names, seen)
+    
+    if type(node) is ValueMatch:
+        if not isinstance(node.matchingValue, str) or len(node.matchingValue) != 1:
+            return None
+        value = node.matchingValue
+        return Lowering(node, re.escape(value), 1, 1, lambda low, m: value)
+    
+    if type(node) is CharsetMatch:
+        charclass = __charclass__(node.chars, node.negate)
+        if not options.get('run', False):
+            return Lowering(node, charclass, 1, 1, lambda low, m: [low.text(m)], text=True)
+        if 'max' in options:
+            return None
+        minimum = options.get('min', 0)
+        quantifier = {0: '*', 1: '+'}.get(minimum, '{%d,}' % minimum)
+        return Lowering(node, charclass + quantifier, minimum, None, lambda low, m: low.text(m), atomic=True, text=True)
+    
+    if type(node) is OrMatch:
+        if options.get('mode', 'first') != 'first' or not node.items:
+            return None
+        if all([__literal_atom__(i) for i in node.items]):
+            chars = ''.join([i.matchingValue for i in node.items])
+            return Lowering(node, __charclass__(chars), 1, 1, lambda low, m: [low.text(m)], text=True)
+        
+        children = [__lower__(i, names, seen) for i in node.items]
+        if None in children or any([c.minlen == 0 or __may_be_empty__(c.node) for c in children]):
+            return None
+        patterns = [c.wrap(names, group=True) for c in children]
+        if None in patterns:
+            return None
+        
+        def item(low, m):
+            for c in children:
+                if c.matched(m):
+                    return c.contribute(m, [])
+        maxlen = None if None in [c.maxlen for c in children] else max([c.maxlen for c in children])
+        return Lowering(node, '|'.join(patterns), min([c.minlen for c in children]), maxlen, item, atomic=True)
+    
+    if type(node) is LinearMatch:
+        children = [__lower__(i, names, seen) for i in node.items]
+        if not children or None in children:
+            return None
+        patterns = [c.wrap(names) for c in children]
+        if None in patterns:
+            return None
+        
+        def item(low, m):
+            lst = []
+            for c in children:
+                lst = c.contribute(m, lst)
+            return lst
+        maxlen = None if None in [c.maxlen for c in children] else sum([c.maxlen for c in children])
+        return Lowering(node, ''.join(patterns), sum([c.minlen for c in children]), maxlen, item)
+    
+    if type(node) is StarMatch:
+        child = __lower__(node.starMatch, names, seen)
+        kind = __contribution_kind__(node.starMatch) if child is not None else None
+        minimum = options.get('min', 0)
+        # StarMatch checks min and max against the length of its result list, which is only the
+        # repetition count when every repetition contributes exactly one character.
+        if kind is None or 'max' in options or child.minlen == 0 or \
+           (minimum and (kind == 'hidden' or child.maxlen != 1)):
+            return None
+        pattern = child.wrap(names, evaluated=False)
+        if pattern is None:
+            return None
+        
+        quantifier = {0: '*', 1: '+'}.get(minimum, '{%d,}' % minimum)
+        if kind == 'chars':
+            item = lambda low, m: list(low.text(m))
+        else:
+            item = lambda low, m: []
+        return Lowering(node, pattern + quantifier, child.minlen * minimum, None, item, atomic=True, text=True)
+    
+    if type(node) is NotMatch:
+        children = [__lower__(i, names, seen) for i in node.matches]
+        if None in children:
+            return None
+        patterns = [c.wrap(names, evaluated=False) for c in children]
+        if None in patterns:
+            return None
+        
+        advance = options.get('advance', 1)
+        pattern = ''.join(['(?!%s)' % p for p in patterns]) + '[\\s\\S]' * advance
+        return Lowering(node, pattern, advance, advance, lambda low, m: low.text(m), text=True)
+    
+    if type(node) is Combine:
+        child = __lower__(node.thismatch, names, seen)
+        if child is None:
+            return None
+        pattern = child.wrap(names)
+        if pattern is None:
+            return None
+        
+        defaults = {'postprocess': lambda r: general_sum(r([]))}
+        item = lambda low, m: lambda lst: child.contribute(m, lst)
+        return Lowering(node, pattern, child.minlen, child.maxlen, item, defaults=defaults)
+    
+    return None
+
+class CompiledMatch(MatchObject):
+    """ A character-only subtree that compile_grammar lowered to a single regular expression.  It
+    gives the same results as the subtree it replaces.
+    """
+    terminal = True
+    
+    def __init__(self, source, **arguments):
+        self.source = source
+        names = itertools.count()
+        self.lowering = __lower__(source, names)
+        if self.lowering is None:
+            raise RuntimeError("%s can't be compiled to a regular expression" % source)
+        self.regex = re.compile(self.lowering.wrap(names, optional=False))
+        self.options = arguments if arguments else copydict(source.options)
+    
+    def copy(self, copied_items={}):
+        # The lowering and the regex are never modified, so copies share them.
+        cp = copy.copy(self)
+        cp.options = copydict(self.options)
+        return cp
+    
+    def __str__(self):
+        return self.strval()
+    
+    def strval(self, seen=set()):
+        return self.source.strval(seen=seen)
+    
+    def first(self, seen=set()):
+        chars, nullable = self.source.first(seen=seen)
+        return chars, nullable or self.options.get('optional', False)
+    
+    @packrat
+    def match(self, buf, pos=0, depth=0, seen=set(), state=None):
+        __pdebug__('Matching %s to %r', depth, self.options.get('verbose', DEBUG_DEFAULT), args=(self, __preview__(buf, pos)))
+        
+        try:
+            m = self.regex.match(buf, pos)
+        except TypeError:
+            # Not a character buffer (a list of tokens, say), so use the interpreted matcher.
+            return self.source.match(buf, pos, depth=depth, seen=seen, state=state)
+        
+        options = copydict(self.lowering.options)
+        options.update(self.options)
+        if m is None:
+            return __return_item__(CouldNotFind, pos, options)
+        return __return_item__(self.lowering.item(self.lowering, m), m.end(), options)
+
+def compile_grammar(match, compiled=None):
+    """ Returns a copy of match in which every subtree that can be lowered to a regular expression
+    is replaced by a CompiledMatch.  Subtrees that can't (FunctionMatch, TypeMatch, DelimitedMatch,
+    OrMatch with a mode other than 'first', ...) stay interpreted, with their children compiled.
+    """
+    if compiled is None:
+        compiled = {}
+    if match is None:
+        return None
+    if match in compiled:
+        return compiled[match]
+    
+    if type(match) not in (ValueMatch, CompiledMatch):
+        try:
+            compiled[match] = CompiledMatch(match)
+            return compiled[match]
+        except (RuntimeError, AssertionError, re.error):
+            # Not lowerable, or too many groups for the re module; compile the children instead.
+            pass
+    
+    clone = compiled[match] = match.clone()
+    __map_children__(clone, match, lambda m: compile_grammar(m, compiled))
+    return clone
+
+def __map_children__(clone, match, convert):
+    """ Points each child of clone at convert(child of match). """
+    if type(match) in (LinearMatch, OrMatch):
+        clone.items = tuple([convert(i) for i in match.items])
+    elif type(match) is StarMatch:
+        clone.starMatch = convert(match.starMatch)
+    elif type(match) is DelimitedMatch:
+        clone.item = convert(match.item)
+        clone.delimitor = convert(match.delimitor)
+    elif type(match) is NotMatch:
+        clone.matches = tuple([convert(m) for m in match.matches])
+    elif type(match) is Combine:
+        clone.thismatch = convert(match.thismatch)
+
+# ---------------------------------------------------------------------------- #
+# Frozen Grammars                                                              #
+# ---------------------------------------------------------------------------- #
+
+class FrozenOptions(dict):
+    """ The options of a frozen matcher.  They read like a dict, but changing them raises. """
+    def __readonly__(self, *args, **kwargs):
+        raise RuntimeError("A frozen grammar can't be changed")
+    
+    __setitem__ = __delitem__ = update = pop = popitem = clear = setdefault = __readonly__
+
+def __freeze__(match, frozen):
+    if match is None:
+        return None
+    if match in frozen:
+        return frozen[match]
+    
+    clone = frozen[match] = copy.copy(match)
+    __map_children__(clone, match, lambda m: __freeze__(m, frozen))
+    if type(match) is CompiledMatch:
+        # The source is what a CompiledMatch falls back on for buffers that aren't strings.
+        clone.source = __freeze__(match.source, frozen)
+    clone.options = FrozenOptions(match.options)
+    return clone
+
+class Grammar(object):
+    """ A frozen grammar, made by freeze().  It holds its own copy of the matcher tree with read-only
+    options, and every OrMatch dispatch table is built up front, so matching never writes to the tree.
+    It can be matched any number of times, from any number of threads at once, without copying
+    anything: each call keeps its state in a ParseState of its own.  Fluent calls on root give
+    ordinary, unfrozen matchers again.
+    """
+    def __init__(self, match, compiled=False):
+        if compiled:
+            match = compile_grammar(match)
+        frozen = {}
+        self.root = __freeze__(match, frozen)
+        for node in frozen.values():
+            if type(node) is OrMatch:
+                node.dispatch = None
+                node.viable('', 0)
+    
+    def __str__(self):
+        return str(self.root)
+    
+    def match(self, buf, pos=0, packrat=False):
+        """ Matches buf from pos.  Returns (action, end position) like MatchObject.match. """
+        return self.root.match(buf, pos, state=ParseState(packrat=packrat))
+    
+    def parse(self, buf, packrat=False):
+        """ Matches all of buf like totalMatch.  Returns the result list or None. """
+        return totalMatch(buf, self.root, packrat=packrat)
+    
+    def iter_parse(self, buf, packrat=False, errors=None):
+        """ Yields the result of each item of a DelimitedMatch root in turn, so a big input is never
+        held as one result list and the first item is ready straight away.  The memo table is only
+        kept for one item at a time.  Syntax errors are added to errors as ParseErrors once the input
+        is used up, or raised as a RuntimeError if errors is None.  Only a root with the recover
+        option goes on after an error.
+        """
+        if type(self.root) is not DelimitedMatch:
+            raise RuntimeError("Only a DelimitedMatch grammar can be parsed item by item")
+        
+        state = ParseState(packrat=packrat)
+        end = 0
+        for action, end in self.root.iter_items(buf, 0, state=state):
+            if state.memo is not None:
+                state.memo.clear()
+            yield action([])
+        
+        if not state.errors and end < len(buf):
+            state.errors.append(state.error(end))
+        for error in state.errors:
+            if errors is None:
+                raise RuntimeError(str(error))
+            errors.append(error)
+    
+    def parse_with_errors(self, buf, packrat=False):
+        """ Like parse, but returns (result, errors), where errors is a list of ParseErrors and the
+        result is None if there are any.  A failed parse has one error at the furthest position a
+        matcher failed at, unless the grammar recovers from errors and lists all of them.
+        """
+        state = ParseState(packrat=packrat)
+        action, end = self.root.match(buf, 0, state=state)
+        if not state.errors and end == len(buf) and not isinstance(action, CouldNotFindType):
+            return action([]), []
+        if not state.errors:
+            state.errors.append(state.error(end))
+        return None, state.errors
+
+def freeze(match, compiled=False):
+    """ Returns a frozen Grammar for match, lowered with compile_grammar first if compiled is set.
+    match itself is left as it is.
+    """
+    return Grammar(match, compiled=compiled)
 
-def totalMatch(lst, match, **arguments):
-    match = match.copy()
-    match.options.update(arguments)
-    ret = match.match(lst)
+def totalMatch(buf, match, packrat=False, **arguments):
+    """ Matches all of buf, which can be a str, an mmap or a list of items, against match.  Returns
+    the result list, or None if the match failed or did not consume the whole buffer.
+    """
+    if isinstance(match, Grammar):
+        match = match.root
+    if arguments:
+        # Only the root gets the extra options, so only the root is copied.
+        match = match.clone()
+        match.options.update(arguments)
+    ret = match.match(buf, 0, state=ParseState(packrat=packrat))
     
     if ret is None:
         return False
     
-    retObject, remainder = ret
+    retObject, end = ret
 
-    if not remainder and not isinstance(retObject, CouldNotFindType):
+    if end == len(buf) and not isinstance(retObject, CouldNotFindType):
         return retObject([])
     else:
         return None
@@ -0,0 +1,450 @@
+""" A parsing virtual machine in the style of LPeg.  A MatchObject tree is compiled once into a flat
+list of instructions, which run in a single loop with an explicit backtrack stack instead of
+recursing through match().  Results are built from the captures with the same __return_item__
+rules, so a Program gives exactly what totalMatch gives for the same grammar.
+
+By default a matcher's action is built as soon as it succeeds, so postprocess functions run at the
+same points as in totalMatch, including inside alternatives that are abandoned later, predicates
+and delimiters.  A Program compiled with lazy=True only builds the actions of the parts of the input
+that end up in the result, from the capture list once the match is over.  A postprocess that raises
+inside an abandoned alternative then no longer aborts the parse, so the two only agree for grammars
+whose postprocess functions always succeed and have no side effects.
+
+Matchers the machine has no instructions for (FunctionMatch, RegexMatch, CompiledMatch,
+OrMatch with a mode other than 'first', stars with min or max, ...) are run through their own match()
+by the NODE instruction, so any grammar can be compiled.
+"""
+
+from parser import *
+from parser import __return_item__, __may_be_empty__, __keep__
+
+# Opcodes.  Every instruction is a tuple of (opcode, arg1, arg2).
+CHAR = 0        # CHAR c: match the item c
+SET = 1         # SET charset negate: match one item in (or, if negate, not in) charset
+SPAN = 2        # SPAN node min: match a CharsetMatch run
+ANY = 3         # ANY n: match any n items
+CHOICE = 4      # CHOICE label: push a backtrack entry that resumes at label
+COMMIT = 5      # COMMIT label: pop the top backtrack entry and jump to label
+FAILTWICE = 6   # FAILTWICE: pop the top backtrack entry, then fail
+PROGRESS = 7    # PROGRESS: fail if nothing was consumed since the top backtrack entry
+CALL = 8        # CALL label checked: call a rule; checked rules fail when re-entered at the same position
+RETURN = 9      # RETURN: return from a rule
+OPEN = 10       # OPEN node: start the capture of node, or of a group of captures if node is None
+CLOSE = 11      # CLOSE node: end the capture of node
+FULL = 12       # FULL node n: capture node over the last n items
+NODE = 13       # NODE node capture: run node.match() and capture its action
+END = 14        # END: the match succeeded
+TYPE = 15       # TYPE types: match one item whose type is in types
+
+# Captured in place of a node whose action is built and then dropped, like a delimiter's.
+DISCARD = object()
+
+OPCODE_NAMES = ['CHAR', 'SET', 'SPAN', 'ANY', 'CHOICE', 'COMMIT', 'FAILTWICE', 'PROGRESS', 'CALL',
+                'RETURN', 'OPEN', 'CLOSE', 'FULL', 'NODE', 'END', 'TYPE']
+
+def __children__(node):
+    """ Returns the matchers node refers to. """
+    if type(node) in (LinearMatch, OrMatch):
+        return list(node.items)
+    if type(node) is StarMatch:
+        return [node.starMatch] if node.starMatch is not None else []
+    if type(node) is DelimitedMatch:
+        return [node.item, node.delimitor]
+    if type(node) is NotMatch:
+        return list(node.matches)
+    if type(node) is Combine:
+        return [node.thismatch]
+    return []
+
+def __recursive_nodes__(root):
+    """ Returns the set of nodes that can reach themselves. """
+    recursive = set()
+    done = set()
+    def visit(node, path):
+        if node in path:
+            recursive.add(node)
+            return
+        if node in done:
+            return
+        path.add(node)
+        for child in __children__(node):
+            visit(child, path)
+        path.remove(node)
+        done.add(node)
+    visit(root, set())
+    return recursive
+
+class Program(object):
+    """ A grammar compiled to machine instructions.  If lazy is True, actions are only built for
+    what ends up in the result.
+    """
+    def __init__(self, root, lazy=False):
+        self.root = root
+        self.lazy = lazy
+        self.code = []
+        self.rules = {}
+        self.pending = []
+        self.calls = []
+        self.recursive = __recursive_nodes__(root)
+
+        self.call(root, True)
+        self.emit(END)
+        # Rules are laid out one after another behind the entry point, each ending in RETURN.
+        while self.pending:
+            node, capture = key = self.pending.pop(0)
+            self.rules[key] = len(self.code)
+            self.rule(node, capture)
+        for index, key in self.calls:
+            self.patch(index, self.rules[key])
+        del self.pending, self.calls
+
+    def emit(self, opcode, arg1=None, arg2=None):
+        self.code.append((opcode, arg1, arg2))
+        return len(self.code) - 1
+
+    def patch(self, index, label):
+        opcode, arg1, arg2 = self.code[index]
+        self.code[index] = (opcode, label, arg2)
+
+    def call(self, node, capture):
+        """ Emits a call of the rule for node.  In a lazy Program, rules used inside predicates and
+        for delimiters are compiled without captures.
+        """
+        key = (node, capture)
+        if key not in self.rules:
+            self.rules[key] = None
+            self.pending.append(key)
+        self.calls.append((self.emit(CALL, None, node in self.recursive), key))
+
+    def rule(self, node, capture):
+        optional = node.options.get('optional', False)
+        if optional:
+            choice = self.emit(CHOICE)
+        self.body(node, capture)
+        if optional:
+            commit = self.emit(COMMIT)
+            self.patch(choice, len(self.code))
+            self.patch(commit, len(self.code))
+        self.emit(RETURN)
+
+    def body(self, node, capture):
+        """ Emits the instructions for node itself, without its optional handling. """
+        kind = type(node)
+
+        if kind is ValueMatch:
+            self.emit(CHAR, node.matchingValue)
+            if capture:
+                self.emit(FULL, node, 1)
+
+        elif kind is TypeMatch:
+            self.emit(TYPE, node.matching_types)
+            if capture:
+                self.emit(FULL, node, 1)
+
+        elif kind is CharsetMatch and not node.options.get('run', False):
+            self.emit(SET, node.charset, node.negate)
+            if capture:
+                self.emit(FULL, node, 1)
+
+        elif kind is CharsetMatch:
+            if capture:
+                self.emit(OPEN, node)
+            self.emit(SPAN, node, node.options.get('min', 0))
+            if capture:
+                self.emit(CLOSE, node)
+
+        elif kind is LinearMatch and node.items:
+            if capture:
+                self.emit(OPEN, node)
+            for item in node.items:
+                self.call(item, capture)
+            if capture:
+                self.emit(CLOSE, node)
+
+        elif kind is OrMatch and node.items and node.options.get('mode', 'first') == 'first' and \
+             not any([__may_be_empty__(item) for item in node.items]):
+            if capture:
+                self.emit(OPEN, node)
+            commits = []
+            for item in node.items[:-1]:
+                choice = self.emit(CHOICE)
+                self.call(item, capture)
+                commits.append(self.emit(COMMIT))
+                self.patch(choice, len(self.code))
+            self.call(node.items[-1], capture)
+            for commit in commits:
+                self.patch(commit, len(self.code))
+            if capture:
+                self.emit(CLOSE, node)
+
+        elif kind is StarMatch and node.starMatch is not None and \
+             node.options.get('min', 0) == 0 and 'max' not in node.options:
+            if capture:
+                self.emit(OPEN, node)
+            loop = self.emit(CHOICE)
+            self.call(node.starMatch, capture)
+            self.emit(PROGRESS)
+            self.emit(COMMIT, loop)
+            self.patch(loop, len(self.code))
+            if capture:
+                self.emit(CLOSE, node)
+
+        elif kind is DelimitedMatch and 'recover' not in node.options:
+            # Each item is captured as a group, since an item can match without contributing.
+            if capture:
+                self.emit(OPEN, node)
+                self.emit(OPEN, None)
+            self.call(node.item, capture)
+            if capture:
+                self.emit(CLOSE, None)
+            loop = self.emit(CHOICE)
+            if capture and not self.lazy:
+                self.emit(OPEN, DISCARD)
+                self.call(node.delimitor, True)
+                self.emit(CLOSE, DISCARD)
+            else:
+                self.call(node.delimitor, False)
+            if capture:
+                self.emit(OPEN, None)
+            self.call(node.item, capture)
+            if capture:
+                self.emit(CLOSE, None)
+            self.emit(COMMIT, loop)
+            self.patch(loop, len(self.code))
+            if capture:
+                self.emit(CLOSE, node)
+
+        elif kind is NotMatch:
+            for match in node.matches:
+                choice = self.emit(CHOICE)
+                # Whatever the predicate captures is dropped when it backtracks.
+                self.call(match, capture and not self.lazy)
+                self.emit(FAILTWICE)
+                self.patch(choice, len(self.code))
+            advance = node.options.get('advance', 1)
+            self.emit(ANY, advance)
+            if capture:
+                self.emit(FULL, node, advance)
+
+        elif kind is Combine:
+            if capture:
+                self.emit(OPEN, node)
+            self.call(node.thismatch, capture)
+            if capture:
+                self.emit(CLOSE, node)
+
+        else:
+            # The optional handling is done by the rule, so run the node as if it were required.
+            if node.options.get('optional', False):
+                node = node.clone().set_option('optional', False)
+            self.emit(NODE, node, capture)
+
+    def dump(self):
+        """ Returns a listing of the program. """
+        lines = []
+        for index, (opcode, arg1, arg2) in enumerate(self.code):
+            args = ' '.join([('%r' % a)[:40] for a in (arg1, arg2) if a is not None])
+            lines.append('%4d  %-9s %s' % (index, OPCODE_NAMES[opcode], args))
+        return '\n'.join(lines)
+
+    def match(self, buf, pos=0):
+        """ Matches buf from pos.  Returns (action, end position) like MatchObject.match. """
+        code = self.code
+        eager = not self.lazy
+        length = len(buf)
+        captures = []
+        backtrack = []
+        calls = []
+        active = set()
+        start = pos
+        pc = 0
+
+        while True:
+            opcode, arg1, arg2 = code[pc]
+
+            if opcode == CALL:
+                if arg2:
+                    # Re-entering a rule at the same position fails, like the seen set.
+                    key = (arg1, pos)
+                    if key in active:
+                        pc = -1
+                    else:
+                        active.add(key)
+                        calls.append((pc + 1, key))
+                        pc = arg1
+                else:
+                    calls.append((pc + 1, None))
+                    pc = arg1
+            elif opcode == RETURN:
+                pc, key = calls.pop()
+                if key is not None:
+                    active.discard(key)
+            elif opcode == CHAR:
+                if pos < length and buf[pos] == arg1:
+                    pos += 1
+                    pc += 1
+                else:
+                    pc = -1
+            elif opcode == SET:
+                if pos < length and (buf[pos] in arg1) != arg2:
+                    pos += 1
+                    pc += 1
+                else:
+                    pc = -1
+            elif opcode == TYPE:
+                if pos < length and type(buf[pos]) in arg1:
+                    pos += 1
+                    pc += 1
+                else:
+                    pc = -1
+            elif opcode == CHOICE:
+                backtrack.append((arg1, pos, len(captures), len(calls)))
+                pc += 1
+            elif opcode == COMMIT:
+                backtrack.pop()
+                pc = arg1
+            elif opcode == OPEN:
+                captures.append((OPEN, arg1, pos))
+                pc += 1
+            elif opcode == CLOSE:
+                if eager:
+                    # The node's children have all been replaced by their actions already, so its
+                    # own action replaces everything back to its OPEN.
+                    index = len(captures) - 1
+                    while captures[index][0] != OPEN:
+                        index -= 1
+                    opened = captures[index][2]
+                    actions = [capture[1] for capture in captures[index + 1:]]
+                    del captures[index:]
+                    if arg1 is not DISCARD:
+                        captures.append((NODE, __action__(arg1, actions, buf, opened, pos), opened))
+                else:
+                    captures.append((CLOSE, arg1, pos))
+                pc += 1
+            elif opcode == FULL:
+                if eager:
+                    captures.append((NODE, __atom_action__(arg1, buf, pos - arg2), pos - arg2))
+                else:
+                    captures.append((FULL, arg1, pos - arg2))
+                pc += 1
+            elif opcode == PROGRESS:
+                pc = -1 if backtrack[-1][1] == pos else pc + 1
+            elif opcode == SPAN:
+                end = __span__(arg1, buf, pos)
+                if arg2 <= end - pos <= arg1.options.get('max', float('inf')):
+                    pos = end
+                    pc += 1
+                else:
+                    pc = -1
+            elif opcode == ANY:
+                if length - pos >= arg1:
+                    pos += arg1
+                    pc += 1
+                else:
+                    pc = -1
+            elif opcode == NODE:
+                action, end = arg1.match(buf, pos)
+                if type(action) is CouldNotFindType:
+                    pc = -1
+                else:
+                    if arg2:
+                        captures.append((NODE, action, pos))
+                    pos = end
+                    pc += 1
+            elif opcode == FAILTWICE:
+                backtrack.pop()
+                pc = -1
+            elif opcode == END:
+                return __evaluate__(buf, captures), pos
+
+            if pc < 0:
+                # Fail: resume at the most recent choice point.
+                if not backtrack:
+                    return CouldNotFind, start
+                pc, pos, capture_count, call_count = backtrack.pop()
+                del captures[capture_count:]
+                while len(calls) > call_count:
+                    ret, key = calls.pop()
+                    if key is not None:
+                        active.discard(key)
+
+    def parse(self, buf):
+        """ Matches all of buf like totalMatch.  Returns the result list or None. """
+        action, end = self.match(buf)
+        if end == len(buf) and not isinstance(action, CouldNotFindType):
+            return action([])
+        return None
+
+def __span__(node, buf, pos):
+    """ Returns the end of the run of node's characters starting at pos. """
+    try:
+        return node.run_regex.match(buf, pos).end()
+    except TypeError:
+        end = pos
+        while end < len(buf) and (buf[end] in node.charset) != node.negate:
+            end += 1
+        return end
+
+def __evaluate__(buf, captures):
+    """ Rebuilds the action of the root matcher from the capture list. """
+    stack = [[]]
+    opened = []
+    for capture in captures:
+        kind = capture[0]
+        if kind == OPEN:
+            stack.append([])
+            opened.append(capture)
+        elif kind == CLOSE:
+            actions = stack.pop()
+            kind, node, start = opened.pop()
+            stack[-1].append(__action__(node, actions, buf, start, capture[2]))
+        elif kind == FULL:
+            kind, node, start = capture
+            stack[-1].append(__atom_action__(node, buf, start))
+        else:
+            stack[-1].append(capture[1])
+
+    if not stack[0]:
+        # An optional root that didn't match contributes nothing.
+        return __keep__
+    return stack[0][0]
+
+def __atom_action__(node, buf, start):
+    if type(node) in (ValueMatch, TypeMatch):
+        item = buf[start]
+    elif type(node) is CharsetMatch:
+        item = [buf[start]]
+    else:
+        item = buf[start:start + node.options.get('advance', 1)]
+    return __return_item__(item, 0, node.options)[0]
+
+def __action__(node, actions, buf, start, end):
+    """ Returns the action node's match() would have returned, given the actions of its children. """
+    if node is None:
+        def group(lst):
+            for action in actions:
+                lst = action(lst)
+            return lst
+        return group
+
+    options = node.options
+    kind = type(node)
+    if kind in (LinearMatch, StarMatch):
+        item = []
+        for action in actions:
+            item = action(item)
+    elif kind is OrMatch:
+        item = actions[0]([])
+    elif kind is DelimitedMatch:
+        item = [action([]) for action in actions]
+    elif kind is Combine:
+        item = actions[0] if actions else __keep__
+        options = {'postprocess': lambda r: general_sum(r([]))}
+        options.update(node.options)
+    else:
+        item = buf[start:end]
+    return __return_item__(item, 0, options)[0]
+
+def compile(root, lazy=False):
+    """ Compiles a grammar into a Program.  See the module docstring for what lazy changes. """
+    return Program(root, lazy)
@@ -0,0 +1,11 @@
+.data 100
+.word 5, 7
+.space 8
+.word -1, 0x10
+.text
+ori $r7, $r0, 100
+lw $r2, 0($r7)
+lw $r3, 4($r7)
+lw $r4, 16($r7)
+add $r5, $r2, $r3
+add $r6, $r4, $r3
@@ -0,0 +1,108 @@
+""" Sampled simulation, which estimates the CPI of a long program without simulating every cycle.
+
+The program is run in periods.  Each one starts with a measurement window: the pipeline is warmed
+up by running some instructions pipelined and then the cycles taken by the next ones are counted.
+Then the pipeline is emptied (see Simulator.retire) and the rest of the period is skipped through
+in one of the fast modes, which don't count cycles.  The number of instructions skipped is random
+in each period, so that the windows don't all start at the same point of a loop and measure the
+same thing.  The CPI of the program is estimated as the ratio of the cycles counted in all the
+windows to their instructions, with a confidence interval from how much the windows differ from it.
+
+The registers and memory at the end are those of running the windows pipelined and the rest of
+the program in the fast mode, which only differ from running it all in one mode for programs the
+modes run differently.
+"""
+
+import math
+import random
+from simulator import BASE_MEMORY
+from translator import MAX_BLOCK_LENGTH
+
+class Sample(object):
+    """ The windows measured by a sampled run, each as (instructions, cycles), and the number of
+    instructions run in all.
+    """
+
+    def __init__(self, windows, instructions):
+        self.windows = windows
+        self.instructions = instructions
+
+    def detailed_instructions(self):
+        """ Returns the number of instructions in the measurement windows. """
+        return sum(instructions for instructions, cycles in self.windows)
+
+    def cpi(self):
+        """ Returns the estimated CPI, the cycles of all the windows over their instructions. """
+        if not self.windows:
+            raise RuntimeError("No windows were measured.")
+        return sum(cycles for instructions, cycles in self.windows) / float(self.detailed_instructions())
+
+    def interval(self, z=1.96):
+        """ Returns the half width of the confidence interval of cpi(), for the given number of
+        standard errors (1.96 for 95%), or None if fewer than two windows were measured.  The
+        standard error of the ratio comes from how far the cycles of each window are from the ones
+        the ratio gives for its instructions.
+        """
+        count = len(self.windows)
+        if count < 2:
+            return None
+        ratio = self.cpi()
+        variance = sum((cycles - ratio * instructions) ** 2 for instructions, cycles in self.windows) / (count - 1)
+        mean_instructions = self.detailed_instructions() / float(count)
+        return z * math.sqrt(variance / count) / mean_instructions
+
+    def cycles(self):
+        """ Returns the estimated number of cycles for the whole program. """
+        return self.cpi() * self.instructions
+
+def measure(windows, sim, start):
+    """ Adds the instructions and cycles sim has run since start, a pair of counts, to windows. """
+    instructions = sim.instructions_executed() - start[0]
+    if instructions:
+        windows.append((instructions, sim.cycles_executed() - start[1]))
+
+def run_sampled(sim, start_pc=BASE_MEMORY, window=1000, warmup=100, skip=20000, fast_mode='translated', seed=None):
+    """ Runs the program loaded in sim starting at PC start_pc with sampled simulation, and returns
+    the Sample.  Each period warms the pipeline up with warmup instructions, measures the next window
+    ones and skips between skip / 2 and skip * 3 / 2 more, the number chosen at random with the given
+    seed, in fast_mode, 'functional' or 'translated'.  The simulator is left in the mode it was in.
+    """
+    if fast_mode not in ('functional', 'translated'):
+        raise RuntimeError("Can't skip through a program in %s mode." % fast_mode)
+    rand = random.Random(seed)
+    mode = sim.mode
+    windows = []
+    begin = sim.instructions_executed(), sim.cycles_executed()
+    pc = start_pc
+    try:
+        while True:
+            sim.mode = 'pipelined'
+            sim.run_pipelined(pc, warmup)
+            if sim.finished():
+                break
+            start = sim.instructions_executed(), sim.cycles_executed()
+            sim.run_pipelined(sim.pc, window)
+            measure(windows, sim, start)
+            if sim.finished():
+                break
+            sim.retire()
+
+            sim.mode = fast_mode
+            skipped = rand.randint(skip // 2, skip + skip // 2)
+            stop = sim.instructions_executed() + skipped
+            if fast_mode == 'translated':
+                # Blocks are run whole, so the translated run stops short of the instruction chosen,
+                # and the last ones are run one at a time to get to it exactly.
+                sim.run_translated(sim.pc, skipped - MAX_BLOCK_LENGTH)
+            if not sim.finished():
+                sim.run_functional(sim.pc, stop - sim.instructions_executed())
+            if sim.finished():
+                break
+            pc = sim.pc
+    finally:
+        sim.mode = mode
+    # A program too short to have a window after warming up is measured whole, since it all ran
+    # pipelined.
+    if not windows:
+        measure(windows, sim, begin)
+    return Sample(windows, sim.instructions_executed())
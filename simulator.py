@@ -1,4 +1,13 @@
+import os
+import sys
+import mmap
+import struct
+from array import array
 from instructions import *
+from translator import translate_block
+from loops import LoopDetector
+import image
+import checkpoint
 
 # ---------------------------------------------------------------------------- #
 # The Simulator and Helper Functions                                           #
@@ -6,6 +15,11 @@ from instructions import *
 
 BASE_MEMORY = 0x1000
 
+# A pipelined simulator models every stage of every cycle.  A functional one runs the instructions
+# one at a time, which only gives the registers and memory at the end, but much faster.  A translated
+# one gives the same as a functional one, running whole blocks of instructions translated to Python.
+MODES = 'pipelined', 'functional', 'translated'
+
 def addr_check(func):
     """ Decorator for an instancemethod that takes in an address as its first argument.  This
     decorator will check if the address is at a word boundary and throw an exception if not.  If it
@@ -18,22 +32,168 @@ def addr_check(func):
     return wrapper
 
 
+# Memory is split into pages of 1 << PAGE_BITS words.
+PAGE_BITS = 10
+PAGE_WORDS = 1 << PAGE_BITS
+PAGE_MASK = PAGE_WORDS - 1
+
+class PagedMemory(object):
+    """ Sparse memory, indexed by word.  A page is only allocated when a word in it is first
+    written, and words that were never written read as 0.  Packed memory keeps each page in an array
+    of 32 bit words, and otherwise in a list.
+
+    Its length is the number of words up to the highest one written, or the number it was made
+    with if that's more.  The numbers of the pages written since dirty was last cleared are kept
+    in it, for incremental checkpoints.
+    """
+
+    def __init__(self, packed, words=0):
+        self.packed = packed
+        self.words = words
+        self.pages = {}
+        self.dirty = set()
+    
+    def page(self, number):
+        """ Returns the page with the given number, allocating it if it isn't yet. """
+        page = self.pages.get(number)
+        if page is None:
+            page = self.pages[number] = (array('I', [0]) if self.packed else [0]) * PAGE_WORDS
+        return page
+    
+    def __len__(self):
+        return self.words
+    
+    def __iter__(self):
+        for index in xrange(self.words):
+            yield self[index]
+    
+    def __getitem__(self, index):
+        page = self.pages.get(index >> PAGE_BITS)
+        if page is None:
+            return 0
+        return page[index & PAGE_MASK]
+    
+    def __setitem__(self, index, value):
+        number = index >> PAGE_BITS
+        self.page(number)[index & PAGE_MASK] = value
+        self.dirty.add(number)
+        if index >= self.words:
+            self.words = index + 1
+    
+    def store(self, index, words):
+        """ Copies the words, an array for packed memory, into memory starting at index. """
+        done = 0
+        while done < len(words):
+            start = (index + done) & PAGE_MASK
+            count = min(PAGE_WORDS - start, len(words) - done)
+            number = (index + done) >> PAGE_BITS
+            self.page(number)[start:start + count] = words[done:done + count]
+            self.dirty.add(number)
+            done += count
+        self.words = max(self.words, index + len(words))
+    
+    def page_numbers(self):
+        """ Returns the numbers of the pages that may hold words that aren't zero, in order. """
+        return sorted(self.pages)
+    
+    def read_page(self, number):
+        """ Returns the words of a page of packed memory, as an array. """
+        page = self.pages.get(number)
+        return page if page is not None else array('I', [0]) * PAGE_WORDS
+
+class MappedMemory(object):
+    """ Packed memory over the words of a mapped program image.  Words are read and written in
+    place, and memory past the end of the image is paged.
+    """
+    word = struct.Struct('<I')
+
+    def __init__(self, buf, offset, words):
+        self.buf = buf
+        self.offset = offset
+        self.words = words
+        self.extra = PagedMemory(packed=True)
+        self.dirty = set()
+    
+    def __len__(self):
+        return self.words + len(self.extra)
+    
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+    
+    def __getitem__(self, index):
+        if index < self.words:
+            return self.word.unpack_from(self.buf, self.offset + (index << 2))[0]
+        return self.extra[index - self.words]
+    
+    def __setitem__(self, index, value):
+        if index < self.words:
+            self.word.pack_into(self.buf, self.offset + (index << 2), value)
+        else:
+            self.extra[index - self.words] = value
+        self.dirty.add(index >> PAGE_BITS)
+    
+    def page_numbers(self):
+        return range((len(self) + PAGE_MASK) >> PAGE_BITS)
+    
+    def read_page(self, number):
+        start = number << PAGE_BITS
+        mapped = max(0, min(PAGE_WORDS, self.words - start))
+        words = array('I')
+        words.fromstring(self.buf[self.offset + (start << 2):self.offset + ((start + mapped) << 2)])
+        if sys.byteorder == 'big':
+            words.byteswap()
+        words.extend(self[index] for index in xrange(start + mapped, start + PAGE_WORDS))
+        return words
+
+class Latch(object):
+    """ The pipeline register holding what's in one stage: the instruction, the result it has put
+    there so far, whether the stage holds an instruction at all and the PC it was fetched from.
+    """
+    __slots__ = ('instruction', 'result', 'valid', 'pc')
+
+    def __init__(self):
+        self.clear()
+    
+    def clear(self):
+        self.instruction = None
+        self.result = None
+        self.valid = False
+        self.pc = None
+    
+    def __repr__(self):
+        return 'Latch(%s)' % self.instruction
+
+
 class Simulator(object):
     """ Represents a simulator. """
-    def __init__(self, verbose=False):
-        """ verbose=bool
+    def __init__(self, verbose=False, packed=False, mode='pipelined', extrapolate=False):
+        """ verbose=bool, packed=bool, mode=one of MODES, extrapolate=bool
 
         Initializes a simulator.  If the verbose flag is enabled, the simulator will print out a lot
-        of debug information.
+        of debug information.  If the packed flag is enabled, memory is an array of 32 bit words:
+        instructions are stored encoded and decoded again when they're fetched.  If the extrapolate
+        flag is enabled, the pipeline skips through the iterations of loops that have reached a
+        steady state (see loops.py), which gives the same registers, memory and counts.  It can only
+        be enabled in pipelined mode.
         """
+        if mode not in MODES:
+            raise RuntimeError("Unknown simulation mode %s." % mode)
+        if extrapolate and mode != 'pipelined':
+            raise RuntimeError("Loops can only be skipped through in pipelined mode, not %s mode." % mode)
         self.verbose = verbose
+        self.packed = packed
+        self.mode = mode
         self.pc = None
         self.registers = [0 for x in xrange(32)] # Initialize 32 registers.
         
-        # Set up the stage names and the pipeline and results data structures.
+        # Set up the stage names, and the handlers of the stages in the order they run each cycle.
         self.stages = 'fetch', 'decode', 'execute', 'memory', 'write'
-        self.pipeline = {}
-        self.results = {}
+        self.handlers = self.fetch, self.decode, self.execute, self.memory, self.write
+        self.loops = None
+        if extrapolate:
+            self.loops = LoopDetector(self)
+            self.handlers = self.handlers[:WRITE] + (self.write_and_detect,)
 
         self.reset()
     
@@ -41,10 +201,12 @@ class Simulator(object):
         """ Resets the simulator so that a new set of instructions can be loaded. """
         self.instruction_count = 0
         self.cycle_count = 0
+        self.text_end = BASE_MEMORY
         self.__stall = None
-        for stage in self.stages:
-            self.pipeline[stage] = None
-            self.results[stage] = None
+        # One latch per stage, indexed by FETCH to WRITE, and the number of them holding an
+        # instruction.
+        self.latches = [Latch() for stage in self.stages]
+        self.occupancy = 0
         
         self.reset_memory()
     
@@ -61,17 +223,62 @@ class Simulator(object):
         return self.cycles_executed() / float(self.instructions_executed())
     
     def stall(self, stage):
-        """ Stalls the pipeline at the given stage. """
+        """ Stalls the pipeline at the given stage, one of FETCH to MEMORY. """
         self.__stall = stage
     
+    def stalling(self):
+        """ Returns the stage the pipeline stalls at in the next cycle, or None. """
+        return self.__stall
+    
     def reset_memory(self):
-        """ Resets the memory to 4096 zero'd bytes. """
-        self.memory_data = [0 for _ in xrange(BASE_MEMORY >> 2)]
+        """ Resets the memory to 4096 zero'd bytes, which aren't allocated until they're written. """
+        self.memory_data = PagedMemory(self.packed, BASE_MEMORY >> 2)
+        self.checkpoint = None
+        self.clear_decoded()
+    
+    def clear_decoded(self):
+        """ Forgets everything worked out from the program in memory: the decoded instructions,
+        kept by their PC, the translated blocks, kept by the PC they start at, and the blocks each
+        word of memory is in.
+        """
+        self.decoded = {}
+        self.blocks = {}
+        self.block_words = {}
+        if self.loops is not None:
+            self.loops.forget()
+    
+    def invalidate(self, addr):
+        """ Forgets the decoded instruction and the translated blocks at addr / 4, since the
+        program wrote over it.
+        """
+        self.decoded.pop(addr << 2, None)
+        for entry in self.block_words.pop(addr, ()):
+            if self.verbose: print 'Invalidating the block at 0x%x' % entry
+            self.blocks.pop(entry, None)
+    
+    def decode_at(self, pc):
+        """ Returns the instruction at pc, decoding it the first time it's asked for.  Raises a
+        RuntimeError if the word there isn't an instruction.
+        """
+        instruction = self.decoded.get(pc)
+        if instruction is None:
+            instruction = self.read_word(pc)
+            if self.packed:
+                instruction = decode_instruction(instruction)
+            if not isinstance(instruction, Instruction):
+                raise RuntimeError("There's no instruction at 0x%x." % pc)
+            self.decoded[pc] = instruction
+        return instruction
     
     @addr_check
     def read_word(self, addr):
-        """ Reads a word from memory at addr. """
-        return self.memory_data[addr]
+        """ Reads a word from memory at addr.  Packed memory holds the words unsigned, so they're
+        read back as signed numbers.
+        """
+        word = self.memory_data[addr]
+        if not self.packed:
+            return word
+        return int(word - (1 << 32) if word & 0x80000000 else word)
     
     @addr_check
     def write_word(self, addr, word):
@@ -82,6 +289,8 @@ class Simulator(object):
 
         If word is a str, it must not be more than 4 bytes long.  The str will be converted to a
         number before being inserted into memory.
+
+        Packed memory keeps the low 32 bits of numbers, and encodes instructions.
         """
         if not isinstance(word, (int, long, Instruction, str)):
             raise RuntimeError("Can't put item of type %s into memory." % type(word))
@@ -94,10 +303,12 @@ class Simulator(object):
                 value += ord(char)
             word = value
         
-        while addr >= len(self.memory_data):
-            self.memory_data.append(0)
+        if self.packed:
+            word = encode_instruction(word) if isinstance(word, Instruction) else word & 0xffffffff
 
         self.memory_data[addr] = word
+        if BASE_MEMORY <= addr << 2 < self.text_end:
+            self.invalidate(addr)
     
     def memory_size(self):
         """ Returns the current memory size in bytes. """
@@ -106,26 +317,32 @@ class Simulator(object):
     def flush_after(self, from_stage):
         """ Flushes the pipeline after the given stage.
 
-        i.e. if the given stage is 'execute', it will flush the 'memory' and 'write' stages.
+        i.e. if the given stage is EXECUTE, it will flush the MEMORY and WRITE stages.
 
         NOTE: This function decrements the PC by 4.
         """
-        for stage in self.stages[self.stages.index(from_stage)+1:]:
-            if self.verbose: print 'Flushing %s' % self.pipeline[stage]
-            self.pipeline[stage] = self.results[stage] = None
-            self.pc -= 4
+        for latch in self.latches[from_stage + 1:]:
+            self.flush(latch)
     
     def flush_before(self, from_stage):
         """ Flushes the pipeline before the given stage.
 
-        i.e. if the given stage is 'execute', it will flush the 'fetch' and 'decode' stages.
+        i.e. if the given stage is EXECUTE, it will flush the FETCH and DECODE stages.
 
         NOTE: This function decrements the PC by 4.
         """
-        for stage in self.stages[:self.stages.index(from_stage)]:
-            if self.verbose: print 'Flushing %s' % self.pipeline[stage]
-            self.pipeline[stage] = self.results[stage] = None
-            self.pc -= 4
+        for latch in self.latches[:from_stage]:
+            self.flush(latch)
+    
+    def flush(self, latch):
+        if self.mode != 'pipelined':
+            # Nothing was fetched ahead of a jump, so there's nothing to flush or to take off the PC.
+            return
+        if self.verbose: print 'Flushing %s' % latch.instruction
+        if latch.valid:
+            self.occupancy -= 1
+        latch.clear()
+        self.pc -= 4
     
     def jump_to(self, addr):
         """ Sets the PC to addr + 4. """
@@ -139,98 +356,463 @@ class Simulator(object):
         if self.verbose: print 'PC is now %x' % self.pc
     
     def load(self, instructions):
-        """ Loads a set of instructions into memory. """
-        for idx, instruction in enumerate(instructions):
-            addr = idx * 4 + BASE_MEMORY
-            self.write_word(addr, instruction)
+        """ Loads a set of instructions into memory.  Packed memory can also be loaded with an array
+        of encoded instructions, which is copied in one go.
+        """
+        if not self.packed:
+            for idx, instruction in enumerate(instructions):
+                addr = idx * 4 + BASE_MEMORY
+                self.write_word(addr, instruction)
+            self.text_end = BASE_MEMORY + len(instructions) * 4
+            self.clear_decoded()
+            return
+        
+        if not isinstance(instructions, array):
+            instructions = array('I', [encode_instruction(instruction) for instruction in instructions])
+        start = BASE_MEMORY >> 2
+        self.memory_data.store(start, instructions)
+        self.text_end = BASE_MEMORY + len(instructions) * 4
+        self.clear_decoded()
+    
+    def load_data(self, addr, words):
+        """ Copies the array of words into memory at addr in one go.  Packed memory takes them as
+        they are, and otherwise they're read as signed numbers.
+        """
+        if addr & 0x3 != 0:
+            raise RuntimeError("Can't access memory at a non-word boundary.")
+        start = addr >> 2
+        if start < self.text_end >> 2 and start + len(words) > BASE_MEMORY >> 2:
+            raise RuntimeError("The data at 0x%x overlaps the program." % addr)
+        if not self.packed:
+            words = [int(word - (1 << 32) if word & 0x80000000 else word) for word in words]
+        
+        self.memory_data.store(start, words)
+    
+    def load_program(self, program):
+        """ Loads a directives.Program: its instructions, and then its data. """
+        self.load(program.text)
+        for addr, words in program.data:
+            self.load_data(addr, words)
+    
+    def load_image(self, path):
+        """ Loads a program image written by image.write_image into packed memory.  The file is
+        mapped copy-on-write and used as the memory, so nothing is read until it's needed and writes
+        don't change the file.
+        """
+        if not self.packed:
+            raise RuntimeError("Program images can only be loaded into packed memory.")
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        text_base, text_words, memory_words = image.read_header(buf)
+        if text_base != BASE_MEMORY:
+            raise RuntimeError("Programs have to start at 0x%x, not 0x%x." % (BASE_MEMORY, text_base))
+        
+        self.memory_data = MappedMemory(buf, image.HEADER.size, memory_words)
+        self.text_end = text_base + text_words * 4
+        self.checkpoint = None
+        self.clear_decoded()
+    
+    def save_checkpoint(self, path, incremental=False):
+        """ Saves the simulator as it is between cycles to a checkpoint at path, which
+        load_checkpoint can carry on from.  A full checkpoint has all of memory.  An incremental one
+        only has the pages written since the last checkpoint this simulator saved or loaded, and can
+        only be loaded on top of that one.  Only packed memory can be saved.
+        """
+        if not self.packed:
+            raise RuntimeError("Only packed memory can be saved to a checkpoint.")
+        if incremental and self.checkpoint is None:
+            raise RuntimeError("There's no checkpoint for an incremental one to be relative to.")
+        
+        # Each instruction in the pipeline is saved once, since the same one can be in more than
+        # one stage, with what it has put in its result and been forwarded.
+        instructions = []
+        indexes = {}
+        latches = []
+        for latch in self.latches:
+            if not latch.valid:
+                latches.append(None)
+                continue
+            instruction = latch.instruction
+            if id(instruction) not in indexes:
+                indexes[id(instruction)] = len(instructions)
+                instructions.append(instruction)
+            latches.append((indexes[id(instruction)], latch.result is not None, latch.pc))
+        saved = []
+        for instruction in instructions:
+            result = getattr(instruction, '_result', None)
+            forwarded = getattr(instruction, 'forwarded', None)
+            if forwarded is not None:
+                forwarded = dict((register.register_number, value) for register, value in forwarded.items())
+            saved.append((encode_instruction(instruction), result[1] if result is not None else None, forwarded))
+        
+        state = {
+            'pc': self.pc,
+            'registers': self.registers,
+            'instruction_count': self.instruction_count,
+            'cycle_count': self.cycle_count,
+            'text_end': self.text_end,
+            'stall': self.__stall,
+            'memory_words': len(self.memory_data),
+            'instructions': saved,
+            'latches': latches,
+        }
+        memory = self.memory_data
+        if incremental:
+            pages = [(number, memory.read_page(number)) for number in sorted(memory.dirty)]
+        else:
+            pages = [(number, memory.read_page(number)) for number in memory.page_numbers()]
+            pages = [(number, words) for number, words in pages if any(words)]
+        identity = os.urandom(8)
+        parent = self.checkpoint if incremental else checkpoint.NO_PARENT
+        checkpoint.write_checkpoint(path, identity, parent, state, pages, PAGE_WORDS)
+        self.checkpoint = identity
+        memory.dirty.clear()
+    
+    def load_checkpoint(self, path):
+        """ Carries on from the checkpoint at path, written by save_checkpoint, into packed memory.
+        An incremental checkpoint has to be loaded on top of the one it's relative to, with nothing
+        written to memory since.  A checkpoint saved with the pipeline full can only be loaded into
+        a pipelined simulator.
+        """
+        if not self.packed:
+            raise RuntimeError("Checkpoints can only be loaded into packed memory.")
+        identity, parent, state, pages = checkpoint.read_checkpoint(path, PAGE_WORDS)
+        if any(state['latches']) and self.mode != 'pipelined':
+            raise RuntimeError("The checkpoint was saved with the pipeline full, so it can only be run pipelined.")
+        if parent == checkpoint.NO_PARENT:
+            memory = PagedMemory(True)
+        elif parent != self.checkpoint or not isinstance(self.memory_data, PagedMemory) or self.memory_data.dirty:
+            raise RuntimeError("The incremental checkpoint %s has to be loaded on top of the one it's relative to." % path)
+        else:
+            memory = self.memory_data
+        for number, words in pages:
+            memory.pages[number] = words
+        memory.words = state['memory_words']
+        memory.dirty.clear()
+        
+        self.memory_data = memory
+        self.checkpoint = identity
+        self.clear_decoded()
+        self.pc = state['pc']
+        self.registers[:] = state['registers']
+        self.instruction_count = state['instruction_count']
+        self.cycle_count = state['cycle_count']
+        self.text_end = state['text_end']
+        self.__stall = state['stall']
+        
+        instructions = []
+        for word, result, forwarded in state['instructions']:
+            instruction = decode_instruction(word)
+            if result is not None:
+                instruction._result = instruction.destination(), result
+            if forwarded is not None:
+                forwarded = dict((decode_register(number), value) for number, value in forwarded.items())
+            instruction.forwarded = forwarded
+            instructions.append(instruction)
+        self.occupancy = 0
+        for latch, saved in zip(self.latches, state['latches']):
+            latch.clear()
+            if saved is not None:
+                index, has_result, latch.pc = saved
+                latch.instruction = instructions[index]
+                latch.result = latch.instruction._result if has_result else None
+                latch.valid = True
+                self.occupancy += 1
     
-    def run(self, start_pc=BASE_MEMORY):
-        """ Runs the set of instructions starting at PC start_pc. """
+    def run(self, start_pc=BASE_MEMORY, limit=None):
+        """ Runs the set of instructions starting at PC start_pc.  If limit is given, the run stops
+        once that many more instructions have been run (in translated mode, at the end of the block
+        that gets there), and can be carried on with run(sim.pc).  A pipelined run stops with the
+        pipeline as it is, so carrying on gives the same cycles as not stopping.
+        """
+        if self.mode == 'functional':
+            self.run_functional(start_pc, limit)
+        elif self.mode == 'translated':
+            self.run_translated(start_pc, limit)
+        else:
+            self.run_pipelined(start_pc, limit)
+        
+        if not self.finished():
+            print 'Execution stopped at 0x%x' % self.pc
+            return
+        print 'Execution finished'
+        if self.mode == 'pipelined':
+            print '%d instructions were run in %d cycles with a CPI of %.03f' % (self.instruction_count, self.cycle_count, self.cpi())
+            if self.loops is not None:
+                print '%d loop iterations were skipped' % self.loops.skipped
+        else:
+            print '%d instructions were run' % self.instruction_count
+        print self.registers
+        print '[', ' '.join(['0x%x' % r for r in self.registers]), ']'
+    
+    def run_pipelined(self, start_pc, limit=None):
+        """ Runs the pipeline a cycle at a time starting at PC start_pc, until it's empty or limit
+        instructions have been run.
+        """
+        stop = self.instruction_count + limit if limit is not None else None
         self.pc = start_pc
         # While the pipeline still has something in it, execute.
-        while self.pc == start_pc or any(self.pipeline[stage] is not None for stage in self.pipeline):
+        while self.pc == start_pc or self.occupancy:
             self.cycle()
             self.pc += 4
             if self.verbose: print hex(self.pc), self.registers
+            if stop is not None and self.instruction_count >= stop and self.occupancy:
+                break
+    
+    def retire(self):
+        """ Empties the pipeline between cycles, so the program can be carried on with in another
+        mode.  The instructions that have executed are finished one at a time, like run_functional
+        runs them, and the ones that haven't are dropped and the PC put back to the first of them.
+        No cycles are counted for it.
+        """
+        latches = self.latches
+        executed = self.__stall is None
+        # The program carries on from the oldest instruction that hasn't executed, or from the one
+        # that would be fetched next if there isn't one.
+        pc = self.pc
+        for stage in (FETCH, DECODE) if executed else (FETCH, DECODE, EXECUTE):
+            if latches[stage].valid:
+                pc = latches[stage].pc
         
-        print 'Execution finished'
-        print '%d instructions were run in %d cycles with a CPI of %.03f' % (self.instruction_count, self.cycle_count, self.cpi())
-        print self.registers
-        print '[', ' '.join(['0x%x' % r for r in self.registers]), ']'
+        # The instruction in the memory stage only has to write its register, and goes first.
+        latch = latches[MEMORY]
+        if latch.valid:
+            if self.verbose: print 'Retiring %s' % latch.instruction
+            latch.instruction.write(self)
+            self.instruction_count += 1
+        latch = latches[EXECUTE]
+        if latch.valid and executed:
+            instruction = latch.instruction
+            if self.verbose: print 'Retiring %s' % instruction
+            # Everything before it has written its registers now, so it reads them from there.
+            instruction.forwarded = None
+            instruction.memory(self)
+            instruction.write(self)
+            self.instruction_count += 1
+        
+        for latch in latches:
+            latch.clear()
+        self.occupancy = 0
+        self.__stall = None
+        self.pc = pc
+        if self.loops is not None:
+            self.loops.forget()
+    
+    def run_functional(self, start_pc, limit=None):
+        """ Runs the instructions starting at PC start_pc one at a time, each through all of its
+        stages before the next one starts, until the PC leaves the program or limit instructions
+        have been run.  Nothing is forwarded and nothing stalls, and no cycles are counted.
+        """
+        if self.occupancy:
+            raise RuntimeError("Can't run one instruction at a time with the pipeline full.")
+        pc = start_pc
+        count = 0
+        if limit is None:
+            limit = -1
+        decoded = self.decoded
+        while BASE_MEMORY <= pc < self.text_end and count != limit:
+            instruction = decoded.get(pc)
+            if instruction is None:
+                instruction = self.decode_at(pc)
+            if self.verbose: print 'Running 0x%x: %s' % (pc, instruction)
+
+            # The instructions expect the PC to be two instructions ahead when they execute, like
+            # it is in the pipeline, and a jump leaves it one ahead of where it jumped to.
+            self.pc = pc + 8
+            instruction.forwarded = None
+            instruction.execute(self)
+            instruction.memory(self)
+            instruction.write(self)
+            pc = self.pc - 4
+            count += 1
+        
+        self.pc = pc
+        self.instruction_count += count
+    
+    def run_translated(self, start_pc, limit=None):
+        """ Runs the program like run_functional, a block at a time.  A block is translated the
+        first time the PC gets to its start, and again if it's written to after that.
+        """
+        if self.occupancy:
+            raise RuntimeError("Can't run one instruction at a time with the pipeline full.")
+        blocks = self.blocks
+        registers, read_word, write_word = self.registers, self.read_word, self.write_word
+        pc = start_pc
+        count = 0
+        if limit is None:
+            limit = float('inf')
+        while BASE_MEMORY <= pc < self.text_end and count < limit:
+            block = blocks.get(pc)
+            if block is None:
+                block = self.translate(pc)
+            pc = block.run(self, registers, read_word, write_word)
+            count += block.length
+        
+        self.pc = pc
+        self.instruction_count += count
+    
+    def finished(self):
+        """ Returns whether the last run got to the end of the program: the PC has left it and
+        nothing is left in the pipeline.
+        """
+        return not self.occupancy and not (self.pc is not None and BASE_MEMORY <= self.pc < self.text_end)
+    
+    def translate(self, entry):
+        """ Translates the block starting at entry and remembers it. """
+        block = translate_block(self, entry)
+        if self.verbose: print 'Translated the block at 0x%x:\n%s' % (entry, block.source)
+        self.blocks[entry] = block
+        for addr in xrange(entry >> 2, block.end >> 2):
+            self.block_words.setdefault(addr, []).append(entry)
+        return block
     
     def cycle(self):
         """ Simulates a single cycle of the simulation. """
         if self.verbose: print '=' * 40, 'NEW CYCLE', '=' * 40
         # Do each of the stages
-        for stage in self.stages:
-            self.current_stage = stage
-            self.do_stage(stage)
+        for handler in self.handlers:
+            handler()
         
         # If the pipeline has anything in it, increase the cycle count.
-        if any(self.pipeline[stage] is not None for stage in self.stages):
+        if self.occupancy:
             self.cycle_count += 1
         
         if self.verbose: print 'Cycle count is now %d' % self.cycle_count
 
-    def do_stage(self, stage):
-        """ Execute the given stage. """
-        if stage not in self.stages:
-            raise RuntimeError("Invalid stage: %s" % stage)
-        
-        getattr(self, stage)()
-
     def fetch(self):
         """ Moves the pipeline along and fetches the next instruction. """
-        # Move the pipeline along.
-        for idx, stage in reversed(list(enumerate(self.stages))):
-            if stage == self.__stall:
-                # If we were told to stall at this stage, reset the stall and reset the next
-                # instruction (since this one won't be moved to the next stage).
-                self.__stall = None
-                self.pipeline[self.stages[idx + 1]] = None
-                if self.verbose: print 'Stalling pipeline at %s' % stage
-                if self.verbose: print 'New pipeline: %s' % self.pipeline
-                return
-            
-            if idx > 0:
-                instruction = self.pipeline[self.stages[idx - 1]]
-                if instruction is not None and self.verbose:
-                    print 'Moved %s from %s to %s' % (instruction, self.stages[idx - 1], stage)
-                self.pipeline[stage] = instruction
-                self.results[stage] = self.results[self.stages[idx - 1]]
-
-        # If our PC is still within the limits of our memory, fetch a new instruction.
-        if BASE_MEMORY <= self.pc < self.memory_size():
-            self.pipeline['fetch'] = self.read_word(self.pc)
-            if self.verbose: print 'Fetched new instruction from address 0x%x: %s' % (self.pc, self.pipeline['fetch'])
-        else:
-            self.pipeline['fetch'] = None
-        self.results['fetch'] = None
+        # Move the pipeline along.  The instruction in the write stage is done, so its latch is
+        # reused: for the instruction fetched into the fetch stage, or if we were told to stall at
+        # a stage, as the empty stage after it (since the stalled instruction won't be moved to it).
+        latches = self.latches
+        latch = latches.pop()
+        if latch.valid:
+            self.occupancy -= 1
+        latch.clear()
+
+        stall = self.__stall
+        self.__stall = None
+        reused = FETCH if stall is None else stall + 1
+        latches.insert(reused, latch)
+        if self.verbose:
+            for stage in xrange(WRITE, reused, -1):
+                if latches[stage].valid:
+                    print 'Moved %s from %s to %s' % (latches[stage].instruction, self.stages[stage - 1], self.stages[stage])
+        
+        if stall is not None:
+            if self.verbose: print 'Stalling pipeline at %s' % self.stages[stall]
+            if self.verbose: print 'New pipeline: %s' % latches
+            return
+        
+
+        # If our PC is still within the program, fetch a new instruction.
+        if BASE_MEMORY <= self.pc < self.text_end:
+            instruction = self.decoded.get(self.pc)
+            latch.instruction = instruction if instruction is not None else self.decode_at(self.pc)
+            latch.valid = True
+            latch.pc = self.pc
+            self.occupancy += 1
+            if self.verbose: print 'Fetched new instruction from address 0x%x: %s' % (self.pc, latch.instruction)
     
     def decode(self):
         """ Decode stage. """
-        if self.pipeline['decode'] is not None:
-            if self.verbose: print '-' * 30, 'decode stage for %s' % self.pipeline['decode'], '-' * 30
-            self.pipeline['decode'].decode(self)
+        latch = self.latches[DECODE]
+        if latch.valid:
+            if self.verbose: print '-' * 30, 'decode stage for %s' % latch.instruction, '-' * 30
+            latch.instruction.decode(self)
     
     def execute(self):
-        """ Execute stage. """
-        if self.pipeline['execute'] is not None:
-            if self.verbose: print '-' * 30, 'execute stage for %s' % self.pipeline['execute'], '-' * 30
-            self.pipeline['execute'].execute(self)
+        """ Execute stage.  Stalls instead if the instruction needs a value that isn't ready. """
+        latch = self.latches[EXECUTE]
+        if latch.valid:
+            instruction = latch.instruction
+            if self.verbose: print '-' * 30, 'execute stage for %s' % instruction, '-' * 30
+            if instruction.forwarding and not self.forward(instruction):
+                if self.verbose: print 'Stalling %s' % instruction
+                self.stall(EXECUTE)
+                return
+            instruction.execute(self)
     
     def memory(self):
         """ Memory stage. """
-        if self.pipeline['memory'] is not None:
-            if self.verbose: print '-' * 30, 'memory stage for %s' % self.pipeline['memory'], '-' * 30
-            self.pipeline['memory'].memory(self)
+        latch = self.latches[MEMORY]
+        if latch.valid:
+            instruction = latch.instruction
+            if self.verbose: print '-' * 30, 'memory stage for %s' % instruction, '-' * 30
+            if instruction.forwards_loads:
+                self.forward_load(instruction)
+            instruction.memory(self)
+    
+    def forward(self, instruction):
+        """ Works out where the registers the instruction in the execute stage reads come from,
+        and puts the values forwarded to it in its forwarded dict.  Returns False if it has to stall.
+
+        The results waiting in the memory and write stages are the only values that can be
+        forwarded, so together with the instruction in the memory stage they tell which
+        instruction last writes each register and whether its value is available yet.  A result
+        in the memory stage is newer than one in the write stage, so it wins.  The instruction in
+        the memory stage has no result there when it's a load that hasn't read memory yet, or when
+        it writes $r0, which is never forwarded; reading its register means stalling.
+        """
+        reads = instruction.reads
+        forwarded = None
+        from_memory = from_write = None
+        memory, write = self.latches[MEMORY], self.latches[WRITE]
+
+        result = memory.result
+        if result is not None:
+            number = result[0].register_number
+            if number != 0 and number in reads:
+                forwarded = {result[0]: result[1]}
+                from_memory = memory.instruction
+        
+        result = write.result
+        if result is not None and write.instruction is not from_memory:
+            number = result[0].register_number
+            if number != 0 and number in reads:
+                if forwarded is None:
+                    forwarded = {result[0]: result[1]}
+                else:
+                    forwarded.setdefault(result[0], result[1])
+                from_write = write.instruction
+        
+        instruction.forwarded = forwarded
+        if instruction.stalls:
+            pending = memory.instruction
+            if memory.valid and pending.writes in reads and \
+               pending is not from_memory and pending is not from_write:
+                return False
+        return True
+    
+    def forward_load(self, instruction):
+        """ Forwards the value a load in the write stage just read to the instruction in the
+        memory stage, over anything forwarded to it before.
+        """
+        write = self.latches[WRITE]
+        if write.result is not None and isinstance(write.instruction, LW):
+            result = write.result
+            number = result[0].register_number
+            if number != 0 and number in instruction.reads:
+                if instruction.forwarded is None:
+                    instruction.forwarded = {}
+                instruction.forwarded[result[0]] = result[1]
     
     def write(self):
         """ Write stage.  Also increments the number of instructions executed by 1. """
-        if self.pipeline['write'] is not None:
-            if self.verbose: print '-' * 30, 'write stage for %s' % self.pipeline['write'], '-' * 30
-            self.pipeline['write'].write(self)
+        latch = self.latches[WRITE]
+        if latch.valid:
+            if self.verbose: print '-' * 30, 'write stage for %s' % latch.instruction, '-' * 30
+            latch.instruction.write(self)
+            self.instruction_count += 1
+    
+    def write_and_detect(self):
+        """ Write stage, when loops are skipped through.  Also tells the loop detector what retired. """
+        latch = self.latches[WRITE]
+        if latch.valid:
+            if self.verbose: print '-' * 30, 'write stage for %s' % latch.instruction, '-' * 30
+            latch.instruction.write(self)
             self.instruction_count += 1
+            self.loops.retired(latch)
     
     def write_register(self, register, data):
         """ Writes data to the given register.  At this point, register must be a number.  If the
@@ -1,7 +1,14 @@
 #!/usr/bin/env python 
 
 import os
+import random
+import shutil
+import sys
+import tempfile
+import assembler
 import main
+import simulator
+import sampling
 
 TESTDIR = 'sample-code'
 
@@ -24,3 +31,323 @@ for test in sorted(results):
 		print 'Test %s failed with exception %s' % (test, results[test])
 	else:
 		print 'Test %s succeeded at %d cycles, %d instructions, with %.03f CPI' % (test, results[test]['cycles'], results[test]['instructions'], results[test]['cpi'])
+
+
+# Checks of the simulator that the sample programs don't cover.  Each returns a list of what went
+# wrong, which is empty when it succeeds.
+checks = []
+
+def check(func):
+	checks.append(func)
+	return func
+
+def assemble(source):
+	""" Assembles source, the text of a program, into a Program. """
+	fd, path = tempfile.mkstemp(suffix='.s')
+	try:
+		os.write(fd, source)
+		os.close(fd)
+		return main.load_asm_file(path, cache=False)
+	finally:
+		os.remove(path)
+
+def quietly(func, *args):
+	""" Calls func with args, throwing away what it prints, and returns what it returns. """
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, 'w')
+	try:
+		return func(*args)
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+
+# The most instructions a check runs a program for, so one that runs wrong can't hang the tests.
+LIMIT = 1000000
+
+def simulate(program, **options):
+	""" Runs program on a Simulator made with the given options, without printing, and returns it. """
+	sim = simulator.Simulator(**options)
+	sim.load_program(program)
+	quietly(sim.run, simulator.BASE_MEMORY, LIMIT)
+	return sim
+
+def expect_registers(name, sim, expected):
+	""" Returns what's wrong with the registers of sim, given expected, a dict of register numbers to their values. """
+	return ['%s: $r%d is %d, not %d' % (name, number, sim.registers[number], value)
+		for number, value in sorted(expected.items()) if sim.registers[number] != value]
+
+@check
+def forwarding_priority():
+	""" When the instructions in the memory and write stages both write a register the instruction
+	in the execute stage reads, the newer one in the memory stage (X->X) is forwarded, not the one in
+	the write stage (M->X).
+	"""
+	failures = []
+	sim = simulate(assemble('addi $r8, $r0, 1\naddi $r8, $r0, 2\nadd $r9, $r8, $r8\nsub $r10, $r8, $r0\n'))
+	failures += expect_registers('ALU over ALU', sim, {8: 2, 9: 4, 10: 2})
+	sim = simulate(assemble('addi $r1, $r0, 5\nsw $r1, 0($r0)\nlw $r8, 0($r0)\naddi $r8, $r0, 2\nadd $r9, $r8, $r8\n'))
+	failures += expect_registers('ALU over load', sim, {8: 2, 9: 4})
+	return failures
+
+def outcome(program, **options):
+	""" Returns the registers, memory, instruction count and PC after running program on a
+	Simulator made with the given options, or the error it stopped with.
+	"""
+	try:
+		sim = simulate(program, **options)
+	except RuntimeError, e:
+		return 'error %s' % e
+	return sim.registers, list(sim.memory_data), sim.instruction_count, sim.pc
+
+# Stores 0 over its last instruction, at 0x1010, before it gets there.  In list memory that word
+# isn't an instruction any more.
+STORING_OVER_TEXT = '''
+sw $r0, 4112($r0)
+addi $r1, $r0, 1
+addi $r2, $r0, 2
+addi $r3, $r0, 3
+addi $r4, $r0, 4
+'''
+
+# Runs the loop at 0x1004 three times, then writes addi $r5, $r5, 7 (0x20a50007) over its first
+# instruction, after it has been translated, and runs it twice more.
+SELF_MODIFYING = '''
+.data 0
+.word 0x20a50007
+.text
+ori $r1, $r0, 3
+addi $r5, $r5, 1
+subi $r1, $r1, 1
+bne $r1, $r0, -3
+bne $r6, $r0, 5
+ori $r6, $r0, 1
+lw $r2, 0($r0)
+sw $r2, 4100($r0)
+ori $r1, $r0, 2
+j 0x1004
+'''
+
+@check
+def translated_matches_functional():
+	""" Every sample program, and one that stores over its own text, gives the same registers and
+	memory, or the same error, translated as run one instruction at a time, with list and packed
+	memory, and a block written over after it's translated is translated again.
+	"""
+	failures = []
+	programs = [(filename, main.load_asm_file(os.path.join(TESTDIR, filename), cache=False))
+		for filename in sorted(os.listdir(TESTDIR))]
+	programs.append(('the program storing over its text', assemble(STORING_OVER_TEXT)))
+	for name, program in programs:
+		for packed in (False, True):
+			if outcome(program, mode='functional', packed=packed) != outcome(program, mode='translated', packed=packed):
+				failures.append('%s differs with %s memory' % (name, 'packed' if packed else 'list'))
+	program = assemble(SELF_MODIFYING)
+	for mode in ('functional', 'translated'):
+		failures += expect_registers('self-modifying %s' % mode, simulate(program, mode=mode, packed=True), {5: 17})
+	return failures
+
+def expect_error(name, func):
+	""" Returns what's wrong if calling func doesn't raise a RuntimeError. """
+	try:
+		func()
+	except RuntimeError:
+		return []
+	return ['%s didn\'t raise an error' % name]
+
+def run_state(sim):
+	""" Returns the registers, memory, counts and PC of sim, to compare runs by. """
+	return sim.registers, list(sim.memory_data), sim.instruction_count, sim.cycle_count, sim.pc
+
+# Stores 21 down to 2 from 0x2000 on, and loads them back to add them up in $r5.  The value stored
+# is forwarded to the sw, which still has it in the memory stage.
+STORING_LOOP = '''
+ori $r1, $r0, 20
+ori $r2, $r0, 0x2000
+addi $r6, $r1, 1
+sw $r6, 0($r2)
+lw $r4, 0($r2)
+addi $r2, $r2, 4
+add $r5, $r5, $r4
+subi $r1, $r1, 1
+bne $r1, $r0, -7
+add $r3, $r2, $r1
+'''
+
+@check
+def checkpoint_round_trip():
+	""" A run saved to a checkpoint part way through, with the pipeline full, and carried on from it
+	in a new simulator, ends the same as a run that didn't stop, wherever it stops, and so does one
+	carried on from an incremental checkpoint loaded on top of its parent, for a program and for a
+	program image.  Checkpoints that can't be loaded aren't.
+	"""
+	program = assemble(STORING_LOOP)
+	whole = simulate(program, packed=True)
+	failures = []
+	directory = tempfile.mkdtemp()
+	full, incremental, other = [os.path.join(directory, name) for name in ('full', 'incremental', 'other')]
+	try:
+		# The loop is run from the program, and from a program image, which maps the file as memory.
+		source, image = os.path.join(directory, 'loop.s'), os.path.join(directory, 'loop.img')
+		with open(source, 'wb') as f:
+			f.write(STORING_LOOP)
+		assembler.assemble(source, image, cache=False)
+		for loaded, load in (('program', lambda sim: sim.load_program(program)), ('image', lambda sim: sim.load_image(image))):
+			sim = simulator.Simulator(packed=True)
+			load(sim)
+			quietly(sim.run, simulator.BASE_MEMORY, 50)
+			if not sim.occupancy:
+				failures.append('the pipeline is empty at the checkpoint of the %s' % loaded)
+			sim.save_checkpoint(full)
+			quietly(sim.run, sim.pc, 50)
+			sim.save_checkpoint(incremental, incremental=True)
+			sim.save_checkpoint(other)
+			
+			for name, paths in (('full', [full]), ('incremental', [full, incremental])):
+				resumed = simulator.Simulator(packed=True)
+				for path in paths:
+					resumed.load_checkpoint(path)
+				quietly(resumed.run, resumed.pc, LIMIT)
+				if run_state(resumed) != run_state(whole):
+					failures.append('carrying on from the %s checkpoint of the %s ends differently' % (name, loaded))
+		
+		failures += expect_error('loading an incremental checkpoint on its own', lambda: simulator.Simulator(packed=True).load_checkpoint(incremental))
+		def wrong_parent():
+			sim = simulator.Simulator(packed=True)
+			sim.load_checkpoint(other)
+			sim.load_checkpoint(incremental)
+		failures += expect_error('loading an incremental checkpoint on top of the wrong one', wrong_parent)
+		failures += expect_error('saving list memory', lambda: simulator.Simulator().save_checkpoint(other))
+		failures += expect_error('loading into list memory', lambda: simulator.Simulator().load_checkpoint(full))
+		with open(full, 'rb') as f:
+			data = f.read()
+		with open(other, 'wb') as f:
+			f.write(data[:-1])
+		failures += expect_error('loading a truncated checkpoint', lambda: simulator.Simulator(packed=True).load_checkpoint(other))
+		
+		# Stopping anywhere in the loop or a sample program, with whatever is stalled or forwarded in the
+		# pipeline then, and carrying on from a checkpoint ends the same as not stopping.
+		programs = [('the storing loop', program)] + [(filename, main.load_asm_file(os.path.join(TESTDIR, filename), cache=False))
+			for filename in sorted(os.listdir(TESTDIR))]
+		for name, program in programs:
+			try:
+				whole = simulate(program, packed=True)
+			except RuntimeError:
+				# It can't be packed, or doesn't run.
+				continue
+			for stop in xrange(1, whole.instruction_count):
+				sim = simulator.Simulator(packed=True)
+				sim.load_program(program)
+				quietly(sim.run, simulator.BASE_MEMORY, stop)
+				sim.save_checkpoint(full)
+				resumed = simulator.Simulator(packed=True)
+				resumed.load_checkpoint(full)
+				quietly(resumed.run, resumed.pc, LIMIT)
+				if run_state(resumed) != run_state(whole):
+					failures.append('carrying on from %s after %d instructions ends differently' % (name, stop))
+					break
+	finally:
+		shutil.rmtree(directory)
+	return failures
+
+# Stores and loads back a number that goes up by 3 each iteration, 5000 times.
+SAMPLED_LOOP = '''
+ori $r1, $r0, 5000
+addi $r2, $r2, 3
+sw $r2, 0($r0)
+lw $r5, 0($r0)
+subi $r1, $r1, 1
+add $r6, $r5, $r5
+bne $r1, $r0, -6
+'''
+
+@check
+def sampled_cpi():
+	""" Sampled simulation of a loop gives the registers of a full run, and a confidence interval
+	that holds its CPI, although each iteration of the loop takes the same number of cycles.
+	"""
+	program = assemble(SAMPLED_LOOP)
+	full = simulate(program)
+	sim = simulator.Simulator()
+	sim.load_program(program)
+	sample = sampling.run_sampled(sim, window=100, warmup=10, skip=2000, seed=0)
+	failures = []
+	if sim.registers != full.registers:
+		failures.append('the registers differ from a full run')
+	if abs(sample.cpi() - full.cpi()) > sample.interval():
+		failures.append('the CPI is %.04f, not within %.04f +/- %.04f' % (full.cpi(), sample.cpi(), sample.interval()))
+	return failures
+
+def counted_loop(rand):
+	""" Returns the source of a random loop, counted down in $r1, that doesn't branch inside or stall. """
+	registers = ['$r%d' % number for number in xrange(2, 8)]
+	pick = lambda: rand.choice(registers)
+	lines = ['ori $r1, $r0, %d' % rand.randint(5, 200)]
+	lines += ['ori %s, $r0, %d' % (pick(), rand.randint(0, 50)) for _ in xrange(rand.randint(0, 3))]
+	body = []
+	for _ in xrange(rand.randint(1, 6)):
+		kind = rand.randint(0, 5)
+		if kind <= 1:
+			body.append('%s %s, %s, %s' % (rand.choice(['add', 'sub', 'slt', 'and', 'or']), pick(), pick(), rand.choice(registers + ['$r0', '$r1'])))
+		elif kind <= 3:
+			body.append('%s %s, %s, %d' % (rand.choice(['addi', 'subi', 'ori']), pick(), rand.choice(registers + ['$r1']), rand.randint(0, 9)))
+		elif kind == 4:
+			# Nothing reads the register loaded straight after, since the pipeline skips the
+			# instruction after one that stalls.
+			body.append('lw %s, %d($r0)' % (pick(), 4 * rand.randint(0, 4)))
+			body.append('or $r0, $r0, $r0')
+		else:
+			body.append('sw %s, %d($r0)' % (pick(), 4 * rand.randint(0, 4)))
+	body.append('subi $r1, $r1, 1')
+	body.append('bne $r1, $r0, %d' % -(len(body) + 1))
+	return '\n'.join(lines + body + ['ori $r9, $r0, 1']) + '\n'
+
+@check
+def extrapolation_is_exact():
+	""" Skipping through loops in a steady state gives the same registers, memory, counts and PC as
+	running every iteration, for the sample programs and random counted loops, and does skip some.
+	"""
+	failures = []
+	programs = [(filename, main.load_asm_file(os.path.join(TESTDIR, filename), cache=False))
+		for filename in sorted(os.listdir(TESTDIR))]
+	rand = random.Random(0)
+	programs += [('loop %d' % number, assemble(counted_loop(rand))) for number in xrange(60)]
+	skipped = 0
+	for name, program in programs:
+		try:
+			full = simulate(program)
+		except RuntimeError:
+			# It doesn't run.
+			continue
+		if not full.finished():
+			# The pipeline never gets out of it.
+			continue
+		extrapolated = simulate(program, extrapolate=True)
+		if run_state(extrapolated) != run_state(full):
+			failures.append('%s ends differently when loops are skipped through' % name)
+		skipped += extrapolated.loops.skipped
+	if not skipped:
+		failures.append('no loop iterations were skipped')
+	failures += expect_error('skipping through loops in translated mode', lambda: simulator.Simulator(mode='translated', extrapolate=True))
+	return failures
+
+@check
+def word_range():
+	""" .word takes values from -2^31 up to 2^32 - 1, and anything that doesn't fit in 32 bits is an error. """
+	failures = []
+	words = list(assemble('.data 0\n.word -2147483648, 4294967295, 0xffffffff\n').data[0][1])
+	if words != [0x80000000, 0xffffffff, 0xffffffff]:
+		failures.append('the words are %s' % ', '.join(['0x%x' % word for word in words]))
+	for value in ('4294967296', '-2147483649', '0x100000000'):
+		failures += expect_error('.word %s' % value, lambda: assemble('.data 0\n.word %s\n' % value))
+	return failures
+
+
+for func in checks:
+	try:
+		failures = func()
+	except Exception, e:
+		failures = ['exception %s' % e]
+	if failures:
+		print 'Check %s failed: %s' % (func.__name__, '; '.join(failures))
+	else:
+		print 'Check %s succeeded' % func.__name__
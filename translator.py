@@ -0,0 +1,219 @@
+""" Translates the basic blocks of a loaded program to Python functions, for the translated
+simulation mode.
+
+A block starts at the PC it's entered at and runs up to and including the first instruction that
+can change the PC or memory: a branch, a jump or a store.  Its instructions become straight-line
+Python working on the register list, with the values the block itself puts in registers and
+$r0 folded into the code as constants, so a branch on them is decided when the block is
+translated.  The function returns the PC to go on at.  Instructions the translator doesn't know
+are run through their own stage methods, like the functional mode does, and end the block.
+
+Each instruction behaves exactly like its execute, memory and write methods, quirks included:
+andi, ori and slti add their immediate.
+"""
+
+from instructions import *
+
+# Blocks are cut after this many instructions, so straight-line programs don't become one
+# enormous function.
+MAX_BLOCK_LENGTH = 256
+
+# How the ALU instructions combine their two source values: the function used to fold constants,
+# and the expression it's written as.
+ALU_OPERATIONS = {
+    Add:  (lambda a, b: a + b, '%s + %s'),
+    Sub:  (lambda a, b: a - b, '%s - %s'),
+    And:  (lambda a, b: a & b, '%s & %s'),
+    Or:   (lambda a, b: a | b, '%s | %s'),
+    Nor:  (lambda a, b: ~(a | b), '~(%s | %s)'),
+    Slt:  (lambda a, b: int(a < b), 'int(%s < %s)'),
+    AddI: (lambda a, b: a + b, '%s + %s'),
+    SubI: (lambda a, b: a - b, '%s - %s'),
+    AndI: (lambda a, b: a + b, '%s + %s'),
+    OrI:  (lambda a, b: a + b, '%s + %s'),
+    SltI: (lambda a, b: a + b, '%s + %s'),
+}
+
+BRANCH_OPERATIONS = {
+    Beq: (lambda a, b: a == b, '%s == %s'),
+    Bne: (lambda a, b: a != b, '%s != %s'),
+}
+
+# Stands for a register whose value isn't known when the block is translated.
+UNKNOWN = object()
+
+class Block(object):
+    """ A translated block: the function that runs it, the number of instructions in it and the
+    addresses it was translated from.
+    """
+    __slots__ = ('entry', 'end', 'length', 'source', 'run')
+
+    def __init__(self, entry, end, length, source, run):
+        self.entry = entry
+        self.end = end
+        self.length = length
+        self.source = source
+        self.run = run
+
+    def __repr__(self):
+        return 'Block(0x%x-0x%x)' % (self.entry, self.end)
+
+def literal(value):
+    if value < 0:
+        return '(%r)' % value
+    return '%r' % value
+
+class BlockWriter(object):
+    """ Collects the lines of a block's function and the register values known at each point. """
+
+    def __init__(self):
+        self.lines = []
+        self.known = {0: 0}
+        self.names = {}
+
+    def constant(self, argument):
+        """ Returns the value of the argument if it's known now, or UNKNOWN. """
+        if argument.is_immediate():
+            return argument.number
+        if argument.is_register():
+            return self.known.get(argument.register_number, UNKNOWN)
+        raise RuntimeError("Can't translate the argument %s." % argument)
+
+    def expression(self, argument):
+        value = self.constant(argument)
+        if value is not UNKNOWN:
+            return literal(value)
+        return 'r[%d]' % argument.register_number
+
+    def address(self, offset):
+        """ Returns the expression for the address of an Offset. """
+        base = self.constant(offset.offset_from)
+        if base is not UNKNOWN:
+            return literal(offset.offset.number + base)
+        return '%s + %s' % (literal(offset.offset.number), self.expression(offset.offset_from))
+
+    def assign(self, register, expression, value=UNKNOWN):
+        """ Puts the result of the expression in the register, which is value if it's known. """
+        number = register.register_number
+        if number == 0:
+            return
+        if value is UNKNOWN:
+            self.known.pop(number, None)
+            self.emit('r[%d] = %s' % (number, expression))
+        else:
+            self.known[number] = value
+            self.emit('r[%d] = %s' % (number, literal(value)))
+
+    def name(self, instruction):
+        """ Returns the name the function knows the instruction by. """
+        return self.names.setdefault(instruction, 'i%d' % len(self.names))
+
+    def emit(self, line):
+        self.lines.append(line)
+
+    def source(self):
+        lines = ['def block(sim, r, read_word, write_word):'] + ['    ' + line for line in self.lines]
+        return '\n'.join(lines) + '\n'
+
+def translate_instruction(writer, instruction, pc):
+    """ Adds the instruction at pc to the block.  Returns True if the block ends with it. """
+    cls = type(instruction)
+    if cls in ALU_OPERATIONS:
+        fold, form = ALU_OPERATIONS[cls]
+        if issubclass(cls, RType):
+            dest, a, b = instruction.rd, instruction.rs, instruction.rt
+        else:
+            dest, a, b = instruction.rt, instruction.rs, instruction.immediate
+        x, y = writer.constant(a), writer.constant(b)
+        if x is not UNKNOWN and y is not UNKNOWN:
+            writer.assign(dest, None, fold(x, y))
+        else:
+            writer.assign(dest, form % (writer.expression(a), writer.expression(b)))
+        return False
+
+    if cls in BRANCH_OPERATIONS:
+        test, form = BRANCH_OPERATIONS[cls]
+        target = pc + 4 + (instruction.immediate.number << 2)
+        x, y = writer.constant(instruction.rs), writer.constant(instruction.rt)
+        if x is not UNKNOWN and y is not UNKNOWN:
+            if not test(x, y):
+                return False
+            writer.emit('return 0x%x' % target)
+        else:
+            writer.emit('if %s:' % (form % (writer.expression(instruction.rs), writer.expression(instruction.rt))))
+            writer.emit('    return 0x%x' % target)
+            writer.emit('return 0x%x' % (pc + 4))
+        return True
+
+    if cls is J:
+        writer.emit('return 0x%x' % instruction.target.number)
+        return True
+
+    if cls is JR:
+        writer.emit('return %s' % writer.expression(instruction.rt))
+        return True
+
+    if cls is LW:
+        load = 'read_word(%s)' % writer.address(instruction.offset)
+        if instruction.rt.register_number == 0:
+            writer.emit(load)
+        else:
+            writer.assign(instruction.rt, load)
+        return False
+
+    if cls is SW:
+        # The store may have written over the rest of the block, so the PC goes back to the loop.
+        writer.emit('write_word(%s, %s)' % (writer.address(instruction.offset), writer.expression(instruction.rt)))
+        writer.emit('return 0x%x' % (pc + 4))
+        return True
+
+    return fallback(writer, instruction, pc)
+
+def fallback(writer, instruction, pc):
+    """ Adds the instruction at pc to the block, to be run the way the functional mode runs it.
+    It may change the PC and any register, so the block ends with it.
+    """
+    name = writer.name(instruction)
+    writer.emit('sim.pc = 0x%x' % (pc + 8))
+    writer.emit('%s.forwarded = None' % name)
+    writer.emit('%s.execute(sim)' % name)
+    writer.emit('%s.memory(sim)' % name)
+    writer.emit('%s.write(sim)' % name)
+    writer.emit('return sim.pc - 4')
+    writer.known = {0: 0}
+    return True
+
+def translate_block(sim, entry):
+    """ Translates the block starting at entry, which has to be in the program loaded in sim, and
+    returns it.
+    """
+    writer = BlockWriter()
+    pc = entry
+    length = 0
+    ended = False
+    while not ended and length < MAX_BLOCK_LENGTH and pc < sim.text_end:
+        try:
+            instruction = sim.decode_at(pc)
+        except RuntimeError:
+            # A word that isn't an instruction ends the block before it, and only fails when the
+            # program actually gets there.
+            if length == 0:
+                raise
+            break
+        try:
+            ended = translate_instruction(writer, instruction, pc)
+        except RuntimeError:
+            # An instruction with arguments that can't be translated is left to run itself, in a
+            # block of its own.  Nothing was added to the block for it yet.
+            if length > 0:
+                break
+            ended = fallback(writer, instruction, pc)
+        pc += 4
+        length += 1
+
+    if not ended:
+        writer.emit('return 0x%x' % pc)
+    source = writer.source()
+    namespace = dict((name, instruction) for instruction, name in writer.names.items())
+    exec compile(source, '<block at 0x%x>' % entry, 'exec') in namespace
+    return Block(entry, pc, length, source, namespace['block'])